@@ -0,0 +1,425 @@
+"""Benchmarks of the merge, split and LFN handling steps on synthetic data.
+
+A mock production of DL2-like files (several camera tables with tens of
+columns each) is generated once per set of parameters and re-used.
+Each benchmark runs in its own process, so that its peak memory (RSS) can
+be measured, and results are stored in a JSON file which can be compared
+with a previous one to spot regressions.
+
+The LFN handling benchmark queries a fake file catalog of a large production,
+answering each call after a fixed latency as a catalog server would.
+
+The package needs to be installed (e.g. pip install -e .); the split_dataset
+and lfn_handling benchmarks also require DIRAC.
+
+Examples:
+  $ python benchmarks/run_benchmarks.py --output results.json
+  $ python benchmarks/run_benchmarks.py --quick --compare results.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import tables as tb
+
+from protopipe_grid_interface.scripts.merge_tables import merge_list_of_pytables
+
+DEFAULT_PARAMETERS = dict(
+    n_files=1000,
+    n_rows=2000,
+    n_columns=40,
+    cameras=["LSTCam", "NectarCam", "FlashCam", "CHEC"],
+)
+QUICK_PARAMETERS = dict(
+    n_files=50, n_rows=500, n_columns=10, cameras=["LSTCam", "NectarCam"]
+)
+
+BENCHMARKS = [
+    "merge_serial",
+    "merge_parallel",
+    "merge_selection",
+    "split_dataset",
+    "lfn_handling",
+]
+
+
+def create_mock_production(directory, n_files, n_rows, n_columns, cameras):
+    """Write a mock production of DL2-like files.
+
+    Parameters
+    ----------
+    directory: pathlib.Path
+        Where to write the files (and a parameters.json file describing them),
+        replacing those of a production with other parameters
+    n_files: int
+        Number of files
+    n_rows: int
+        Number of rows of each table
+    n_columns: int
+        Number of float columns besides obs_id and event_id
+    cameras: list
+        Names of the tables in each file
+
+    """
+    parameters = dict(
+        n_files=n_files, n_rows=n_rows, n_columns=n_columns, cameras=cameras
+    )
+    parameters_file = directory / "parameters.json"
+    if parameters_file.exists():
+        with open(parameters_file, mode="r", encoding="utf8") as f:
+            if json.load(f) == parameters:
+                return
+        # the files of another production would be merged too
+        os.remove(parameters_file)
+        for path in directory.glob("DL2_*.h5"):
+            os.remove(path)
+
+    directory.mkdir(parents=True, exist_ok=True)
+    dtype = np.dtype(
+        [("obs_id", "i8"), ("event_id", "i8"), ("hillas_intensity", "f8")]
+        + [(f"parameter_{i}", "f4") for i in range(n_columns)]
+    )
+    rng = np.random.default_rng(0)
+    for idx in range(n_files):
+        with tb.open_file(
+            directory / f"DL2_proton_tail_run{idx:06d}.h5", mode="w"
+        ) as outfile:
+            for camera in cameras:
+                rows = np.zeros(n_rows, dtype=dtype)
+                rows["obs_id"] = idx
+                rows["event_id"] = np.arange(n_rows)
+                rows["hillas_intensity"] = rng.exponential(100.0, n_rows)
+                for i in range(n_columns):
+                    rows[f"parameter_{i}"] = rng.normal(size=n_rows)
+                outfile.create_table("/", camera, obj=rows)
+
+    with open(parameters_file, mode="w", encoding="utf8") as f:
+        json.dump(parameters, f)
+
+
+def _merge(data_directory, **options):
+    filename_list = sorted(str(path) for path in data_directory.glob("DL2_*.h5"))
+    logger = logging.getLogger("benchmark")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        destination = Path(tmp_dir) / "merged.h5"
+        start = time.perf_counter()
+        merge_list_of_pytables(filename_list, destination, logger=logger, **options)
+        elapsed = time.perf_counter() - start
+        with tb.open_file(destination, mode="r") as merged:
+            n_rows = sum(int(table.nrows) for table in merged.root)
+            n_bytes = sum(
+                int(table.nrows) * table.dtype.itemsize for table in merged.root
+            )
+    return dict(
+        seconds=elapsed,
+        n_files=len(filename_list),
+        rows=n_rows,
+        rows_per_second=n_rows / elapsed,
+        files_per_second=len(filename_list) / elapsed,
+        MB_per_second=n_bytes / 2**20 / elapsed,
+    )
+
+
+def bench_merge_serial(data_directory, n_workers):
+    return _merge(data_directory)
+
+
+def bench_merge_parallel(data_directory, n_workers):
+    return _merge(data_directory, n_workers=n_workers)
+
+
+def bench_merge_selection(data_directory, n_workers):
+    return _merge(
+        data_directory,
+        columns=["obs_id", "event_id", "hillas_intensity"],
+        where="hillas_intensity > 50",
+    )
+
+
+def bench_split_dataset(data_directory, n_workers):
+    # imported here since it requires DIRAC
+    from protopipe_grid_interface.scripts import split_dataset
+
+    # lists of LFNs as found in real productions
+    n_lfns = 300000
+    template = (
+        "/vo.cta.in2p3.fr/MC/PROD3/LaPalma/{0}/simtel/{1:07d}/{0}_20deg_180deg_"
+        "run{2}___cta-prod3-demo-2147m-LaPalma-baseline.simtel.gz\n"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        arguments = ["split_dataset.py", "--output_path", tmp_dir]
+        for particle in ["gamma", "proton", "electron"]:
+            input_list = Path(tmp_dir) / f"{particle}.list"
+            with open(input_list, mode="w", encoding="utf8") as f:
+                f.writelines(
+                    template.format(particle, i // 1000, i) for i in range(n_lfns // 3)
+                )
+            arguments += [f"--input_{particle}s", str(input_list)]
+        sys.argv = arguments
+        start = time.perf_counter()
+        split_dataset.main()
+        elapsed = time.perf_counter() - start
+    return dict(seconds=elapsed, lfns=n_lfns, lfns_per_second=n_lfns / elapsed)
+
+
+class FakeCatalog:
+    """File catalog of a mock production, without network access.
+
+    Directories hold files_per_directory files each, and every call waits
+    latency seconds, as the round trip to a catalog server.
+    Each file has replicas on one or two of the SEs.
+    """
+
+    SES = ["CC-IN2P3-Disk", "DESY-ZN-Disk", "CNAF-Disk"]
+
+    def __init__(self, base_dir, n_lfns, files_per_directory=1000, latency=0.005):
+        self.base_dir = base_dir
+        self.latency = latency
+        self.directories = {}
+        self.metadata = {}
+        self.replicas = {}
+        for i in range(n_lfns):
+            directory = f"{base_dir}/{i // files_per_directory:07d}"
+            lfn = f"{directory}/gamma_20deg_180deg_run{i}___cta-prod3.simtel.gz"
+            content = self.content(lfn)
+            self.directories.setdefault(directory, []).append(lfn)
+            self.metadata[lfn] = {
+                "Size": len(content),
+                "Checksum": f"{zlib.adler32(content):08x}",
+            }
+            self.replicas[lfn] = {se: lfn for se in self.SES[i % 3 : i % 3 + 2]}
+
+    @staticmethod
+    def content(lfn):
+        return lfn.encode() * 4
+
+    @staticmethod
+    def _result(successful):
+        return {"OK": True, "Value": {"Successful": successful, "Failed": {}}}
+
+    def listDirectory(self, paths):
+        time.sleep(self.latency)
+        listings = {}
+        for path in paths:
+            if path == self.base_dir:
+                listings[path] = {
+                    "Files": {},
+                    "SubDirs": dict.fromkeys(self.directories),
+                }
+            else:
+                files = dict.fromkeys(self.directories.get(path, []), {})
+                listings[path] = {"Files": files, "SubDirs": {}}
+        return self._result(listings)
+
+    def getFileMetadata(self, lfns):
+        time.sleep(self.latency)
+        return self._result({lfn: self.metadata[lfn] for lfn in lfns})
+
+    def getReplicas(self, lfns):
+        time.sleep(self.latency)
+        return self._result({lfn: self.replicas[lfn] for lfn in lfns})
+
+
+def bench_lfn_handling(data_directory, n_workers):
+    # imported here since it requires DIRAC
+    from protopipe_grid_interface.utils import (
+        files_to_download,
+        get_replicas,
+        list_lfns,
+    )
+
+    # listing, then selection of the files to download (a fifth of them
+    # being already downloaded) and of those with a replica on a disk
+    n_lfns = 50000
+    catalog = FakeCatalog("/vo.cta.in2p3.fr/MC/PROD3/LaPalma/gamma/simtel", n_lfns)
+    logger = logging.getLogger("benchmark")
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for lfn in list(catalog.metadata)[::5]:
+            with open(Path(tmp_dir) / os.path.basename(lfn), mode="wb") as f:
+                f.write(catalog.content(lfn))
+
+        start = time.perf_counter()
+        lfns = list(list_lfns(catalog.base_dir, catalog=catalog, logger=logger))
+        timings["list_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        missing = files_to_download(
+            lfns, tmp_dir, catalog=catalog, n_workers=n_workers, logger=logger
+        )
+        timings["files_to_download_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        replicas = get_replicas(lfns, catalog=catalog, logger=logger)
+        on_disk = [lfn for lfn in lfns if "CC-IN2P3-Disk" in replicas.get(lfn, [])]
+        timings["replica_filter_seconds"] = time.perf_counter() - start
+
+    assert len(lfns) == n_lfns and len(missing) == n_lfns - n_lfns // 5
+    elapsed = sum(timings.values())
+    return dict(
+        seconds=elapsed,
+        lfns=n_lfns,
+        selected_lfns=len(on_disk),
+        lfns_per_second=n_lfns / elapsed,
+        **timings,
+    )
+
+
+def run_benchmark(name, data_directory, n_workers):
+    """Run a benchmark in a child process and measure its peak memory."""
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            __file__,
+            "--run_one",
+            name,
+            "--data_dir",
+            str(data_directory),
+            "--n_workers",
+            str(n_workers),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    stdout, stderr = process.communicate()
+    result = dict(name=name, returncode=process.returncode)
+    if process.returncode != 0:
+        result["error"] = stderr.strip().splitlines()[-1:] or ["unknown error"]
+        return result
+    result.update(json.loads(stdout.strip().splitlines()[-1]))
+    return result
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its worker processes."""
+    import resource
+
+    rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def compare(results, reference, threshold):
+    """Print the change of each benchmark with respect to a reference run.
+
+    Returns the names of the benchmarks slower than reference by more than
+    threshold (a fraction).
+    """
+    reference = {result["name"]: result for result in reference["results"]}
+    regressions = []
+    for result in results["results"]:
+        old = reference.get(result["name"])
+        if old is None or "seconds" not in result or "seconds" not in old:
+            print(f"{result['name']:20s} no comparison available")
+            continue
+        change = result["seconds"] / old["seconds"] - 1
+        print(
+            f"{result['name']:20s} {old['seconds']:8.2f} s -> {result['seconds']:8.2f} s"
+            f" ({change:+.0%}), peak RSS {old['peak_rss_mb']:.0f}"
+            f" -> {result['peak_rss_mb']:.0f} MB"
+        )
+        if change > threshold:
+            regressions.append(result["name"])
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default=None,
+        help="Directory of the mock production (default: temporary directory)",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="JSON file where to store results"
+    )
+    parser.add_argument(
+        "--compare", type=str, default=None, help="JSON results to compare with"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slow-down reported as regression (default: 0.2)",
+    )
+    parser.add_argument(
+        "--quick", action="store_true", help="Use a small mock production"
+    )
+    parser.add_argument(
+        "--benchmarks",
+        type=str,
+        nargs="+",
+        default=BENCHMARKS,
+        choices=BENCHMARKS,
+        help="Benchmarks to run (default: all)",
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Processes used by parallel benchmarks (default: number of CPUs)",
+    )
+    parser.add_argument("--run_one", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        result = globals()[f"bench_{args.run_one}"](Path(args.data_dir), args.n_workers)
+        result["peak_rss_mb"] = peak_rss_mb()
+        print(json.dumps(result))
+        return
+
+    parameters = QUICK_PARAMETERS if args.quick else DEFAULT_PARAMETERS
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_directory = Path(args.data_dir or tmp_dir)
+        print(f"Generating mock production in {data_directory}: {parameters}")
+        create_mock_production(data_directory, **parameters)
+
+        results = dict(
+            date=datetime.datetime.now().isoformat(timespec="seconds"),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            tables=tb.__version__,
+            n_workers=args.n_workers,
+            parameters=parameters,
+            results=[],
+        )
+        for name in args.benchmarks:
+            result = run_benchmark(name, data_directory, args.n_workers)
+            results["results"].append(result)
+            print(json.dumps(result))
+
+    if args.output is not None:
+        with open(args.output, mode="w", encoding="utf8") as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare, mode="r", encoding="utf8") as f:
+            reference = json.load(f)
+        if reference.get("parameters") != results["parameters"]:
+            print("WARNING: the reference was run on a different mock production")
+        regressions = compare(results, reference, args.threshold)
+        if regressions:
+            sys.exit(f"Regressions: {regressions}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 import argparse
 import logging
 import subprocess
+import tempfile
+
+from protopipe_grid_interface.utils import invalidate_catalog_cache, list_lfns
 
 
 def main():
@@ -18,27 +21,21 @@ def main():
     logger.debug("Delete file from: %s", args.indir)
 
     # Get list of files
-    batcmd = f"dirac-dms-user-lfns --BaseDir {args.indir}"
-    result = subprocess.check_output(batcmd, shell=True)
-    logger.debug(result)
-    file_list = result.split()[-1]
-
-    # Try reading the LFNs file
-    try:
-        with open(file_list, mode="r", encoding="utf8"):
-            # Delete files
-            batcmd = f"dirac-dms-remove-files {file_list}"
-            result = subprocess.check_output(batcmd, shell=True)
-    except IOError:
-        logger.exception("Can't read LFNs file list.")
+    lfns = list(list_lfns(args.indir, logger=logger))
+    logger.debug("Found %d files", len(lfns))
+
+    if lfns:
+        # Delete files
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".list") as file_list:
+            file_list.write("\n".join(lfns) + "\n")
+            file_list.flush()
+            result = subprocess.check_output(["dirac-dms-remove-files", file_list.name])
+            logger.debug(result)
+        invalidate_catalog_cache([args.indir])
 
     # Final check
     # Get same list of files again
-    batcmd = f"dirac-dms-user-lfns --BaseDir {args.indir}"
-    result = subprocess.check_output(batcmd, shell=True)
-    logger.debug(result)
-    file_list = result.split()[-1]
-    if len(file_list) > 0:
+    if next(list_lfns(args.indir, logger=logger), None) is not None:
         logger.error("Some files appear to not be removed.")
     else:
         logger.info("Removal completed.")
@@ -1,13 +1,365 @@
 import argparse
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from fnmatch import fnmatch
 import glob
+import os
 from pathlib import Path
+import queue
 import subprocess
+import threading
 
+from DIRAC.Resources.Catalog.FileCatalog import FileCatalog
 import yaml
 
-from protopipe_grid_interface.scripts.merge_tables import merge_call
-from protopipe_grid_interface.utils import initialize_logger, download
+from protopipe_grid_interface.scripts.merge_tables import merge_call, StreamingMerger
+from protopipe_grid_interface.utils import (
+    initialize_logger,
+    download,
+    download_files,
+    files_to_download,
+    get_file_metadata,
+    get_replicas,
+    list_lfns,
+    CachedFileCatalog,
+    DownloadCache,
+    StorageElementHistory,
+    DEFAULT_CONCURRENCY,
+)
+
+# Define data type for analysis
+DATA_TYPE = {
+    "TRAINING/for_energy_estimation": "TRAINING_energy",
+    "TRAINING/for_particle_classification": "TRAINING_classification",
+    "DL2": "DL2",
+}
+
+
+def download_and_merge_stream(
+    input_directory,
+    output_directory,
+    output_file,
+    template_file_name,
+    args,
+    log,
+    catalog=None,
+    se_history=None,
+    transfer_slots=None,
+    merge_slots=None,
+    cache=None,
+):
+    """Merge the files of a directory on the GRID while they are downloaded.
+
+    Downloaded files go through a queue of at most args.queue_size files to
+    a thread which validates and appends them to the merged file, so that
+    merging overlaps with the transfers (which wait while the queue is full).
+    Files already downloaded and up to date are merged first.
+    With args.delete_merged, the files are removed once merged, which bounds
+    the local disk use but means they are downloaded again by the next run
+    (unless they are in the shared cache).
+
+    Parameters
+    ----------
+    input_directory: pathlib.Path
+        DIRAC file catalog directory of the files
+    output_directory: pathlib.Path
+        Local directory of the files
+    output_file: pathlib.Path
+        Merged file
+    template_file_name: str
+        Beginning of the name of the files to merge
+    args: argparse.Namespace
+        Command line options
+    log: logging.Logger
+        Logger
+    catalog: protopipe_grid_interface.utils.CachedFileCatalog
+        Catalog to use (default: new FileCatalog object)
+    se_history: protopipe_grid_interface.utils.StorageElementHistory
+        History used to choose the replicas to download
+    transfer_slots: threading.Semaphore
+        Limit on the transfers, shared with the other particle types
+    merge_slots: threading.Semaphore
+        Limit on the merges, shared with the other particle types
+    cache: protopipe_grid_interface.utils.DownloadCache
+        Cache of downloaded files shared between analyses
+
+    Returns
+    -------
+    failed: dict
+        Reasons of the failure by LFN, for files which could not be downloaded
+
+    """
+    output_directory.mkdir(parents=True, exist_ok=True)
+    if catalog is None:
+        catalog = FileCatalog()
+
+    lfns = list(list_lfns(str(input_directory), catalog=catalog, logger=log))
+    lfns_to_download = files_to_download(
+        lfns, output_directory, catalog=catalog, n_workers=args.concurrency, logger=log
+    )
+    metadata = None
+    if cache is not None or se_history is not None:
+        metadata = get_file_metadata(lfns_to_download, catalog=catalog, logger=log)
+    if cache is not None:
+        lfns_to_download = cache.fetch(
+            lfns_to_download, output_directory, metadata, logger=log
+        )
+
+    def to_merge(lfn):
+        return fnmatch(os.path.basename(lfn), f"{template_file_name}*.h5")
+
+    n_files = sum(1 for lfn in lfns if to_merge(lfn))
+    pending = set(lfns_to_download)
+    local_files = [
+        output_directory / os.path.basename(lfn)
+        for lfn in lfns
+        if to_merge(lfn) and lfn not in pending
+    ]
+    log.info(
+        "Merging %d files into %s: %d to download, %d already downloaded",
+        n_files,
+        output_file,
+        sum(1 for lfn in lfns_to_download if to_merge(lfn)),
+        len(local_files),
+    )
+
+    downloaded = queue.Queue(maxsize=max(args.queue_size, 1))
+    errors = []
+
+    def merge_batch(merger, batch):
+        if not batch:
+            return
+        with merge_slots or nullcontext():
+            merged = merger.append([str(filename) for filename in batch])
+        if args.delete_merged:
+            for filename in merged:
+                os.remove(filename)
+
+    def merge_files():
+        done = False
+        try:
+            with StreamingMerger(output_file, log, n_files=n_files) as merger:
+                for idx in range(0, len(local_files), downloaded.maxsize):
+                    merge_batch(merger, local_files[idx : idx + downloaded.maxsize])
+                while not done:
+                    # merge all the files waiting in the queue at once
+                    batch = [downloaded.get()]
+                    while batch[-1] is not None:
+                        try:
+                            batch.append(downloaded.get_nowait())
+                        except queue.Empty:
+                            break
+                    done = batch[-1] is None
+                    merge_batch(merger, [filename for filename in batch if filename])
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+            # keep emptying the queue, so that the transfers do not wait forever
+            while not done:
+                done = downloaded.get() is None
+
+    def queue_file(lfn, filename):
+        if cache is not None and metadata.get(lfn, {}).get("Checksum"):
+            cache.put(lfn, metadata[lfn]["Checksum"], filename, logger=log)
+        if to_merge(lfn):
+            downloaded.put(filename)
+
+    merger_thread = threading.Thread(target=merge_files)
+    merger_thread.start()
+    try:
+        replicas = None
+        if se_history is not None:
+            replicas = get_replicas(lfns_to_download, catalog=catalog, logger=log)
+        failed = download_files(
+            lfns_to_download,
+            output_directory,
+            concurrency=args.concurrency,
+            logger=log,
+            replicas=replicas,
+            se_history=se_history,
+            transfer_slots=transfer_slots,
+            callback=queue_file,
+            metadata=metadata,
+        )
+    finally:
+        downloaded.put(None)
+        merger_thread.join()
+    if errors:
+        raise errors[0]
+    return failed
+
+
+def process_particle(
+    part,
+    args,
+    input_directory,
+    output_directory,
+    log,
+    catalog=None,
+    se_history=None,
+    transfer_slots=None,
+    merge_slots=None,
+    cache=None,
+):
+    """Download, sync and merge the files of one particle type.
+
+    Parameters
+    ----------
+    part: str
+        Particle type
+    args: argparse.Namespace
+        Command line options
+    input_directory: pathlib.Path
+        DIRAC file catalog directory of the files
+    output_directory: pathlib.Path
+        Local directory of the files
+    log: logging.Logger
+        Logger
+    catalog: protopipe_grid_interface.utils.CachedFileCatalog
+        Catalog to use (default: new FileCatalog object)
+    se_history: protopipe_grid_interface.utils.StorageElementHistory
+        History used to choose the replicas to download
+    transfer_slots: threading.Semaphore
+        Limit on the transfers, shared with the other particle types
+    merge_slots: threading.Semaphore
+        Limit on the merges, shared with the other particle types
+    cache: protopipe_grid_interface.utils.DownloadCache
+        Cache of downloaded files shared between analyses
+
+    """
+
+    log.info("Processing %s...", part)
+
+    output_file = (
+        output_directory
+        / f"{DATA_TYPE[args.data_type]}_{args.cleaning_mode}_{part}_merged.h5"
+    )
+    template_file_name = f"{DATA_TYPE[args.data_type]}_{part}_{args.cleaning_mode}"
+
+    if args.pipeline:
+        log.info("Downloading and merging %s...", part)
+        download_and_merge_stream(
+            input_directory,
+            output_directory,
+            output_file,
+            template_file_name,
+            args,
+            log,
+            catalog=catalog,
+            se_history=se_history,
+            transfer_slots=transfer_slots,
+            merge_slots=merge_slots,
+            cache=cache,
+        )
+        log.info("Downloaded files have been merged into %s", output_file)
+        return
+
+    # Download files
+    if not args.disable_download:
+        log.info("Downloading %s...", part)
+        log.debug("...from %s", input_directory)
+        log.debug("...to %s", output_directory)
+        download(
+            str(input_directory),
+            str(output_directory),
+            concurrency=args.concurrency,
+            catalog=catalog,
+            se_history=se_history,
+            transfer_slots=transfer_slots,
+            cache=cache,
+        )
+        n_files = len(glob.glob(str(output_directory / "*.h5")))
+        log.info("%i files have been downloaded into %s", n_files, output_directory)
+    # Syncing (for good measure)
+    if args.sync:
+        log.info("Syncing directory to be sure...")
+        subprocess.check_call(
+            [
+                "dirac-dms-directory-sync",
+                "-D",
+                f"-j {args.n_jobs}",
+                str(input_directory),
+                str(output_directory),
+            ]
+        )
+
+    # Merging files
+    if not args.disable_merge:
+        log.debug("template_file_name = %s", template_file_name)
+        with merge_slots or nullcontext():
+            log.info("Merging %s...", part)
+            merge_call(
+                template_file_name,
+                output_directory,
+                output_file,
+                logger=log,
+                n_workers=args.n_workers,
+                incremental=args.incremental,
+            )
+
+        log.info("Downloaded files have been merged into %s", output_file)
+
+
+def process_particles(
+    particle_types, args, directories, log, catalog=None, se_history=None, cache=None
+):
+    """Download, sync and merge the files of all particle types at the same time.
+
+    While a merge uses the CPU, the downloads of the other particle types
+    use the network: transfers are limited to args.concurrency in total,
+    and a single merge runs at a time.
+    The failure of a particle type does not stop the others.
+
+    Parameters
+    ----------
+    particle_types: list
+        Particle types
+    args: argparse.Namespace
+        Command line options
+    directories: callable
+        Function returning the DIRAC file catalog directory and the local
+        directory of the files of a particle type
+    log: logging.Logger
+        Logger
+    catalog: protopipe_grid_interface.utils.CachedFileCatalog
+        Catalog to use (default: new FileCatalog object)
+    se_history: protopipe_grid_interface.utils.StorageElementHistory
+        History used to choose the replicas to download
+    cache: protopipe_grid_interface.utils.DownloadCache
+        Cache of downloaded files shared between analyses
+
+    Returns
+    -------
+    failed: list
+        Particle types whose processing failed
+
+    """
+    transfer_slots = threading.BoundedSemaphore(args.concurrency)
+    merge_slots = threading.BoundedSemaphore(1)
+    with ThreadPoolExecutor(max_workers=len(particle_types)) as pool:
+        futures = {
+            pool.submit(
+                process_particle,
+                part,
+                args,
+                *directories(part),
+                log,
+                catalog=catalog,
+                se_history=se_history,
+                transfer_slots=transfer_slots,
+                merge_slots=merge_slots,
+                cache=cache,
+            ): part
+            for part in particle_types
+        }
+        failed = []
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Processing of %s failed", futures[future])
+                failed.append(futures[future])
+    return failed
 
 
 def main():
@@ -15,8 +367,14 @@ def main():
 
     description = """Download and merge data from the DIRAC grid.
 
-    The default behaviour calls an rsync-like command after the normal download as
-    an additional check.
+    Files which were already downloaded, and whose size and checksum match those
+    in the catalog, are not downloaded again.
+    An rsync-like command can be called after the download as an additional check
+    (--sync).
+    With --pipeline, each file is validated and merged as soon as it is downloaded.
+    Downloaded files are kept in a cache shared by the analyses
+    (shared_folder/productions/download_cache, see --shared_cache), from which
+    they are linked read-only into each analysis.
 
     This script can be used separately, or in association with an analysis workflow.
     In the second case the recommended usage is via the metadata file produced at creation.
@@ -35,16 +393,87 @@ def main():
     )
 
     parser.add_argument(
-        "--disable_download", action="store_true", help="Do not download files serially"
+        "--disable_download", action="store_true", help="Do not download files"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"""Number of files downloaded at the same time
+                (default: {DEFAULT_CONCURRENCY})""",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=float,
+        default=None,
+        help="""Answer catalog queries from the local cache, querying again
+                entries older than this number of seconds (default: no cache)""",
+    )
+    parser.add_argument(
+        "--rank_replicas",
+        action="store_true",
+        help="""Download each file from the Storage Element which has been the
+                fastest and most reliable so far (history kept locally)""",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Syncronyze folders after download (dirac-dms-directory-sync)",
     )
     parser.add_argument(
         "--disable_sync",
         action="store_true",
-        help="Do not syncronyze folders after serial download",
+        help="Deprecated argument (folders are syncronyzed only with --sync)",
     )
     parser.add_argument(
         "--disable_merge", action="store_true", help="Do not merge files at the end"
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only merge files which are new since the last merge",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="""Validate and merge each file as soon as it is downloaded,
+                instead of after the download of all the files; the rows of the
+                merged file are then in the order in which the downloads
+                complete, not in the sorted order of the file names""",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=64,
+        help="""With --pipeline, number of downloaded files waiting to be merged
+                after which transfers pause (default: 64)""",
+    )
+    parser.add_argument(
+        "--delete_merged",
+        action="store_true",
+        help="""With --pipeline, delete the downloaded files once merged
+                (they are downloaded again by the next run, unless cached)""",
+    )
+    parser.add_argument(
+        "--shared_cache",
+        type=str,
+        default=None,
+        help="""Directory of a cache of downloaded files shared between analyses,
+                from which they are linked instead of downloaded again
+                (default: shared_folder/productions/download_cache)""",
+    )
+    parser.add_argument(
+        "--no_shared_cache",
+        action="store_true",
+        help="Do not use a cache of downloaded files shared between analyses",
+    )
+    parser.add_argument(
+        "--shared_cache_gb",
+        type=float,
+        default=None,
+        help="""Size in GB above which the least recently used files are
+                removed from the shared cache (default: no limit)""",
+    )
 
     parser.add_argument(
         "--indir", type=str, default=None, help="Override input directory"
@@ -74,6 +503,19 @@ def main():
         help="One of more particle type to download and merge",
     )
 
+    parser.add_argument(
+        "--concurrent_particles",
+        action="store_true",
+        help="""Process the particle types at the same time, sharing the limits
+                on transfers (--concurrency) and merges (one at a time)""",
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=1,
+        help="Number of processes used to merge files (default: 1)",
+    )
+
     parser.add_argument(
         "--n_jobs",
         type=int,
@@ -123,24 +565,33 @@ def main():
 
     args = parser.parse_args()
 
-    # Define data type for analysis
-    data_type = {
-        "TRAINING/for_energy_estimation": "TRAINING_energy",
-        "TRAINING/for_particle_classification": "TRAINING_classification",
-        "DL2": "DL2",
-    }
+    if args.pipeline and (
+        args.disable_download or args.disable_merge or args.sync or args.incremental
+    ):
+        parser.error(
+            "--pipeline cannot be used with --disable_download, --disable_merge,"
+            " --sync or --incremental"
+        )
+    if args.delete_merged and not args.pipeline:
+        parser.error("--delete_merged requires --pipeline")
+    if args.shared_cache and args.no_shared_cache:
+        parser.error("--shared_cache cannot be used with --no_shared_cache")
 
     if args.metadata:
         with open(args.metadata, mode="r", encoding="utf8") as f:
             metadata = yaml.safe_load(f)
         analysis_name = metadata["analysis_name"]
         analysis_path_local = Path(metadata["analyses_directory"]) / analysis_name
+        productions_directory = (
+            Path(metadata["analyses_directory"]).parent / "productions"
+        )
         grid_home = Path(metadata["Home directory on the GRID"])
         grid_path_from_home = Path(metadata["analysis directory on the GRID from home"])
     else:
         local = Path(args.local_path)
         analysis_name = args.analysis_name
         analysis_path_local = local / "shared_folder/analyses" / analysis_name
+        productions_directory = local / "shared_folder/productions"
         grid_home = Path(args.GRID_home)
         grid_path_from_home = Path(args.GRID_path_from_home)
 
@@ -154,11 +605,21 @@ def main():
         logger_name=__name__, log_filename=log_filepath, append=append
     )
 
-    # for each particle type selected
-    for part in args.particle_types:
+    if args.disable_sync:
+        log.warning(
+            "--disable_sync is deprecated: folders are syncronyzed only with --sync"
+        )
 
-        log.info("Processing %s...", part)
+    catalog = None if args.cache_ttl is None else CachedFileCatalog(ttl=args.cache_ttl)
+    se_history = StorageElementHistory() if args.rank_replicas else None
+    cache = None
+    if not args.no_shared_cache:
+        cache = DownloadCache(
+            args.shared_cache or productions_directory / "download_cache",
+            max_size_gb=args.shared_cache_gb,
+        )
 
+    def directories(part):
         # DIRAC file catalog full path
         input_directory = (
             grid_home
@@ -170,42 +631,33 @@ def main():
         )
         # Full path in local virtual environment for the grid interface
         output_directory = analysis_path_local / "data" / args.data_type / part
+        return input_directory, output_directory
 
-        # Download files
-        if not args.disable_download:
-            log.info("Downloading %s...", part)
-            log.debug("...from %s", input_directory)
-            log.debug("...to %s", output_directory)
-            download(str(input_directory), str(output_directory))
-            n_files = len(glob.glob(str(output_directory / "*.h5")))
-            log.info("%i files have been downloaded into %s", n_files, output_directory)
-        # Syncing (for good measure)
-        if not args.disable_sync:
-            log.info("Syncing directory to be sure...")
-            subprocess.check_call(
-                [
-                    "dirac-dms-directory-sync",
-                    "-D",
-                    f"-j {args.n_jobs}",
-                    str(input_directory),
-                    str(output_directory),
-                ]
+    if not args.concurrent_particles:
+        # for each particle type selected
+        for part in args.particle_types:
+            process_particle(
+                part,
+                args,
+                *directories(part),
+                log,
+                catalog=catalog,
+                se_history=se_history,
+                cache=cache,
             )
+        return
 
-        # Merging files
-        if not args.disable_merge:
-            log.info("Merging %s...", part)
-            output_file = (
-                output_directory
-                / f"{data_type[args.data_type]}_{args.cleaning_mode}_{part}_merged.h5"
-            )
-            template_file_name = (
-                f"{data_type[args.data_type]}_{part}_{args.cleaning_mode}"
-            )
-            log.debug("template_file_name = %s", template_file_name)
-            merge_call(template_file_name, output_directory, output_file, logger=log)
-
-            log.info("Downloaded files have been merged into %s", output_file)
+    failed = process_particles(
+        args.particle_types,
+        args,
+        directories,
+        log,
+        catalog=catalog,
+        se_history=se_history,
+        cache=cache,
+    )
+    if failed:
+        raise SystemExit(f"Processing failed for particle types {failed}")
 
 
 if __name__ == "__main__":
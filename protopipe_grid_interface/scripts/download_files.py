@@ -1,5 +1,12 @@
 import argparse
-from protopipe_grid_interface.utils import check_voms, download
+from protopipe_grid_interface.utils import (
+    check_voms,
+    download,
+    CachedFileCatalog,
+    DownloadCache,
+    StorageElementHistory,
+    DEFAULT_CONCURRENCY,
+)
 
 
 def main():
@@ -10,9 +17,55 @@ def main():
     parser = argparse.ArgumentParser(description="Download collection files from Dirac")
     parser.add_argument("--indir", default=None, help="Dirac repository")
     parser.add_argument("--outdir", default="", help="Output file directory")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"""Number of files downloaded at the same time
+                (default: {DEFAULT_CONCURRENCY})""",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=float,
+        default=None,
+        help="""Answer catalog queries from the local cache, querying again
+                entries older than this number of seconds (default: no cache)""",
+    )
+    parser.add_argument(
+        "--rank_replicas",
+        action="store_true",
+        help="""Download each file from the Storage Element which has been the
+                fastest and most reliable so far (history kept locally)""",
+    )
+    parser.add_argument(
+        "--shared_cache",
+        type=str,
+        default=None,
+        help="""Directory of a cache of downloaded files shared between analyses,
+                e.g. shared_folder/productions/download_cache (default: no cache)""",
+    )
+    parser.add_argument(
+        "--shared_cache_gb",
+        type=float,
+        default=None,
+        help="""Size in GB above which the least recently used files are
+                removed from the shared cache (default: no limit)""",
+    )
     args = parser.parse_args()
 
-    download(args.indir, args.outdir)
+    catalog = None if args.cache_ttl is None else CachedFileCatalog(ttl=args.cache_ttl)
+    download(
+        args.indir,
+        args.outdir,
+        concurrency=args.concurrency,
+        catalog=catalog,
+        se_history=StorageElementHistory() if args.rank_replicas else None,
+        cache=(
+            None
+            if args.shared_cache is None
+            else DownloadCache(args.shared_cache, max_size_gb=args.shared_cache_gb)
+        ),
+    )
 
 
 if __name__ == "__main__":
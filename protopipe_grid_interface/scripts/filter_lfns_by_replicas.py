@@ -15,6 +15,8 @@ from tqdm.contrib.concurrent import process_map
 from DIRAC.Core.Base import Script
 from DIRAC.Resources.Catalog.FileCatalog import FileCatalog
 
+from protopipe_grid_interface.utils import CachedFileCatalog
+
 Script.registerSwitch("", "input_list=", "File containing a list of LFNs (required)")
 Script.registerSwitch(
     "",
@@ -32,6 +34,12 @@ Script.registerSwitch("", "log_level=", "Logging level (default: INFO)")
 Script.registerSwitch(
     "", "chunk_size=", "Size of chunks sent to worker processes (default: 1)"
 )
+Script.registerSwitch(
+    "",
+    "cache_ttl=",
+    "Answer replica queries from the local cache if younger than this number"
+    " of seconds (default: no cache)",
+)
 
 Script.parseCommandLine()
 switches = dict(Script.getUnprocessedSwitches())
@@ -59,7 +67,10 @@ else:
 if "log_level" not in switches:
     switches["log_level"] = "INFO"
 
-fc = FileCatalog()
+if "cache_ttl" not in switches:
+    fc = FileCatalog()
+else:
+    fc = CachedFileCatalog(FileCatalog(), ttl=float(switches["cache_ttl"]))
 
 
 def get_replicas(lfn, disk, logger=None):
@@ -1,7 +1,15 @@
 import argparse
+import ast
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import glob
+import json
 import logging
+import os
 from pathlib import Path
+import shutil
+import tempfile
+import time
 
 try:
     import tables as tb
@@ -9,8 +17,15 @@ except ImportError:
     logging.critical(
         "Pytables is not installed in this environment (pip install tables)."
     )
+import numpy as np
 from tqdm import tqdm
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None  # only needed for Parquet output
+
 try:
     from protopipe_grid_interface.utils import initialize_logger
 
@@ -18,8 +33,35 @@ try:
 except ImportError:
     initialize_default_logger = True
 
+# Memory used to coalesce rows of the input tables before writing them
+DEFAULT_BUFFER_MB = 64
+# Rows per row group of Parquet output
+DEFAULT_ROW_GROUP_SIZE = 2**20
 
-def merge_call(template_file_name, indir, outfile, logger=None):
+
+def merge_call(
+    template_file_name,
+    indir,
+    outfile,
+    logger=None,
+    n_workers=1,
+    buffer_mb=DEFAULT_BUFFER_MB,
+    virtual=False,
+    incremental=False,
+    filters=None,
+    chunkshape=None,
+    report=False,
+    validation_report=None,
+    validate_only=False,
+    output_format="hdf5",
+    row_group_size=DEFAULT_ROW_GROUP_SIZE,
+    columns=None,
+    where=None,
+    index_columns=None,
+    sort_by=None,
+    max_shard_gb=None,
+    max_shard_rows=None,
+):
 
     logger.debug("template_file_name = %s", template_file_name)
     logger.debug("indir = %s", indir)
@@ -31,7 +73,84 @@ def merge_call(template_file_name, indir, outfile, logger=None):
     filename_list = glob.glob(input_template)
     logger.debug(f"filename_list (truncated to 10 files): {filename_list[0:10]}")
 
-    _, empty_files = merge_list_of_pytables(filename_list, outfile, logger=logger)
+    if validate_only:
+        scans = scan_files(sorted(filename_list), logger, n_workers=n_workers)
+        if validation_report is not None:
+            write_validation_report(scans, validation_report)
+        statuses = Counter(scan["status"] for scan in scans)
+        logger.info("Validation of %d files: %s", len(scans), dict(statuses))
+        return
+
+    if virtual and (columns is not None or where is not None):
+        raise ValueError("Columns and row selections need a copy of the rows")
+    if (index_columns or sort_by) and (virtual or output_format != "hdf5"):
+        raise ValueError("Indexes and sorting need a merged HDF5 file")
+    sharded = bool(max_shard_gb or max_shard_rows)
+    if sharded and (virtual or output_format != "hdf5"):
+        raise ValueError("Shards are only written by merges into HDF5 files")
+
+    start = time.perf_counter()
+    if output_format == "parquet":
+        if virtual or incremental:
+            raise ValueError("Parquet output supports neither virtual nor incremental")
+        _, empty_files = write_parquet_dataset(
+            filename_list,
+            outfile,
+            logger=logger,
+            n_workers=n_workers,
+            row_group_size=row_group_size,
+            columns=columns,
+            where=where,
+            buffer_mb=buffer_mb,
+        )
+    elif virtual:
+        _, empty_files = write_virtual_index(
+            filename_list, outfile, logger=logger, n_workers=n_workers
+        )
+    else:
+        _, empty_files = merge_list_of_pytables(
+            filename_list,
+            outfile,
+            logger=logger,
+            n_workers=n_workers,
+            buffer_mb=buffer_mb,
+            incremental=incremental,
+            filters=filters,
+            chunkshape=chunkshape,
+            validation_report=validation_report,
+            columns=columns,
+            where=where,
+            max_shard_gb=max_shard_gb,
+            max_shard_rows=max_shard_rows,
+        )
+    elapsed = time.perf_counter() - start
+    logger.info("Merging took %.1f s", elapsed)
+
+    if sharded:
+        directory = Path(outfile).parent
+        outfiles = [
+            directory / shard["filename"]
+            for shard in read_shard_manifest(outfile)["shards"]
+        ]
+    else:
+        outfiles = [outfile]
+
+    # shards are sorted and indexed independently
+    if index_columns or sort_by:
+        for filename in outfiles:
+            index_tables(
+                filename,
+                logger,
+                index_columns=index_columns,
+                sort_by=sort_by,
+                buffer_mb=buffer_mb,
+            )
+
+    if report and not virtual and output_format == "hdf5":
+        for filename in outfiles:
+            log_compression_report(
+                filename, logger, merge_time=None if sharded else elapsed
+            )
 
     if empty_files > 0:
         ratio = round(float(empty_files) / float(len(filename_list)), 2) * 100
@@ -40,72 +159,1792 @@ def merge_call(template_file_name, indir, outfile, logger=None):
         )
 
 
-def merge_list_of_pytables(filename_list, destination, logger=None):
-    merged_tables = {}
-    outfile = tb.open_file(destination, mode="w")
-    all_previous_files_were_empty = True
-    empty_files = 0
+def merge_list_of_pytables(
+    filename_list,
+    destination,
+    logger=None,
+    n_workers=1,
+    buffer_mb=DEFAULT_BUFFER_MB,
+    incremental=False,
+    filters=None,
+    chunkshape=None,
+    validation_report=None,
+    columns=None,
+    where=None,
+    max_shard_gb=None,
+    max_shard_rows=None,
+):
+    """Merge a list of HDF5 files containing the same tables.
 
-    for idx, filename in enumerate(tqdm(sorted(filename_list))):
+    All input files are validated first (see `scan_files`): corrupt and
+    empty files, as well as files whose schema differs from the one of most
+    files, are skipped.
 
-        logger.debug("File # %d of %d", idx + 1, len(filename_list))
-        logger.debug("Filename %s", filename)
+    Parameters
+    ----------
+    filename_list: list
+        Paths of the input files (they are merged in sorted order)
+    destination: str or pathlib.Path
+        Path of the merged output file
+    logger: logging.Logger
+        Logger to use
+    n_workers: int
+        Number of processes to use (default: 1, serial merge).
+        With more than one process, contiguous groups of the sorted input files
+        are merged in parallel into intermediate files, which are then combined
+        pairwise in a reduction tree.
+        Since groups are contiguous and combined in order, the output is
+        row-for-row identical to the serial merge, including the row order.
+    buffer_mb: float
+        Memory (in MB) shared by the output tables to coalesce the rows of
+        the input tables, so that each buffer is written with a single append
+        (per process when n_workers > 1).
+    incremental: bool
+        If True, keep a manifest of the merged inputs next to the output
+        file (see `manifest_filename`) and on later calls only append the
+        rows of new files, or of changed files which did not contribute
+        any row before.
+        The output is rebuilt from scratch if an input was removed or if
+        an input which contributed rows has changed.
+        Appended rows follow the rows already merged, so the row order can
+        differ from the one of a merge from scratch.
+        Appends are serial, n_workers is used only for rebuilds.
+    filters: tables.Filters
+        Compression filters of the output tables (see `make_filters`).
+        Default is None, using those of the input tables.
+    chunkshape: int
+        Chunk size of the output tables in number of rows.
+        Default is None, letting PyTables compute it from the number of rows.
+    validation_report: str or pathlib.Path
+        If set, path of a JSON file where to write the result of the
+        validation of the input files (see `write_validation_report`).
+    columns: list
+        Names of the columns to keep (default: all).
+        Tables keep their column order, whatever the order of this list.
+    where: str
+        Condition on the columns of the input tables selecting the rows to
+        keep (e.g. "hillas_intensity > 50"), evaluated by PyTables with
+        numexpr (see tables.Table.read_where).
+        Every table must have the columns used in the condition.
+    max_shard_gb: float
+        If set, roll over to a new output file (shard) once the input files
+        merged into the current one reach this size, in GB.
+        Shards are named after destination, e.g. merged_0000.h5, and listed
+        with the row ranges of each table in a manifest next to them (see
+        `read_shard_manifest`), so that they can be read in parallel.
+        A merge which failed restarts after the last complete shard.
+        Input files are never split across shards.
+    max_shard_rows: int
+        If set, roll over to a new shard before any table of the current one
+        exceeds this number of rows (can be combined with max_shard_gb).
+
+    Returns
+    -------
+    merged_tables: dict
+        Output table nodes by name (with shards, lists of nodes, one per shard)
+    empty_files: int
+        Number of empty input files
+
+    """
+    table_options = {
+        "filters": filters,
+        "chunkshape": chunkshape,
+        "columns": columns,
+        "where": where,
+    }
+    if max_shard_gb or max_shard_rows:
+        if incremental:
+            raise ValueError("Sharded merges cannot be incremental")
+        merged_tables, scans = _merge_sharded(
+            filename_list,
+            destination,
+            logger,
+            n_workers,
+            buffer_mb,
+            table_options,
+            max_shard_gb=max_shard_gb,
+            max_shard_rows=max_shard_rows,
+            validation_report=validation_report,
+        )
+        empty_files = sum(1 for scan in scans if scan["status"] == "empty")
+        return merged_tables, empty_files
+
+    if incremental:
+        return _merge_incremental(
+            filename_list,
+            destination,
+            logger,
+            n_workers,
+            buffer_mb,
+            table_options,
+            validation_report,
+        )
+
+    merged_tables, scans = _merge(
+        filename_list,
+        destination,
+        logger,
+        n_workers,
+        buffer_mb,
+        table_options,
+        validation_report,
+    )
+    # a manifest left by a previous incremental merge is no longer valid
+    if manifest_filename(destination).exists():
+        os.remove(manifest_filename(destination))
+
+    empty_files = sum(1 for scan in scans if scan["status"] == "empty")
+    return merged_tables, empty_files
+
+
+def _merge(
+    filename_list,
+    destination,
+    logger,
+    n_workers,
+    buffer_mb,
+    table_options,
+    validation_report=None,
+):
+    """Merge files from scratch, returning the output tables and the file scans.
+
+    The input files are validated first (in parallel if n_workers > 1)
+    and only the valid ones are merged.
+    """
+    scans = scan_files(sorted(filename_list), logger, n_workers=n_workers)
+    if validation_report is not None:
+        write_validation_report(scans, validation_report)
+        logger.info("Validation report written to %s", validation_report)
+
+    valid_scans = [scan for scan in scans if scan["status"] == "ok"]
+    merged_tables = _write_scans(
+        valid_scans, destination, logger, n_workers, buffer_mb, table_options
+    )
+    return merged_tables, scans
+
+
+def _write_scans(scans, destination, logger, n_workers, buffer_mb, table_options):
+    """Write valid scanned files to a new output file, returning its tables."""
+    if (n_workers > 1) and (len(scans) > 1):
+        return _merge_parallel(
+            scans, destination, logger, n_workers, buffer_mb, table_options
+        )
+    with tb.open_file(destination, mode="w") as outfile:
+        return _append_files(outfile, scans, logger, buffer_mb, table_options)
+
+
+def _merge_group(scans, destination, logger, buffer_mb, table_options):
+    """Merge a group of scanned files in a worker process.
+
+    Returns the number of tables written.
+    """
+    with tb.open_file(destination, mode="w") as outfile:
+        merged_tables = _append_files(
+            outfile, scans, logger, buffer_mb, table_options, progress=False
+        )
+    return len(merged_tables)
+
+
+def _merge_pair(filename_list, destination, logger, buffer_mb, table_options):
+    """Merge two intermediate files in a worker process."""
+    scans = [scan_file(filename) for filename in filename_list]
+    return _merge_group(scans, destination, logger, buffer_mb, table_options)
 
-        try:
-            infile = tb.open_file(filename, mode="r")
-        except tb.exceptions.HDF5ExtError:
-            logger.warning("File %s appears to be corrupt", filename)
-            continue
 
-        table_name_list = [table.name for table in infile.root]  # Name of tables
+def _merge_parallel(scans, destination, logger, n_workers, buffer_mb, table_options):
+    """Merge scanned files with a process pool and a pairwise reduction tree.
 
-        if len(table_name_list) == 0:
-            logger.warning("file %s appears to be empty", filename)
-            empty_file = True
-            empty_files += 1
+    Returns the output table nodes by name.
+    """
+    n_groups = min(n_workers, len(scans))
+    group_size = -(-len(scans) // n_groups)  # ceiling division
+    groups = [scans[i : i + group_size] for i in range(0, len(scans), group_size)]
+    logger.debug(
+        "Merging %d files in %d groups with %d processes",
+        len(scans),
+        len(groups),
+        n_workers,
+    )
+
+    # intermediate files already contain only the selected columns and rows
+    reduce_options = dict(table_options, columns=None, where=None)
+
+    # intermediate files live next to the destination so the final rename is cheap
+    tmp_dir = tempfile.mkdtemp(prefix=".merge_", dir=Path(destination).resolve().parent)
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            # zero-padded names keep the sorted order equal to the input order
+            level = [
+                os.path.join(tmp_dir, f"level00_{i:05d}.h5") for i in range(len(groups))
+            ]
+            futures = [
+                pool.submit(_merge_group, group, path, logger, buffer_mb, table_options)
+                for group, path in zip(groups, level)
+            ]
+            n_tables = [future.result() for future in tqdm(futures, desc="groups")]
+            # groups whose files were all skipped do not take part
+            level = [path for path, n in zip(level, n_tables) if n > 0]
+
+            depth = 0
+            while len(level) > 1:
+                depth += 1
+                logger.debug("Reduction level %d: %d files", depth, len(level))
+                pairs = [level[i : i + 2] for i in range(0, len(level), 2)]
+                next_level = [
+                    os.path.join(tmp_dir, f"level{depth:02d}_{i:05d}.h5")
+                    for i in range(len(pairs))
+                ]
+                futures = [
+                    (
+                        pool.submit(
+                            _merge_pair, pair, path, logger, buffer_mb, reduce_options
+                        )
+                        if len(pair) > 1
+                        else None
+                    )
+                    for pair, path in zip(pairs, next_level)
+                ]
+                for pair, path, future in zip(pairs, next_level, futures):
+                    if future is None:
+                        os.replace(pair[0], path)
+                    else:
+                        future.result()
+                        for filename in pair:
+                            os.remove(filename)
+                level = next_level
+
+        if level:
+            os.replace(level[0], destination)
         else:
-            empty_file = False
-
-        # Initialise output file
-        if (idx == 0) and not empty_file:
-            logger.debug("First file is not empty")
-            for name in table_name_list:
-                merged_tables[name] = infile.copy_node(
-                    where="/", name=name, newparent=outfile.root
+            logger.warning("No file with data...")
+            tb.open_file(destination, mode="w").close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with tb.open_file(destination, mode="r") as outfile:
+        merged_tables = {table.name: table for table in outfile.root}
+
+    return merged_tables
+
+
+def scan_file(filename):
+    """Read the metadata of the tables stored in an HDF5 file.
+
+    Parameters
+    ----------
+    filename: str
+        Path of the file
+
+    Returns
+    -------
+    scan: dict
+        Path of the file ("filename"), its status ("ok", "corrupt" or "empty")
+        and, by table name, the number of rows and the schema of each table
+        ("tables").
+
+    """
+    scan = {"filename": filename, "status": "ok", "tables": {}}
+    try:
+        infile = tb.open_file(filename, mode="r")
+    except tb.exceptions.HDF5ExtError:
+        scan["status"] = "corrupt"
+        return scan
+
+    with infile:
+        for table in infile.iter_nodes("/", classname="Table"):
+            scan["tables"][table.name] = {
+                "nrows": int(table.nrows),
+                "dtype": str(table.dtype),
+            }
+    if not scan["tables"]:
+        scan["status"] = "empty"
+
+    return scan
+
+
+def scan_files(filename_list, logger, n_workers=1):
+    """Validate a list of files before merging them.
+
+    Each file is opened and its tables are listed with their number of rows
+    and schema, using a pool of processes if n_workers > 1.
+    For each table, the schema found in most files is taken as reference:
+    files with a different one are flagged as "mismatch" (the names of the
+    offending tables are listed under "mismatch") and will not be merged.
+
+    Parameters
+    ----------
+    filename_list: list
+        Paths of the input files
+    logger: logging.Logger
+        Logger to use
+    n_workers: int
+        Number of processes to use (default: 1)
+
+    Returns
+    -------
+    scans: list
+        Output of `scan_file` for each input file, in the same order
+
+    """
+    if (n_workers > 1) and (len(filename_list) > 1):
+        chunksize = max(1, len(filename_list) // (4 * n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            scans = list(pool.map(scan_file, filename_list, chunksize=chunksize))
+    else:
+        scans = [scan_file(filename) for filename in filename_list]
+
+    schemas = {}
+    for scan in scans:
+        if scan["status"] == "corrupt":
+            logger.warning("File %s appears to be corrupt", scan["filename"])
+        elif scan["status"] == "empty":
+            logger.warning("file %s appears to be empty", scan["filename"])
+        for name, table in scan["tables"].items():
+            schemas.setdefault(name, Counter())[table["dtype"]] += 1
+    schemas = {name: counts.most_common(1)[0][0] for name, counts in schemas.items()}
+
+    for scan in scans:
+        mismatch = [
+            name
+            for name, table in scan["tables"].items()
+            if table["dtype"] != schemas[name]
+        ]
+        if mismatch:
+            logger.warning(
+                "File %s has a schema different from most files for table(s) %s:"
+                " skipping the file",
+                scan["filename"],
+                mismatch,
+            )
+            scan["status"] = "mismatch"
+            scan["mismatch"] = mismatch
+    return scans
+
+
+def write_validation_report(scans, filename):
+    """Write the result of `scan_files` to a JSON file.
+
+    The report contains the number of files by status, the reference schema,
+    number of files and total number of rows of each table (valid files only),
+    and the status and number of rows per table of each file.
+    """
+    tables = {}
+    for scan in scans:
+        if scan["status"] != "ok":
+            continue
+        for name, table in scan["tables"].items():
+            info = tables.setdefault(
+                name, {"dtype": table["dtype"], "n_files": 0, "nrows": 0}
+            )
+            info["n_files"] += 1
+            info["nrows"] += table["nrows"]
+
+    report = {
+        "n_files": len(scans),
+        "status": dict(Counter(scan["status"] for scan in scans)),
+        "tables": tables,
+        "files": [
+            {
+                "filename": scan["filename"],
+                "status": scan["status"],
+                "tables": {
+                    name: table["nrows"] for name, table in scan["tables"].items()
+                },
+                **(
+                    {
+                        "mismatch": {
+                            name: scan["tables"][name]["dtype"]
+                            for name in scan["mismatch"]
+                        }
+                    }
+                    if "mismatch" in scan
+                    else {}
+                ),
+            }
+            for scan in scans
+        ],
+    }
+    with open(filename, mode="w", encoding="utf8") as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+def make_filters(complib=None, complevel=None, shuffle=None):
+    """Build the compression filters of the merged tables.
+
+    Parameters
+    ----------
+    complib: str
+        Compression library (any of tables.filters.all_complibs,
+        e.g. "blosc2:zstd", "blosc2:lz4" or "zlib")
+    complevel: int
+        Compression level from 0 (no compression) to 9 (default: 5)
+    shuffle: str
+        "byte", "bit" or "none" (default: "byte")
+
+    Returns
+    -------
+    filters: tables.Filters or None
+        None if no option has been set, meaning that the filters of the
+        input tables are kept.
+
+    Raises
+    ------
+    ValueError
+        If complevel or shuffle is set without complib, since the other
+        filters of the input tables would otherwise be silently replaced
+
+    """
+    if complib is None:
+        if complevel is not None or shuffle is not None:
+            raise ValueError("The compression level and shuffle require a complib")
+        return None
+    if complevel is None:
+        complevel = 5
+    if shuffle is None:
+        shuffle = "byte"
+    return tb.Filters(
+        complevel=complevel,
+        complib=complib,
+        shuffle=shuffle == "byte",
+        bitshuffle=shuffle == "bit",
+    )
+
+
+def _selected_columns(names, columns=None):
+    """Names of the selected columns, in the order of the table."""
+    if columns is None:
+        return list(names)
+    return [name for name in names if name in columns]
+
+
+def _project_dtype(dtype, columns=None):
+    """Data type of the rows of a table restricted to the selected columns."""
+    return np.dtype(
+        [(name, dtype[name]) for name in _selected_columns(dtype.names, columns)]
+    )
+
+
+def _check_selection(table, columns=None, where=None):
+    """Check that the column and row selections apply to an input table."""
+    if not _selected_columns(table.dtype.names, columns):
+        raise ValueError(f"None of the columns {columns} is in table {table.name}")
+    if where is not None:
+        try:
+            table.will_query_use_indexing(where)
+        except (NameError, SyntaxError) as error:
+            raise ValueError(
+                f"Invalid condition '{where}' for table {table.name}: {error}"
+            ) from None
+
+
+def _create_output_table(outfile, table, expectedrows, table_options=None):
+    """Create an empty copy of an input table sized for the merged output.
+
+    PyTables derives the chunkshape from the expected number of rows,
+    so this is the total number of rows of the table over all input files
+    (an upper limit if rows are selected).
+    Filters and chunkshape can be overridden through table_options,
+    which also hold the column and row selections.
+    """
+    table_options = table_options or {}
+    _check_selection(table, table_options.get("columns"), table_options.get("where"))
+    if table_options.get("columns") is None:
+        description = table.description
+    else:
+        # copies of the columns, whose offsets are computed for the new rows
+        description = {
+            name: table.description._v_colobjects[name].copy()
+            for name in _selected_columns(
+                table.description._v_names, table_options["columns"]
+            )
+        }
+    output_table = outfile.create_table(
+        outfile.root,
+        table.name,
+        description=description,
+        title=table.title,
+        filters=table_options.get("filters") or table.filters,
+        expectedrows=max(expectedrows, 1),
+        chunkshape=table_options.get("chunkshape"),
+    )
+    table.attrs._f_copy(output_table)
+    return output_table
+
+
+def write_virtual_index(filename_list, destination, logger=None, n_workers=1):
+    """Write an index file exposing the tables of many files without copying them.
+
+    For each table name the index file contains a group with the same name,
+    holding one external link per input file (``file00000``, ``file00001``, ...)
+    in sorted order.
+    Links are relative to the directory of the index file, so the index
+    can be moved together with the input files.
+    Corrupt, empty and mismatching files are left out, as in a normal merge.
+
+    The attributes of each group store the linked file names (``filenames``),
+    the number of rows per link (``nrows``) and their total (``total_nrows``).
+    Use `read_virtual_table` to read a table as a single array.
+
+    Parameters
+    ----------
+    filename_list: list
+        Paths of the input files
+    destination: str or pathlib.Path
+        Path of the index file
+    logger: logging.Logger
+        Logger to use
+    n_workers: int
+        Number of processes used to validate the input files (default: 1)
+
+    Returns
+    -------
+    groups: dict
+        Index groups by table name
+    empty_files: int
+        Number of empty input files
+
+    """
+    scans = scan_files(sorted(filename_list), logger, n_workers=n_workers)
+    empty_files = sum(1 for scan in scans if scan["status"] == "empty")
+    scans = [scan for scan in scans if scan["status"] == "ok"]
+    if not scans:
+        logger.warning("No file with data...")
+
+    index_directory = Path(destination).resolve().parent
+    groups = {}
+    with tb.open_file(destination, mode="w", title="Virtual merge") as outfile:
+        links = {}
+        for scan in scans:
+            target = os.path.relpath(Path(scan["filename"]).resolve(), index_directory)
+            for name, table in scan["tables"].items():
+                links.setdefault(name, []).append((target, table["nrows"]))
+
+        for name, targets in links.items():
+            groups[name] = outfile.create_group(outfile.root, name)
+            for idx, (target, _) in enumerate(targets):
+                outfile.create_external_link(
+                    groups[name], f"file{idx:05d}", f"{target}:/{name}"
                 )
-            all_previous_files_were_empty = False
-        elif all_previous_files_were_empty and (idx != 0) and not empty_file:
-            logger.debug("This is not the first file but is the first non-empty")
-            for name in table_name_list:
-                merged_tables[name] = infile.copy_node(
-                    where="/", name=name, newparent=outfile.root
+            groups[name]._v_attrs.filenames = [target for target, _ in targets]
+            groups[name]._v_attrs.nrows = [nrows for _, nrows in targets]
+            groups[name]._v_attrs.total_nrows = sum(nrows for _, nrows in targets)
+            logger.debug(
+                "Table %s: %d files, %d rows",
+                name,
+                len(targets),
+                groups[name]._v_attrs.total_nrows,
+            )
+
+    return groups, empty_files
+
+
+def read_virtual_table(filename, name):
+    """Read a table from an index file written by `write_virtual_index`.
+
+    Parameters
+    ----------
+    filename: str or pathlib.Path
+        Path of the index file
+    name: str
+        Name of the table
+
+    Returns
+    -------
+    data: numpy.ndarray
+        Rows of the table from all the linked files, in order
+
+    """
+    with tb.open_file(filename, mode="r") as index:
+        group = index.get_node("/", name)
+        arrays = []
+        for idx in range(len(group._v_attrs.nrows)):
+            table = group._f_get_child(f"file{idx:05d}")()
+            try:
+                arrays.append(table.read())
+            finally:
+                table._v_file.close()
+    if not arrays:
+        return np.empty(0)
+    return np.concatenate(arrays)
+
+
+class TableBuffer:
+    """Coalesce the rows of many input tables into bulk appends to one table.
+
+    Rows are read as NumPy structured arrays directly into a preallocated
+    buffer, which is appended to the output table with a single call
+    every time it gets full.
+    If the output table has only a subset of the input columns, or if a
+    condition is given, input rows are read in blocks of the buffer size,
+    selected, and then copied column by column into the buffer.
+
+    Parameters
+    ----------
+    output_table: tables.Table
+        Table where the rows are written
+    n_rows: int
+        Size of the buffer in number of rows
+    where: str
+        Condition selecting the rows to copy (default: all rows)
+
+    """
+
+    def __init__(self, output_table, n_rows, where=None):
+        self.output_table = output_table
+        self.buffer = np.empty(max(int(n_rows), 1), dtype=output_table.dtype)
+        self.where = where
+        self.n_filled = 0
+        self.n_rows = 0
+        self.elapsed = 0.0
+
+    def copy(self, table):
+        """Copy the (selected) rows of an input table."""
+        start_time = time.perf_counter()
+        if (self.where is None) and (table.dtype == self.buffer.dtype):
+            start = 0
+            while start < table.nrows:
+                n = min(table.nrows - start, len(self.buffer) - self.n_filled)
+                table.read(
+                    start, start + n, out=self.buffer[self.n_filled : self.n_filled + n]
                 )
-            all_previous_files_were_empty = False
-        elif all_previous_files_were_empty:
-            logger.warning("Still no file with data...")
-            infile.close()
+                self.n_filled += n
+                start += n
+                if self.n_filled == len(self.buffer):
+                    self._write()
+        else:
+            block = len(self.buffer)
+            for start in range(0, table.nrows, block):
+                stop = min(start + block, table.nrows)
+                if self.where is None:
+                    rows = table.read(start, stop)
+                else:
+                    rows = table.read_where(self.where, start=start, stop=stop)
+                self.add(rows)
+        self.elapsed += time.perf_counter() - start_time
+
+    def add(self, rows):
+        """Copy the output columns of an array of rows."""
+        start = 0
+        while start < len(rows):
+            n = min(len(rows) - start, len(self.buffer) - self.n_filled)
+            destination = self.buffer[self.n_filled : self.n_filled + n]
+            for name in self.buffer.dtype.names:
+                destination[name] = rows[name][start : start + n]
+            self.n_filled += n
+            start += n
+            if self.n_filled == len(self.buffer):
+                self._write()
+
+    def flush(self):
+        """Write the rows left in the buffer."""
+        start_time = time.perf_counter()
+        self._write()
+        self.output_table.flush()
+        self.elapsed += time.perf_counter() - start_time
+
+    def _write(self):
+        if self.n_filled > 0:
+            self.output_table.append(self.buffer[: self.n_filled])
+            self.n_rows += self.n_filled
+            self.n_filled = 0
+
+
+def _buffer_rows(output_tables, buffer_mb):
+    """Split the buffer memory evenly among tables, in number of rows."""
+    if not output_tables:
+        return {}
+    table_bytes = buffer_mb * 2**20 / len(output_tables)
+    return {
+        name: table_bytes // table.dtype.itemsize
+        for name, table in output_tables.items()
+    }
+
+
+def _append_files(
+    outfile,
+    scans,
+    logger,
+    buffer_mb=DEFAULT_BUFFER_MB,
+    table_options=None,
+    progress=True,
+    expected_rows=None,
+):
+    """Append the rows of scanned files to the tables of an open output file.
+
+    Missing output tables are created with the total number of rows
+    to be copied as expected size, unless it is given by name in
+    expected_rows.
+    Files with a schema different from an existing output table, or from
+    the first file planned to create it, are flagged as "mismatch" and
+    skipped.
+
+    Returns the output table nodes by name.
+    """
+    table_options = table_options or {}
+    merged_tables = {
+        table.name: table for table in outfile.iter_nodes("/", classname="Table")
+    }
+    # reference schema of each table: that of the existing output table,
+    # or else that of the first file which will create it
+    schemas = {name: table.dtype for name, table in merged_tables.items()}
+    for scan in scans:
+        if scan["status"] != "ok":
             continue
-        elif empty_file:
-            logger.warning("Empty file! Closing and going to the next one...")
-            infile.close()
+        dtypes = {
+            name: _project_dtype(
+                np.dtype(ast.literal_eval(table["dtype"])),
+                table_options.get("columns"),
+            )
+            for name, table in scan["tables"].items()
+        }
+        mismatch = [
+            name for name, dtype in dtypes.items() if dtype != schemas.get(name, dtype)
+        ]
+        if mismatch:
+            logger.warning(
+                "File %s has a schema different from the merged one for table(s) %s:"
+                " skipping the file",
+                scan["filename"],
+                mismatch,
+            )
+            scan["status"] = "mismatch"
+            scan["mismatch"] = mismatch
             continue
+        for name, dtype in dtypes.items():
+            schemas.setdefault(name, dtype)
+    scans = [scan for scan in scans if scan["status"] == "ok"]
+
+    total_rows = {}
+    templates = {}
+    for scan in scans:
+        for name, table in scan["tables"].items():
+            total_rows[name] = total_rows.get(name, 0) + table["nrows"]
+            templates.setdefault(name, scan["filename"])
+    if not scans:
+        logger.warning("No file with data...")
+
+    # Create the missing output tables with their final size
+    for name, filename in templates.items():
+        if name in merged_tables:
+            continue
+        with tb.open_file(filename, mode="r") as infile:
+            merged_tables[name] = _create_output_table(
+                outfile,
+                infile.get_node("/", name),
+                (expected_rows or {}).get(name, total_rows[name]),
+                table_options,
+            )
+        logger.debug(
+            "Table %s: %d expected rows, chunkshape %s, %s",
+            name,
+            (expected_rows or {}).get(name, total_rows[name]),
+            merged_tables[name].chunkshape,
+            merged_tables[name].filters,
+        )
+
+    buffers = {
+        name: TableBuffer(merged_tables[name], n_rows, where=table_options.get("where"))
+        for name, n_rows in _buffer_rows(
+            {name: merged_tables[name] for name in total_rows}, buffer_mb
+        ).items()
+    }
+
+    for idx, scan in enumerate(tqdm(scans, disable=not progress)):
+
+        logger.debug("File # %d of %d", idx + 1, len(scans))
+        logger.debug("Filename %s", scan["filename"])
+
+        with tb.open_file(scan["filename"], mode="r") as infile:
+            for name in scan["tables"]:
+                buffers[name].copy(infile.get_node("/", name))
+
+    for buffer in buffers.values():
+        buffer.flush()
+
+    for name, buffer in buffers.items():
+        logger.debug(
+            "Table %s: %d of %d rows in %.2f s (%.0f rows/s, %.1f MB/s)",
+            name,
+            buffer.n_rows,
+            total_rows[name],
+            buffer.elapsed,
+            buffer.n_rows / buffer.elapsed if buffer.elapsed > 0 else float("nan"),
+            (
+                buffer.n_rows * buffer.buffer.dtype.itemsize / 2**20 / buffer.elapsed
+                if buffer.elapsed > 0
+                else float("nan")
+            ),
+        )
+
+    return merged_tables
+
+
+class StreamingMerger:
+    """Merge files into an HDF5 file batch by batch, as they become available.
+
+    This allows to merge files while the next ones are still being
+    downloaded. Each file is validated (see `scan_file`) before its rows
+    are appended; corrupt or empty files, and files whose schema differs
+    from the tables merged so far, are skipped.
+    The output tables are created from the first valid batch, with an
+    expected size extrapolated to n_files files, since the chunkshape
+    cannot change afterwards.
+
+    Parameters
+    ----------
+    destination: str or pathlib.Path
+        Merged file, overwritten if it exists
+    logger: logging.Logger
+        Logger
+    n_files: int
+        Expected number of input files (default: size the tables for the
+        first batch only)
+    buffer_mb: int
+        Memory used to coalesce the rows of each batch
+    filters: tables.Filters
+        Compression of the output tables (default: that of the inputs)
+    chunkshape: tuple
+        Chunkshape of the output tables (default: set by PyTables from
+        the expected number of rows)
+
+    """
+
+    def __init__(
+        self,
+        destination,
+        logger,
+        n_files=None,
+        buffer_mb=DEFAULT_BUFFER_MB,
+        filters=None,
+        chunkshape=None,
+    ):
+        self.destination = Path(destination)
+        self.logger = logger
+        self.n_files = n_files
+        self.buffer_mb = buffer_mb
+        self.table_options = {"filters": filters, "chunkshape": chunkshape}
+        self.scans = []
+        # a manifest left by a previous incremental merge is no longer valid
+        if manifest_filename(self.destination).exists():
+            os.remove(manifest_filename(self.destination))
+        self.outfile = tb.open_file(self.destination, mode="w")
+
+    def append(self, filename_list):
+        """Validate files and append the rows of the valid ones.
+
+        Returns the list of files which have been merged.
+        """
+        scans = [scan_file(filename) for filename in filename_list]
+        for scan in scans:
+            if scan["status"] != "ok":
+                self.logger.warning(
+                    "Skipping %s file %s", scan["status"], scan["filename"]
+                )
+
+        expected_rows = None
+        valid_scans = [scan for scan in scans if scan["status"] == "ok"]
+        if self.n_files and valid_scans:
+            rows = Counter()
+            for scan in valid_scans:
+                for name, table in scan["tables"].items():
+                    rows[name] += table["nrows"]
+            expected_rows = {
+                name: n_rows * max(self.n_files, len(valid_scans)) // len(valid_scans)
+                for name, n_rows in rows.items()
+            }
+
+        _append_files(
+            self.outfile,
+            scans,
+            self.logger,
+            self.buffer_mb,
+            self.table_options,
+            progress=False,
+            expected_rows=expected_rows,
+        )
+        self.scans.extend(scans)
+        return [scan["filename"] for scan in scans if scan["status"] == "ok"]
+
+    def close(self):
+        self.outfile.close()
+        statuses = Counter(scan["status"] for scan in self.scans)
+        self.logger.info(
+            "Merged %d of %d files into %s (%s)",
+            statuses["ok"],
+            len(self.scans),
+            self.destination,
+            dict(statuses),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def manifest_filename(destination):
+    """Path of the manifest stored next to a merged file."""
+    return Path(destination).with_suffix(".manifest.json")
+
+
+def _file_entry(filename):
+    """Size and modification time of a file, as stored in a manifest."""
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _manifest_options(table_options, **extra):
+    """Merge options stored in a manifest, as read back from JSON.
+
+    A previous merge can only be reused if it was done with the same
+    options, since they change the rows or the layout of the output.
+    """
+    options = dict(
+        extra,
+        columns=table_options.get("columns"),
+        where=table_options.get("where"),
+        filters=repr(table_options.get("filters")),
+        chunkshape=table_options.get("chunkshape"),
+    )
+    return json.loads(json.dumps(options))
+
+
+def _merge_incremental(
+    filename_list,
+    destination,
+    logger,
+    n_workers,
+    buffer_mb,
+    table_options,
+    validation_report=None,
+):
+    """Append only new or changed files to an existing merged file.
+
+    The manifest stores, by path relative to the merged file, the size,
+    modification time, status and row count per table of every input.
+    The merged file is rebuilt if there is no manifest, if it was merged
+    with other options (column or row selection, compression, chunkshape),
+    if an input was removed, or if an input which contributed rows has changed.
+    """
+    destination = Path(destination)
+    manifest_path = manifest_filename(destination)
+    directory = destination.resolve().parent
+    inputs = {
+        os.path.relpath(Path(filename).resolve(), directory): filename
+        for filename in sorted(filename_list)
+    }
+
+    manifest = None
+    if destination.exists() and manifest_path.exists():
+        with open(manifest_path, mode="r", encoding="utf8") as f:
+            manifest = json.load(f)
+
+    options = _manifest_options(table_options)
+    rebuild = manifest is None
+    new_files = []
+    if rebuild:
+        logger.info("No previous merge found for %s", destination)
+    elif manifest.get("options") != options:
+        logger.info("%s was merged with different options", destination)
+        rebuild = True
+    else:
+        removed = sorted(set(manifest["inputs"]) - set(inputs))
+        if removed:
+            logger.info(
+                "%d files were removed since the last merge (e.g. %s)",
+                len(removed),
+                removed[0],
+            )
+            rebuild = True
+        for key, filename in inputs.items():
+            entry = manifest["inputs"].get(key)
+            if entry is None:
+                new_files.append(filename)
+            elif _file_entry(filename) != {
+                "size": entry["size"],
+                "mtime": entry["mtime"],
+            }:
+                if any(entry["tables"].values()):
+                    logger.info("%s changed since the last merge", key)
+                    rebuild = True
+                else:
+                    # it did not contribute any row (e.g. it was corrupt)
+                    new_files.append(filename)
+
+    if rebuild:
+        logger.info("Merging all %d files into %s", len(inputs), destination)
+        entries = {}
+        merged_tables, scans = _merge(
+            list(inputs.values()),
+            destination,
+            logger,
+            n_workers,
+            buffer_mb,
+            table_options,
+            validation_report,
+        )
+    else:
+        entries = manifest["inputs"]
+        if new_files:
+            logger.info(
+                "Appending %d new or changed files to %s", len(new_files), destination
+            )
+            scans = scan_files(new_files, logger, n_workers=n_workers)
+            if validation_report is not None:
+                write_validation_report(scans, validation_report)
+            with tb.open_file(destination, mode="a") as outfile:
+                merged_tables = _append_files(
+                    outfile, scans, logger, buffer_mb, table_options
+                )
         else:
-            logger.debug("File with data. Merging with the previous non-empty one...")
-            for name in table_name_list:
-                table_tmp = infile.get_node("/" + name)
-                table_tmp.append_where(dstTable=merged_tables[name])
+            logger.info("%s is up to date", destination)
+            scans = []
+            with tb.open_file(destination, mode="r") as outfile:
+                merged_tables = {table.name: table for table in outfile.root}
 
-        infile.close()
-    outfile.close()
+    for scan in scans:
+        entry = _file_entry(scan["filename"])
+        entry["status"] = scan["status"]
+        entry["tables"] = (
+            {name: table["nrows"] for name, table in scan["tables"].items()}
+            if scan["status"] == "ok"
+            else {}
+        )
+        entries[os.path.relpath(Path(scan["filename"]).resolve(), directory)] = entry
+
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, mode="w", encoding="utf8") as f:
+        json.dump(
+            {"destination": destination.name, "options": options, "inputs": entries},
+            f,
+            indent=1,
+        )
+    os.replace(tmp_path, manifest_path)
 
+    empty_files = sum(1 for entry in entries.values() if entry["status"] == "empty")
     return merged_tables, empty_files
 
 
+def shard_manifest_filename(destination):
+    """Path of the manifest listing the shards of a sharded merge."""
+    return Path(destination).with_suffix(".shards.json")
+
+
+def shard_filename(destination, idx):
+    """Path of a shard of a sharded merge (e.g. merged_0003.h5)."""
+    destination = Path(destination)
+    return destination.with_name(f"{destination.stem}_{idx:04d}{destination.suffix}")
+
+
+def read_shard_manifest(destination):
+    """Read the manifest of a sharded merge.
+
+    Returns a dict whose "shards" entry lists, in order, the "filename" of
+    each shard (relative to the directory of destination), the input files
+    merged into it and, for each table, the range [start, stop) of the rows
+    of the whole merged table stored in the shard.
+    """
+    with open(shard_manifest_filename(destination), mode="r", encoding="utf8") as f:
+        return json.load(f)
+
+
+def _plan_shards(scans, max_shard_gb=None, max_shard_rows=None):
+    """Split scanned files, in order, into groups of at most a size or rows.
+
+    The size of a shard is estimated from the size of its input files.
+    Files are never split, so a file larger than a shard gets its own shard.
+    """
+    max_bytes = max_shard_gb * 2**30 if max_shard_gb else float("inf")
+    max_rows = max_shard_rows or float("inf")
+    shards = []
+    n_bytes, n_rows = 0, Counter()
+    for scan in scans:
+        file_bytes = os.path.getsize(scan["filename"])
+        file_rows = Counter(
+            {name: table["nrows"] for name, table in scan["tables"].items()}
+        )
+        if shards and (
+            n_bytes + file_bytes > max_bytes
+            or any(n_rows[name] + n > max_rows for name, n in file_rows.items())
+        ):
+            shards.append([])
+            n_bytes, n_rows = 0, Counter()
+        elif not shards:
+            shards.append([])
+        shards[-1].append(scan)
+        n_bytes += file_bytes
+        n_rows.update(file_rows)
+    return shards
+
+
+def _write_shard_manifest(manifest_path, options, entries):
+    """Atomically write the manifest of a sharded merge."""
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, mode="w", encoding="utf8") as f:
+        json.dump({"options": options, "shards": entries}, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def _merge_sharded(
+    filename_list,
+    destination,
+    logger,
+    n_workers,
+    buffer_mb,
+    table_options,
+    max_shard_gb=None,
+    max_shard_rows=None,
+    validation_report=None,
+):
+    """Merge files into a sequence of shards, written one after the other.
+
+    The manifest is updated after each shard, so that a merge which failed
+    restarts after the last shard written with the same inputs and options.
+    Returns lists of output table nodes by name (one per shard with the table)
+    and the file scans.
+    """
+    destination = Path(destination)
+    directory = destination.resolve().parent
+    manifest_path = shard_manifest_filename(destination)
+
+    scans = scan_files(sorted(filename_list), logger, n_workers=n_workers)
+    if validation_report is not None:
+        write_validation_report(scans, validation_report)
+        logger.info("Validation report written to %s", validation_report)
+    valid_scans = [scan for scan in scans if scan["status"] == "ok"]
+    shards = _plan_shards(valid_scans, max_shard_gb, max_shard_rows)
+
+    options = _manifest_options(
+        table_options, max_shard_gb=max_shard_gb, max_shard_rows=max_shard_rows
+    )
+    previous = []
+    if manifest_path.exists():
+        manifest = read_shard_manifest(destination)
+        if manifest.get("options") == options:
+            previous = manifest["shards"]
+
+    entries = []
+    merged_tables = {}
+    stops = Counter()
+    for idx, shard_scans in enumerate(shards):
+        path = shard_filename(destination, idx)
+        inputs = [
+            os.path.relpath(Path(scan["filename"]).resolve(), directory)
+            for scan in shard_scans
+        ]
+        if len(previous) > idx and previous[idx]["inputs"] == inputs and path.exists():
+            logger.info("Shard %s already merged", path)
+        else:
+            # the following shards need to be written again
+            previous = []
+            logger.info(
+                "Merging %d files into shard %d of %d: %s",
+                len(shard_scans),
+                idx + 1,
+                len(shards),
+                path,
+            )
+            _write_scans(shard_scans, path, logger, n_workers, buffer_mb, table_options)
+        with tb.open_file(path, mode="r") as outfile:
+            n_rows = {table.name: int(table.nrows) for table in outfile.root}
+            for table in outfile.root:
+                merged_tables.setdefault(table.name, []).append(table)
+
+        tables = {}
+        for name, n in n_rows.items():
+            tables[name] = [stops[name], stops[name] + n]
+            stops[name] += n
+        entries.append({"filename": path.name, "inputs": inputs, "tables": tables})
+        _write_shard_manifest(manifest_path, options, entries)
+
+    # written even without any shard, so that no stale manifest remains
+    _write_shard_manifest(manifest_path, options, entries)
+
+    # shards of a previous merge beyond the last one are no longer valid
+    idx = len(shards)
+    while shard_filename(destination, idx).exists():
+        os.remove(shard_filename(destination, idx))
+        idx += 1
+
+    logger.info("Merged %d files into %d shards", len(valid_scans), len(shards))
+    return merged_tables, scans
+
+
+def _create_csindex(column):
+    """Create a completely sorted index on a column, replacing any other index."""
+    if column.is_indexed and not column.index.is_csi:
+        column.remove_index()
+    if not column.is_indexed:
+        column.create_csindex()
+
+
+def _sort_table(table, keys, n_rows):
+    """Rewrite a table with its rows sorted by one or more columns.
+
+    Rows are read in blocks in the order of a completely sorted index on the
+    first key, then the rows sharing the same value of the first key are
+    sorted by the other keys, so that only one block (plus the rows of its
+    last value of the first key) is in memory at a time.
+
+    Returns the sorted table, which replaces the original one.
+    """
+    _create_csindex(table.cols._f_col(keys[0]))
+    name = table.name
+    sorted_table = table._v_file.create_table(
+        table._v_parent,
+        f"_sorted_{name}",
+        description=table.description,
+        title=table.title,
+        filters=table.filters,
+        expectedrows=max(table.nrows, 1),
+        chunkshape=table.chunkshape,
+    )
+    table.attrs._f_copy(sorted_table)
+
+    n_rows = max(int(n_rows), 1)
+    pending = table.read(0, 0)
+    for start in range(0, table.nrows, n_rows):
+        stop = min(start + n_rows, table.nrows)
+        rows = np.concatenate(
+            [pending, table.read_sorted(keys[0], start=start, stop=stop)]
+        )
+        if stop < table.nrows:
+            # rows with the last value of the first key may continue in the next block
+            n_sorted = np.searchsorted(rows[keys[0]], rows[keys[0]][-1], side="left")
+        else:
+            n_sorted = len(rows)
+        rows, pending = rows[:n_sorted], rows[n_sorted:]
+        if len(keys) > 1:
+            rows = rows[np.lexsort([rows[key] for key in reversed(keys)])]
+        sorted_table.append(rows)
+    sorted_table.flush()
+
+    table.remove()
+    sorted_table.rename(name)
+    return sorted_table
+
+
+def index_tables(
+    filename, logger, index_columns=None, sort_by=None, buffer_mb=DEFAULT_BUFFER_MB
+):
+    """Sort and index the tables of a merged file for fast lookups.
+
+    Completely sorted indexes (CSI) make queries such as
+    ``table.read_where("(obs_id == 1) & (event_id == 2)")`` or selections
+    of an energy range run in logarithmic time instead of scanning the table.
+    Sorting the rows as well (e.g. by obs_id and event_id) keeps the matching
+    rows contiguous on disk and allows to match the events of different
+    cameras by walking the tables in parallel.
+    The first column of sort_by is indexed as well.
+    Tables without some of the columns are left unsorted or unindexed
+    on those columns.
+
+    Parameters
+    ----------
+    filename: str
+        Merged HDF5 file, modified in place
+    logger: logging.Logger
+        Logger
+    index_columns: list
+        Columns on which to create a CSI
+    sort_by: list
+        Columns by which to sort the rows, primary key first
+    buffer_mb: float
+        Memory used to sort the rows, in MB
+
+    """
+    index_columns = list(index_columns or [])
+    sort_by = list(sort_by or [])
+    with tb.open_file(filename, mode="a") as outfile:
+        for table in list(outfile.walk_nodes("/", classname="Table")):
+            start = time.perf_counter()
+            missing = [
+                column
+                for column in dict.fromkeys(sort_by + index_columns)
+                if column not in table.colnames
+            ]
+            if missing:
+                logger.warning("Table %s has no columns %s", table.name, missing)
+            sorted_by = [] if any(key in missing for key in sort_by) else sort_by
+            if sorted_by:
+                table = _sort_table(
+                    table, sorted_by, buffer_mb * 2**20 // table.dtype.itemsize
+                )
+            # the primary key of sorted tables is always indexed
+            indexed = [
+                column
+                for column in dict.fromkeys(sorted_by[:1] + index_columns)
+                if column not in missing
+            ]
+            for column in indexed:
+                _create_csindex(table.cols._f_col(column))
+            logger.info(
+                "Table %s sorted by %s and indexed on %s in %.2f s",
+                table.name,
+                sorted_by,
+                indexed,
+                time.perf_counter() - start,
+            )
+
+
+class ParquetTableWriter:
+    """Write NumPy structured arrays to the part files of a Parquet dataset.
+
+    It has the subset of the tables.Table interface used by `TableBuffer`,
+    so that the same buffering is used for HDF5 and Parquet outputs.
+    Multidimensional columns are stored flattened as fixed-size lists.
+
+    Parameters
+    ----------
+    directory: pathlib.Path
+        Directory of the dataset
+    dtype: numpy.dtype
+        Data type of the rows
+    prefix: str
+        Prefix of the part files, which are numbered in the order they
+        are written
+    row_groups_per_file: int
+        Number of row groups after which a new part file is started
+
+    """
+
+    def __init__(self, directory, dtype, prefix="part", row_groups_per_file=64):
+        self.directory = Path(directory)
+        self.dtype = dtype
+        self.prefix = prefix
+        self.row_groups_per_file = row_groups_per_file
+        self.nrows = 0
+        self._writer = None
+        self._n_files = 0
+        self._n_row_groups = 0
+
+    def append(self, rows):
+        """Write the rows as one row group."""
+        columns = {}
+        for name in rows.dtype.names:
+            column = rows[name]
+            if not column.dtype.isnative:
+                column = column.astype(column.dtype.newbyteorder("="))
+            if column.ndim > 1:
+                values = pa.array(np.ascontiguousarray(column).reshape(-1))
+                size = int(np.prod(column.shape[1:]))
+                columns[name] = pa.FixedSizeListArray.from_arrays(values, size)
+            else:
+                columns[name] = pa.array(np.ascontiguousarray(column))
+        table = pa.table(columns)
+
+        if self._writer is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self.directory / f"{self.prefix}-{self._n_files:05d}.parquet"
+            self._writer = pq.ParquetWriter(path, table.schema)
+            self._n_files += 1
+        self._writer.write_table(table, row_group_size=len(rows))
+        self.nrows += len(rows)
+        self._n_row_groups += 1
+        if self._n_row_groups == self.row_groups_per_file:
+            self.close()
+
+    def flush(self):
+        """Nothing to do, row groups are written when appended."""
+
+    def close(self):
+        """Close the current part file."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._n_row_groups = 0
+
+
+def _write_parquet_group(
+    scans,
+    destination,
+    prefix,
+    row_group_size,
+    columns=None,
+    where=None,
+    buffer_mb=DEFAULT_BUFFER_MB,
+):
+    """Stream the tables of scanned files into Parquet datasets.
+
+    Returns the number of rows written per table.
+    """
+    templates = {}
+    for scan in scans:
+        for name in scan["tables"]:
+            templates.setdefault(name, scan["filename"])
+    writers = {}
+    for name, filename in templates.items():
+        with tb.open_file(filename, mode="r") as infile:
+            table = infile.get_node("/", name)
+            _check_selection(table, columns, where)
+            writers[name] = ParquetTableWriter(
+                Path(destination) / name,
+                _project_dtype(table.dtype, columns),
+                prefix=prefix,
+            )
+    # one buffer is one row group, smaller if the memory is not enough
+    buffers = {
+        name: TableBuffer(writers[name], min(row_group_size, n_rows), where=where)
+        for name, n_rows in _buffer_rows(writers, buffer_mb).items()
+    }
+
+    for scan in scans:
+        with tb.open_file(scan["filename"], mode="r") as infile:
+            for name in scan["tables"]:
+                buffers[name].copy(infile.get_node("/", name))
+    for name, buffer in buffers.items():
+        buffer.flush()
+        writers[name].close()
+    return {name: writer.nrows for name, writer in writers.items()}
+
+
+def write_parquet_dataset(
+    filename_list,
+    destination,
+    logger=None,
+    n_workers=1,
+    row_group_size=DEFAULT_ROW_GROUP_SIZE,
+    columns=None,
+    where=None,
+    buffer_mb=DEFAULT_BUFFER_MB,
+):
+    """Stream the tables of many HDF5 files into Parquet datasets.
+
+    Each table is written to its own dataset, a sub-directory of destination
+    with the table name, made of numbered part files.
+    Each part file contains up to 64 row groups of row_group_size rows,
+    or fewer if buffer_mb is not enough to buffer a row group of each table:
+    each process holds one row group per table in memory.
+    Input files are validated first as for `merge_list_of_pytables`.
+    With n_workers > 1, contiguous groups of files are written in parallel
+    to different part files, whose names keep the order of the input files.
+
+    The datasets can be read memory-mapped with `read_parquet_table`.
+
+    Parameters
+    ----------
+    filename_list: list
+        Paths of the input files
+    destination: str or pathlib.Path
+        Output directory
+    logger: logging.Logger
+        Logger to use
+    n_workers: int
+        Number of processes to use (default: 1)
+    row_group_size: int
+        Number of rows per row group
+    buffer_mb: float
+        Memory used by each process to buffer the row groups of all tables
+    columns: list
+        Names of the columns to keep (default: all)
+    where: str
+        Condition selecting the rows to keep (default: all rows),
+        see `merge_list_of_pytables`
+
+    Returns
+    -------
+    nrows: dict
+        Number of rows written per table
+    empty_files: int
+        Number of empty input files
+
+    """
+    if pa is None:
+        raise ImportError(
+            "pyarrow is needed to write Parquet files (pip install pyarrow)."
+        )
+
+    scans = scan_files(sorted(filename_list), logger, n_workers=n_workers)
+    empty_files = sum(1 for scan in scans if scan["status"] == "empty")
+    scans = [scan for scan in scans if scan["status"] == "ok"]
+    if not scans:
+        logger.warning("No file with data...")
+
+    destination = Path(destination)
+    if destination.exists():
+        shutil.rmtree(destination)
+
+    n_groups = max(1, min(n_workers, len(scans)))
+    group_size = max(1, -(-len(scans) // n_groups))
+    groups = [scans[i : i + group_size] for i in range(0, len(scans), group_size)]
+
+    nrows = {}
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [
+                pool.submit(
+                    _write_parquet_group,
+                    group,
+                    destination,
+                    f"part-{i:05d}",
+                    row_group_size,
+                    columns,
+                    where,
+                    buffer_mb,
+                )
+                for i, group in enumerate(groups)
+            ]
+            results = [future.result() for future in tqdm(futures, desc="groups")]
+    else:
+        results = [
+            _write_parquet_group(
+                group,
+                destination,
+                f"part-{i:05d}",
+                row_group_size,
+                columns,
+                where,
+                buffer_mb,
+            )
+            for i, group in enumerate(groups)
+        ]
+    for result in results:
+        for name, n in result.items():
+            nrows[name] = nrows.get(name, 0) + n
+
+    for name, n in nrows.items():
+        logger.debug("Table %s: %d rows written to %s", name, n, destination / name)
+
+    return nrows, empty_files
+
+
+def read_parquet_table(destination, name, columns=None):
+    """Read a table written by `write_parquet_dataset` as an Arrow table.
+
+    The part files are memory-mapped, so reading a subset of columns
+    only touches the corresponding column chunks.
+
+    Parameters
+    ----------
+    destination: str or pathlib.Path
+        Output directory of `write_parquet_dataset`
+    name: str
+        Name of the table
+    columns: list
+        Names of the columns to read (default: all)
+
+    Returns
+    -------
+    table: pyarrow.Table
+
+    """
+    return pq.read_table(Path(destination) / name, columns=columns, memory_map=True)
+
+
+def compression_report(filename, read=True):
+    """Measure the compression and the read speed of the tables of a file.
+
+    Parameters
+    ----------
+    filename: str or pathlib.Path
+        Path of the file
+    read: bool
+        If True (default), read each table in full to measure its read speed
+
+    Returns
+    -------
+    report: dict
+        By table name: number of rows, uncompressed and on-disk sizes (bytes),
+        compression ratio, filters, chunkshape and read throughput (MB/s).
+
+    """
+    report = {}
+    with tb.open_file(filename, mode="r") as infile:
+        for table in infile.iter_nodes("/", classname="Table"):
+            size_in_memory = int(table.nrows) * table.dtype.itemsize
+            size_on_disk = int(table.size_on_disk)
+            report[table.name] = {
+                "nrows": int(table.nrows),
+                "size_in_memory": size_in_memory,
+                "size_on_disk": size_on_disk,
+                "ratio": size_in_memory / size_on_disk if size_on_disk else None,
+                "filters": repr(table.filters),
+                "chunkshape": tuple(int(size) for size in table.chunkshape),
+            }
+            if read:
+                block = max(1, DEFAULT_BUFFER_MB * 2**20 // table.dtype.itemsize)
+                start = time.perf_counter()
+                for first in range(0, table.nrows, block):
+                    table.read(first, min(first + block, table.nrows))
+                elapsed = time.perf_counter() - start
+                report[table.name]["read_MBps"] = (
+                    size_in_memory / 2**20 / elapsed if elapsed > 0 else None
+                )
+    return report
+
+
+def log_compression_report(filename, logger, merge_time=None):
+    """Log the output of `compression_report`.
+
+    If the time taken by the merge is given, the write throughput
+    (uncompressed MB/s over all tables) is reported too.
+    """
+    report = compression_report(filename)
+    for name, table in report.items():
+        logger.info(
+            "Table %s: %d rows, %.1f MB -> %.1f MB on disk (ratio %.2f), "
+            "chunkshape %s, read %.1f MB/s, %s",
+            name,
+            table["nrows"],
+            table["size_in_memory"] / 2**20,
+            table["size_on_disk"] / 2**20,
+            table["ratio"] or float("nan"),
+            table["chunkshape"],
+            table["read_MBps"] or float("nan"),
+            table["filters"],
+        )
+    if merge_time:
+        total_size = sum(table["size_in_memory"] for table in report.values())
+        logger.info(
+            "Write throughput: %.1f MB/s (%.1f MB in %.1f s)",
+            total_size / 2**20 / merge_time,
+            total_size / 2**20,
+            merge_time,
+        )
+    return report
+
+
 def main():
     parser = argparse.ArgumentParser(description="Merge collection of HDF5 files")
     parser.add_argument("--indir", type=str, default="./")
     parser.add_argument("--template_file_name", type=str, default="features_event")
     parser.add_argument("--outfile", type=str)
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=1,
+        help="""Number of processes used to validate and merge groups of files
+                in parallel (default: 1, serial merge)""",
+    )
+    parser.add_argument(
+        "--validation_report",
+        type=str,
+        default=None,
+        help="JSON file where to write the validation of the input files",
+    )
+    parser.add_argument(
+        "--validate_only",
+        action="store_true",
+        help="Only validate the input files, without merging them",
+    )
+    parser.add_argument(
+        "--virtual",
+        action="store_true",
+        help="""Write an index file linking the tables of all input files
+                instead of copying their rows""",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="""Only append new files to an existing merged file,
+                using the manifest stored next to it""",
+    )
+    parser.add_argument(
+        "--columns",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Columns to keep in the output tables (default: all)",
+    )
+    parser.add_argument(
+        "--where",
+        type=str,
+        default=None,
+        help="""Condition selecting the rows to keep,
+                e.g. "hillas_intensity > 50" (default: all rows)""",
+    )
+    parser.add_argument(
+        "--index_columns",
+        type=str,
+        nargs="+",
+        default=None,
+        help="""Columns of the output tables on which to create completely
+                sorted indexes, e.g. obs_id event_id (default: none)""",
+    )
+    parser.add_argument(
+        "--sort_by",
+        type=str,
+        nargs="+",
+        default=None,
+        help="""Columns by which to sort the rows of the output tables,
+                primary key first, e.g. obs_id event_id (default: input order;
+                incremental merges sort the whole output again)""",
+    )
+    parser.add_argument(
+        "--max_shard_gb",
+        type=float,
+        default=None,
+        help="""Write the output into shards (e.g. merged_0000.h5) of about
+                this size in GB, listed in a manifest next to them
+                (default: single output file)""",
+    )
+    parser.add_argument(
+        "--max_shard_rows",
+        type=int,
+        default=None,
+        help="Maximum number of rows of each table in a shard (default: no limit)",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="hdf5",
+        choices=["hdf5", "parquet"],
+        help="""Format of the output: a HDF5 file, or a directory with
+                one Parquet dataset per table (default: hdf5)""",
+    )
+    parser.add_argument(
+        "--row_group_size",
+        type=int,
+        default=DEFAULT_ROW_GROUP_SIZE,
+        help=f"""Rows per row group of Parquet output, fewer if --buffer_mb
+                is not enough for a row group of each table
+                (default: {DEFAULT_ROW_GROUP_SIZE})""",
+    )
+    parser.add_argument(
+        "--complib",
+        type=str,
+        default=None,
+        choices=tb.filters.all_complibs,
+        help="""Compression library of the output tables
+                (default: same as the input tables)""",
+    )
+    parser.add_argument(
+        "--complevel",
+        type=int,
+        default=None,
+        choices=range(10),
+        help="""Compression level of the output tables,
+                requires --complib (default: 5)""",
+    )
+    parser.add_argument(
+        "--shuffle",
+        type=str,
+        default=None,
+        choices=["byte", "bit", "none"],
+        help="""Shuffle filter applied before compression,
+                requires --complib (default: byte)""",
+    )
+    parser.add_argument(
+        "--chunkshape",
+        type=int,
+        default=None,
+        help="""Chunk size of the output tables in rows
+                (default: computed from the number of rows)""",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="Report compression ratio and write/read throughput of the output",
+    )
+    parser.add_argument(
+        "--buffer_mb",
+        type=float,
+        default=DEFAULT_BUFFER_MB,
+        help=f"""Memory used to buffer rows before writing them, in MB
+                (per process; default: {DEFAULT_BUFFER_MB})""",
+    )
     parser.add_argument(
         "--log_file",
         type=str,
@@ -114,6 +1953,10 @@ def main():
                 (default: input directory)""",
     )
     args = parser.parse_args()
+    if args.complib is None and (
+        args.complevel is not None or args.shuffle is not None
+    ):
+        parser.error("--complevel and --shuffle require --complib")
 
     if args.log_file is None:
         log_filepath = Path(args.indir) / "merge_tables.log"
@@ -139,7 +1982,29 @@ def main():
             logger_name=__name__, log_filename=log_filepath, append=False
         )
 
-    merge_call(args.template_file_name, args.indir, args.outfile, logger=log)
+    merge_call(
+        args.template_file_name,
+        args.indir,
+        args.outfile,
+        logger=log,
+        n_workers=args.n_workers,
+        buffer_mb=args.buffer_mb,
+        virtual=args.virtual,
+        incremental=args.incremental,
+        filters=make_filters(args.complib, args.complevel, args.shuffle),
+        chunkshape=args.chunkshape,
+        report=args.report,
+        validation_report=args.validation_report,
+        validate_only=args.validate_only,
+        output_format=args.output_format,
+        row_group_size=args.row_group_size,
+        columns=args.columns,
+        where=args.where,
+        index_columns=args.index_columns,
+        sort_by=args.sort_by,
+        max_shard_gb=args.max_shard_gb,
+        max_shard_rows=args.max_shard_rows,
+    )
 
 
 if __name__ == "__main__":
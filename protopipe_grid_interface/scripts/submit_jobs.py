@@ -1,7 +1,6 @@
 import os
 import re
 import datetime
-import subprocess
 import sys
 from pathlib import Path
 from pkg_resources import resource_filename
@@ -14,7 +13,15 @@ try:
 except ImportError:
     raise ImportError("protopipe is not installed in this environment.") from None
 
-from protopipe_grid_interface.utils import initialize_logger, load_config
+from protopipe_grid_interface.utils import (
+    initialize_logger,
+    load_config,
+    list_lfns,
+    upload_to_sites,
+    check_parametric_jdl,
+    submit_job_list,
+    CachedFileCatalog,
+)
 
 try:
     from DIRAC.Core.Base import Script  # This allows to handle user arguments
@@ -77,6 +84,40 @@ Script.registerSwitch(
     "Particle type (gamma, electron, proton) - Recommended: use grid.yaml",
 )
 Script.registerSwitch("n", "n_file_per_job=", "number of files per job")
+Script.registerSwitch(
+    "",
+    "bulk=",
+    "If True, submit jobs in bulk as parametric jobs (default: False)",
+)
+Script.registerSwitch(
+    "",
+    "bulk_size=",
+    "Maximum number of parametric jobs per submission, at most the"
+    " MaxParametricJobs of the DIRAC server (default: 100)",
+)
+Script.registerSwitch(
+    "",
+    "jdl_dir=",
+    "Directory where the job descriptions (JDL) of bulk submissions are written"
+    " (default: None)",
+)
+Script.registerSwitch(
+    "",
+    "concurrent_submissions=",
+    "Number of jobs submitted at the same time, when not in bulk (default: 1)",
+)
+Script.registerSwitch(
+    "",
+    "max_submission_rate=",
+    "Maximum number of job submissions per second, with concurrent submissions"
+    " (default: no limit)",
+)
+Script.registerSwitch(
+    "",
+    "cache_ttl=",
+    "Answer catalog listings from the local cache if younger than this number"
+    " of seconds (default: no cache)",
+)
 Script.parseCommandLine()
 switches = dict(Script.getUnprocessedSwitches())
 
@@ -155,6 +196,38 @@ else:
     particle = None
 
 
+if "bulk" not in switches:
+    switches["bulk"] = False
+elif switches["bulk"] in ["True", "true"]:
+    switches["bulk"] = True
+else:
+    switches["bulk"] = False
+
+if "bulk_size" not in switches:
+    switches["bulk_size"] = 100
+else:
+    switches["bulk_size"] = int(switches["bulk_size"])
+
+if "jdl_dir" not in switches:
+    switches["jdl_dir"] = None
+else:
+    switches["jdl_dir"] = str(switches["jdl_dir"])
+
+if "concurrent_submissions" not in switches:
+    switches["concurrent_submissions"] = 1
+else:
+    switches["concurrent_submissions"] = int(switches["concurrent_submissions"])
+
+if "max_submission_rate" not in switches:
+    switches["max_submission_rate"] = None
+else:
+    switches["max_submission_rate"] = float(switches["max_submission_rate"])
+
+if "cache_ttl" not in switches:
+    switches["cache_ttl"] = None
+else:
+    switches["cache_ttl"] = float(switches["cache_ttl"])
+
 if "log_file" not in switches:
     switches["log_file"] = None
 else:
@@ -255,7 +328,7 @@ def main():
     home_grid = cfg["GRID"]["home_grid"]
     user_name = cfg["GRID"]["user_name"]
     banned_sites = cfg["GRID"]["banned_sites"]
-    upload_sites = cfg["GRID"]["upload_sites"]
+    upload_sites = cfg["GRID"]["upload_sites"] or []
 
     log.info("PARTICLE: %s", particle)
     log.info("FILES/JOB: %s", n_file_per_job)
@@ -460,51 +533,39 @@ def main():
     log.info("Particle type: %s", particle)
     log.info("Energy estimation: %s", estimate_energy)
 
+    catalog = (
+        None
+        if switches["cache_ttl"] is None
+        else CachedFileCatalog(ttl=switches["cache_ttl"])
+    )
+
     # Upload analysis configuration file for provenance
     if switches["upload_config_files"] and not switches["dry"]:
-        se_list = ["CC-IN2P3-USER", "DESY-ZN-USER", "CNAF-USER", "CEA-USER"]
         analysis_config_local = os.path.join(config_path, config_file)
         # the configuration file is uploaded to the data directory because
         # the training samples (as well as their cleaning settings) are independent
-        analysis_config_dirac = os.path.join(home_grid, output_path, config_file)
-        grid_config_dirac = os.path.join(home_grid, output_path, "grid.yaml")
-
-        # Upload these 2 files to all Dirac Storage Elements in SE_LIST
-        for se in se_list:
+        # upload once, then replicate from there to the other upload sites
+        # (files already up to date on the GRID are not uploaded again)
+        primary_se, results = upload_to_sites(
+            [analysis_config_local, grid_config_local_path],
+            os.path.join(home_grid, output_path),
+            upload_sites,
             # the uploaded config file overwrites any old copy
-            ana_cfg_upload_cmd = f"dirac-dms-add-file -f {analysis_config_dirac} {analysis_config_local} {se}"
-            log.info(
-                "Uploading %s to %s...",
-                analysis_config_local,
-                analysis_config_dirac,
-            )
-            ana_cfg_upload_result = subprocess.run(
-                ana_cfg_upload_cmd, shell=True, text=True, check=True
-            )
-            log.debug(ana_cfg_upload_result)
-
-            grid_cfg_upload_cmd = f"dirac-dms-add-file -f {grid_config_dirac} {grid_config_local_path} {se}"
-            log.info(
-                "Uploading %s to %s...",
-                grid_config_local_path,
-                grid_config_dirac,
-            )
-            grid_cfg_upload_result = subprocess.run(
-                grid_cfg_upload_cmd, shell=True, text=True, check=True
-            )
-            log.debug(grid_cfg_upload_result)
+            overwrite=True,
+            catalog=catalog,
+            logger=log,
+        )
+        if any(result.get(primary_se) is not None for result in results.values()):
+            log.critical("Configuration files could not be uploaded to %s", primary_se)
+            sys.exit(1)
     else:
         log.debug("Configuration files won't be uploaded.")
 
     # list of files on the GRID SE space
     # not submitting jobs where we already have the output
-    batcmd = f"dirac-dms-user-lfns --BaseDir {os.path.join(home_grid, output_path)}"
-    result = subprocess.check_output(batcmd, shell=True)
-    try:
-        with open(result.split()[-1], mode="r", encoding="utf8") as f:
-            grid_filelist = [line.rstrip("\n") for line in f]
-    except IOError:
-        log.exception("Cannot read GRID filelist.", exc_info=True)
+    grid_filelist = set(
+        list_lfns(os.path.join(home_grid, output_path), catalog=catalog, logger=log)
+    )
 
     # get jobs from today and yesterday...
     days = []
@@ -535,10 +596,75 @@ def main():
             jobname = dirac.getJobAttributes(job_id)["Value"]["JobName"]
             running_names.append(jobname)
 
+    def new_job():
+        """Job with the settings common to all jobs."""
+        j = Job()
+        # runtime in seconds times 8 (CPU normalisation factor)
+        j.setCPUTime(6 * 3600 * 8)
+        j.setInputSandbox(input_sandbox)
+        if banned_sites:
+            j.setBannedSites(banned_sites)
+        # This allows to run the jobs sites different from where the input
+        # data is located when the source site has been banned
+        if switches["DataReprocessing"] is True:
+            j.setType("DataReprocessing")
+            if switches["tag"]:
+                j.setTag(switches["tag"])
+        return j
+
+    def set_job_steps(j, job_name, input_files, output_files, output_file):
+        """Set the name, the executables and the output of a job.
+
+        The arguments are file names, or placeholders (%(name)s) of
+        parameter sequences for parametric jobs.
+        """
+        j.setName(job_name)
+        for input_file, output_file_temp in zip(input_files, output_files):
+            # source the miniconda ctapipe environment and
+            # run the python script with all its arguments
+            j.setExecutable(
+                "./pilot.sh",
+                pilot_args_write.format(
+                    outfile=output_file_temp,
+                    infile_name=input_file,
+                    mode=mode,
+                ),
+            )
+
+            # check that the output file is there
+            j.setExecutable(f"ls -lh {output_file_temp}")
+
+            # remove the current file to clear space
+            j.setExecutable("rm", input_file)
+
+        # if there is more than one file per job, merge the output tables
+        if len(input_files) > 1:
+            names = []
+
+            names.append((f"*_{particle}_", output_file))
+
+            for in_name, out_name in names:
+                log.debug("in_name: %s, out_name: %s", in_name, out_name)
+                j.setExecutable(
+                    "./pilot.sh",
+                    pilot_args_merge.format(in_name=in_name, out_name=out_name),
+                )
+
+                log.debug(
+                    "args append: %s",
+                    pilot_args_merge.format(in_name=in_name, out_name=out_name),
+                )
+
+        j.setOutputData([output_file], outputSE=None, outputPath=output_path)
+
     n_jobs_remaining = n_jobs_max
     n_jobs_planned = n_jobs_max if (n_jobs_max != -1) else len(list_run_to_loop_on)
     n_jobs_submitted = 0
     failed_jobs = []
+    # jobs to be submitted in bulk
+    planned_jobs = []
+    # jobs to be submitted concurrently
+    jobs_to_submit = []
     for n_job, bunch in enumerate(list_run_to_loop_on):
 
         log.info("JOB # %i", n_job + 1)
@@ -588,70 +714,22 @@ def main():
             log.warning("Maximum number of jobs to submit reached; breaking loop now")
             break
 
-        j = Job()
-
-        # runtime in seconds times 8 (CPU normalisation factor)
-        j.setCPUTime(6 * 3600 * 8)
-        j.setName(job_name)
-        j.setInputSandbox(input_sandbox)
-
-        if banned_sites:
-            j.setBannedSites(banned_sites)
-
-        # Add simtel files as input data
-        j.setInputData(bunch)
-
-        for i, run_file in enumerate(bunch):
-            file_token = re.split("/", bunch[i])[-1].split("_")[3]
-
-            # source the miniconda ctapipe environment and
-            # run the python script with all its arguments
+        output_files = []
+        for run_file in bunch:
+            file_token = re.split("/", run_file)[-1].split("_")[3]
             if switches["output_type"] in "DL2":
-                output_filename_temp = output_filename.format(
-                    "_".join([particle, mode, file_token])
+                output_files.append(
+                    output_filename.format("_".join([particle, mode, file_token]))
                 )
             if switches["output_type"] in "TRAINING":
-                output_filename_temp = output_filename.format(
-                    "_".join([step, particle, mode, file_token])
-                )
-
-            j.setExecutable(
-                "./pilot.sh",
-                pilot_args_write.format(
-                    outfile=output_filename_temp,
-                    infile_name=os.path.basename(run_file),
-                    mode=mode,
-                ),
-            )
-
-            # check that the output file is there
-            j.setExecutable(f"ls -lh {output_filename_temp}")
-
-            # remove the current file to clear space
-            j.setExecutable("rm", os.path.basename(run_file))
-
-        # if there is more than one file per job, merge the output tables
-        if len(bunch) > 1:
-            names = []
-
-            names.append((f"*_{particle}_", output_filenames[mode]))
-
-            for in_name, out_name in names:
-                log.debug("in_name: %s, out_name: %s", in_name, out_name)
-                j.setExecutable(
-                    "./pilot.sh",
-                    pilot_args_merge.format(in_name=in_name, out_name=out_name),
-                )
-
-                log.debug(
-                    "args append: %s",
-                    pilot_args_merge.format(in_name=in_name, out_name=out_name),
+                output_files.append(
+                    output_filename.format("_".join([step, particle, mode, file_token]))
                 )
+        input_files = [os.path.basename(run_file) for run_file in bunch]
 
+        # Add simtel files as input data
         bunch.extend(models_to_upload)
         bunch.extend(configs_to_upload)
-        j.setInputData(bunch)
-
         log.debug("Input data set to job = \n%s", bunch)
 
         outputs = []
@@ -662,7 +740,26 @@ def main():
             output_filenames[mode],
         )
 
-        j.setOutputData(outputs, outputSE=None, outputPath=output_path)
+        if switches["bulk"]:
+            planned_jobs.append(
+                dict(
+                    job_name=job_name,
+                    run_token=run_token,
+                    input_data=bunch,
+                    input_files=input_files,
+                    output_files=output_files,
+                    output_file=output_filenames[mode],
+                )
+            )
+            n_jobs_remaining -= 1
+            if switches["test"] is True:
+                log.info("This is a TEST RUN! -- Only ONE job will be submitted!")
+                break
+            continue
+
+        j = new_job()
+        j.setInputData(bunch)
+        set_job_steps(j, job_name, input_files, output_files, output_filenames[mode])
 
         # check if we should somehow stop doing what we are doing
         if switches["dry"] is True:
@@ -671,18 +768,20 @@ def main():
             log.info("Output path from GRID home: %s", output_path)
             break
 
-        # This allows to run the jobs sites different from where the input
-        # data is located when the source site has been banned
         if switches["DataReprocessing"] is True:
-            j.setType("DataReprocessing")
             if switches["tag"]:
-                j.setTag(switches["tag"])
                 log.debug(
                     "DataReprocessing has been activated with %s tag.", switches["tag"]
                 )
             else:
                 log.debug("DataReprocessing has been activated with no tag.")
 
+        if switches["concurrent_submissions"] > 1 and switches["test"] is False:
+            # submitted after the loop, several at a time
+            jobs_to_submit.append((run_token, j))
+            n_jobs_remaining -= 1
+            continue
+
         # this sends the job to the GRID and uploads all the
         # files into the input sandbox in the process
 
@@ -712,6 +811,84 @@ def main():
         if switches["test"] is True:
             break
 
+    if jobs_to_submit:
+        log.info(
+            "SUBMITTING %d jobs with the following INPUT SANDBOX:\n %s",
+            len(jobs_to_submit),
+            input_sandbox,
+        )
+        _, failed = submit_job_list(
+            jobs_to_submit,
+            concurrency=switches["concurrent_submissions"],
+            max_rate=switches["max_submission_rate"],
+            logger=log,
+        )
+        failed_jobs.extend(failed)
+        n_jobs_submitted += len(jobs_to_submit)
+
+    # Bulk submission: jobs with the same number of input files only differ
+    # by their parameters, so each group is submitted as parametric jobs
+    groups = {}
+    for planned_job in planned_jobs:
+        groups.setdefault(len(planned_job["input_files"]), []).append(planned_job)
+    n_bulk = 0
+    for n_files, group in sorted(groups.items()):
+        for start in range(0, len(group), switches["bulk_size"]):
+            chunk = group[start : start + switches["bulk_size"]]
+            j = new_job()
+            j.setParameterSequence(
+                "InputData",
+                [planned_job["input_data"] for planned_job in chunk],
+                addToWorkflow="ParametricInputData",
+            )
+            sequences = {
+                "job_name": [planned_job["job_name"] for planned_job in chunk],
+                "output_file": [planned_job["output_file"] for planned_job in chunk],
+            }
+            for i in range(n_files):
+                sequences[f"infile{i}"] = [
+                    planned_job["input_files"][i] for planned_job in chunk
+                ]
+                sequences[f"outfile{i}"] = [
+                    planned_job["output_files"][i] for planned_job in chunk
+                ]
+            for name, values in sequences.items():
+                j.setParameterSequence(name, values, addToWorkflow=True)
+            set_job_steps(
+                j,
+                "%(job_name)s",
+                [f"%(infile{i})s" for i in range(n_files)],
+                [f"%(outfile{i})s" for i in range(n_files)],
+                "%(output_file)s",
+            )
+
+            # the description of the jobs can be checked before submission
+            jdl = j._toJDL()  # pylint: disable=protected-access
+            if switches["jdl_dir"] is not None:
+                os.makedirs(switches["jdl_dir"], exist_ok=True)
+                jdl_file = os.path.join(switches["jdl_dir"], f"bulk_{n_bulk:04d}.jdl")
+                with open(jdl_file, mode="w", encoding="utf8") as f:
+                    f.write(jdl)
+                log.info("Description of %d jobs written to %s", len(chunk), jdl_file)
+            n_bulk += 1
+            check_parametric_jdl(jdl, n_jobs=len(chunk))
+
+            if switches["dry"] is True:
+                log.info(
+                    "%d jobs with %d input files would be submitted",
+                    len(chunk),
+                    n_files,
+                )
+                continue
+
+            job = dirac.submitJob(j)
+            if not job["OK"]:
+                log.critical("Bulk submission of %d jobs failed: %s", len(chunk), job)
+                failed_jobs.extend(planned_job["run_token"] for planned_job in chunk)
+            else:
+                log.info("Submitted %d jobs: IDs %s", len(chunk), job["Value"])
+            n_jobs_submitted += len(chunk)
+
     log.info("%i job(s) have been planned", n_jobs_planned)
     log.info("%i job(s) have been submitted", n_jobs_submitted)
     log.info("%d jobs(s) failed", len(failed_jobs))
@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+pytest.importorskip("DIRAC")
+
+from protopipe_grid_interface.utils import CachedFileCatalog, list_lfns
+
+
+class FakeCatalog:
+    """In-memory stand-in for DIRAC.Resources.Catalog.FileCatalog.FileCatalog."""
+
+    def __init__(self, lfns):
+        self.directories = {}
+        for lfn in lfns:
+            directory = os.path.dirname(lfn)
+            self.directories.setdefault(directory, {"Files": {}, "SubDirs": {}})
+            self.directories[directory]["Files"][lfn] = {}
+            # register the parent directories up to the root
+            while directory != "/":
+                parent = os.path.dirname(directory)
+                self.directories.setdefault(parent, {"Files": {}, "SubDirs": {}})
+                self.directories[parent]["SubDirs"][directory] = {}
+                directory = parent
+        self.n_calls = 0
+
+    def listDirectory(self, paths):
+        self.n_calls += 1
+        successful = {p: self.directories[p] for p in paths if p in self.directories}
+        failed = {p: "Directory does not exist" for p in paths if p not in successful}
+        return {"OK": True, "Value": {"Successful": successful, "Failed": failed}}
+
+    def getFileMetadata(self, lfns):
+        self.n_calls += 1
+        directories = [self.directories.get(os.path.dirname(lfn), {}) for lfn in lfns]
+        successful = {
+            lfn: {"Size": len(lfn)}
+            for lfn, directory in zip(lfns, directories)
+            if lfn in directory.get("Files", {})
+        }
+        failed = {lfn: "No such file" for lfn in lfns if lfn not in successful}
+        return {"OK": True, "Value": {"Successful": successful, "Failed": failed}}
+
+
+def test_list_lfns():
+
+    base_dir = "/vo.cta.in2p3.fr/user/x/xxx/analysis/data"
+    lfns = [f"{base_dir}/DL2/proton/run{i}.h5" for i in range(5)]
+    lfns += [f"{base_dir}/DL2/proton/run{i}.log" for i in range(5)]
+    lfns += [f"{base_dir}/DL2/gamma/run{i}.h5" for i in range(3)]
+    lfns += [f"{base_dir}/TRAINING/gamma/run{i}.h5" for i in range(3)]
+    lfns += ["/vo.cta.in2p3.fr/user/x/xxx/other/run0.h5"]
+    catalog = FakeCatalog(lfns)
+
+    listed = list(list_lfns(base_dir, catalog=catalog, batch_size=2))
+    assert sorted(listed) == sorted(lfn for lfn in lfns if lfn.startswith(base_dir))
+    # 1 + 2 + 3 directories by levels of the tree, listed 2 per call
+    assert catalog.n_calls == 4
+
+    assert sorted(list_lfns(f"{base_dir}/DL2", pattern="*.h5", catalog=catalog)) == (
+        sorted(lfn for lfn in lfns if "/DL2/" in lfn and lfn.endswith(".h5"))
+    )
+    assert list(list_lfns(f"{base_dir}/DL1", catalog=catalog)) == []
+
+
+def test_cached_catalog(tmpdir):
+
+    base_dir = "/vo.cta.in2p3.fr/user/x/xxx/analysis/data"
+    lfns = [f"{base_dir}/{particle}/run0.h5" for particle in ["gamma", "proton"]]
+    catalog = FakeCatalog(lfns)
+    cache_path = tmpdir.join("catalog.sqlite").strpath
+    cached = CachedFileCatalog(catalog, path=cache_path)
+
+    assert sorted(list_lfns(base_dir, catalog=cached)) == lfns
+    n_calls = catalog.n_calls
+    # answered from the cache, also by another object on the same database
+    assert sorted(list_lfns(base_dir, catalog=cached)) == lfns
+    cached = CachedFileCatalog(catalog, path=cache_path)
+    assert sorted(list_lfns(base_dir, catalog=cached)) == lfns
+    assert catalog.n_calls == n_calls
+
+    # only missing entries are queried and failures are not cached
+    missing = f"{base_dir}/gamma/run1.h5"
+    result = cached.getFileMetadata(lfns[:1])
+    assert result["Value"]["Successful"] == {lfns[0]: {"Size": len(lfns[0])}}
+    result = cached.getFileMetadata(lfns + [missing])
+    assert list(result["Value"]["Successful"]) == lfns
+    assert list(result["Value"]["Failed"]) == [missing]
+    assert catalog.n_calls == n_calls + 2
+
+    # a new file invalidates the listings of its parent directories only
+    catalog = FakeCatalog(lfns + [missing])
+    cached = CachedFileCatalog(catalog, path=cache_path)
+    cached.invalidate(missing)
+    assert sorted(list_lfns(base_dir, catalog=cached)) == sorted(lfns + [missing])
+    # base directory, then gamma directory (proton is still cached)
+    assert catalog.n_calls == 2
+
+    # expired entries are queried again
+    cached = CachedFileCatalog(catalog, path=cache_path, ttl=0)
+    assert sorted(list_lfns(base_dir, catalog=cached)) == sorted(lfns + [missing])
+    # base directory, then both sub-directories
+    assert catalog.n_calls == 4
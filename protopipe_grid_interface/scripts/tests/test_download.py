@@ -0,0 +1,405 @@
+import argparse
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+import zlib
+
+import numpy as np
+import pytest
+import tables as tb
+
+pytest.importorskip("DIRAC")
+
+from protopipe_grid_interface.utils import (
+    download,
+    download_files,
+    DownloadCache,
+    files_to_download,
+    StorageElementHistory,
+)
+
+
+class FakeDirac:
+    """Stand-in for Dirac (transfers) and FileCatalog (metadata) objects."""
+
+    def __init__(self, latency=0.05, failures=None):
+        self.latency = latency
+        # number of times each LFN fails before succeeding
+        self.failures = dict(failures or {})
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def getFile(self, lfn, destDir=""):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+            if self.failures.get(lfn, 0) > 0:
+                self.failures[lfn] -= 1
+                return {
+                    "OK": True,
+                    "Value": {"Successful": {}, "Failed": {lfn: "timeout"}},
+                }
+        path = os.path.join(destDir, os.path.basename(lfn))
+        with open(path, "wb") as f:
+            f.write(self.content(lfn))
+        return {"OK": True, "Value": {"Successful": {lfn: path}, "Failed": {}}}
+
+    @staticmethod
+    def content(lfn):
+        return lfn.encode() * 100
+
+    def getFileMetadata(self, lfns):
+        metadata = {
+            lfn: {
+                "Size": len(self.content(lfn)),
+                "Checksum": f"{zlib.adler32(self.content(lfn)):x}",
+            }
+            for lfn in lfns
+        }
+        return {"OK": True, "Value": {"Successful": metadata, "Failed": {}}}
+
+
+def test_concurrent_download(tmpdir):
+
+    lfns = [f"/vo.cta.in2p3.fr/user/x/xxx/run{i}.h5" for i in range(20)]
+    dirac = FakeDirac()
+
+    failed = download_files(lfns, tmpdir.strpath, dirac=dirac, concurrency=5)
+
+    assert failed == {}
+    assert dirac.max_in_flight == 5
+    assert sorted(os.listdir(tmpdir.strpath)) == sorted(
+        os.path.basename(lfn) for lfn in lfns
+    )
+
+
+def test_download_retries(tmpdir):
+
+    lfns = [f"/vo.cta.in2p3.fr/user/x/xxx/run{i}.h5" for i in range(3)]
+    dirac = FakeDirac(latency=0, failures={lfns[0]: 2, lfns[1]: 10})
+
+    failed = download_files(lfns, tmpdir.strpath, dirac=dirac, retries=2, backoff=0)
+
+    assert failed == {lfns[1]: "timeout"}
+    assert tmpdir.join("run0.h5").exists()
+    assert not tmpdir.join("run1.h5").exists()
+
+
+def test_skip_up_to_date_files(tmpdir):
+
+    lfns = [f"/vo.cta.in2p3.fr/user/x/xxx/run{i}.h5" for i in range(4)]
+    dirac = FakeDirac(latency=0)
+    download_files(lfns, tmpdir.strpath, dirac=dirac)
+
+    # same size but different content
+    content = tmpdir.join("run1.h5").read_binary()
+    tmpdir.join("run1.h5").write_binary(content[::-1])
+    # different size
+    tmpdir.join("run2.h5").write_binary(b"0")
+    tmpdir.join("run3.h5").remove()
+
+    assert files_to_download(lfns, tmpdir.strpath, catalog=dirac) == lfns[1:]
+    assert tmpdir.join("run0.h5").exists()
+    assert not tmpdir.join("run1.h5").exists()
+    assert not tmpdir.join("run2.h5").exists()
+
+
+def test_batched_metadata_queries(tmpdir):
+
+    lfns = [f"/vo.cta.in2p3.fr/user/x/xxx/run{i}.h5" for i in range(2500)]
+    for lfn in lfns:
+        tmpdir.join(os.path.basename(lfn)).write_binary(FakeDirac.content(lfn))
+    dirac = FakeDirac(latency=0)
+    batches = []
+    get_file_metadata = dirac.getFileMetadata
+
+    def record(lfns):
+        batches.append(len(lfns))
+        return get_file_metadata(lfns)
+
+    dirac.getFileMetadata = record
+
+    assert files_to_download(lfns, tmpdir.strpath, catalog=dirac) == []
+    assert batches == [1000, 1000, 500]
+
+
+class UnreachableCatalog:
+    def getFileMetadata(self, lfns):
+        return {"OK": False, "Message": "timeout"}
+
+
+def test_keep_files_without_metadata(tmpdir):
+
+    lfns = [f"/vo.cta.in2p3.fr/user/x/xxx/run{i}.h5" for i in range(3)]
+    download_files(lfns[:2], tmpdir.strpath, dirac=FakeDirac(latency=0))
+
+    # local files are neither removed nor downloaded again
+    assert files_to_download(lfns, tmpdir.strpath, catalog=UnreachableCatalog()) == [
+        lfns[2]
+    ]
+    assert tmpdir.join("run0.h5").exists()
+    assert tmpdir.join("run1.h5").exists()
+
+
+class FakeStorageElement:
+    """Stand-in for DIRAC.Resources.Storage.StorageElement.StorageElement."""
+
+    transfers = []
+
+    def __init__(self, name):
+        self.name = name
+
+    def getFile(self, lfn, localPath=""):
+        self.transfers.append((self.name, lfn))
+        if self.name == "BROKEN-USER":
+            return {"OK": False, "Message": "SE unavailable"}
+        with open(os.path.join(localPath, os.path.basename(lfn)), "wb") as f:
+            # CORRUPT-USER transfers wrong data without reporting any error
+            f.write((b"1" if self.name == "CORRUPT-USER" else b"0") * 2**20)
+        return {"OK": True, "Value": {"Successful": {lfn: 2**20}, "Failed": {}}}
+
+
+def test_download_from_best_replica(tmpdir):
+
+    history = StorageElementHistory(tmpdir.join("history.sqlite").strpath)
+    history.record("SLOW-USER", 2**20, 10.0)
+    history.record("FAST-USER", 2**20, 0.1)
+    history.record("BROKEN-USER", 2**20, 0.01)
+    assert history.rank(["SLOW-USER", "NEW-USER", "FAST-USER"]) == [
+        "FAST-USER",
+        "NEW-USER",
+        "SLOW-USER",
+    ]
+
+    lfns = [f"/vo.cta.in2p3.fr/user/x/xxx/run{i}.h5" for i in range(4)]
+    replicas = {lfn: ["SLOW-USER", "FAST-USER", "BROKEN-USER"] for lfn in lfns}
+    FakeStorageElement.transfers = []
+    failed = download_files(
+        lfns,
+        tmpdir.strpath,
+        concurrency=1,
+        backoff=0,
+        replicas=replicas,
+        se_history=history,
+        storage_element=FakeStorageElement,
+    )
+
+    assert failed == {}
+    # the ranking is fixed during a download: each file is tried first on
+    # BROKEN-USER, then on FAST-USER
+    assert FakeStorageElement.transfers[:2] == [
+        ("BROKEN-USER", lfns[0]),
+        ("FAST-USER", lfns[0]),
+    ]
+    assert all(se != "SLOW-USER" for se, _ in FakeStorageElement.transfers)
+    statistics = history.statistics()
+    assert statistics["BROKEN-USER"]["failure_rate"] > 0
+    assert statistics["FAST-USER"]["n_transfers"] == 5
+    # BROKEN-USER has now failed too often and is ranked last
+    assert history.rank(["BROKEN-USER", "SLOW-USER"]) == ["SLOW-USER", "BROKEN-USER"]
+
+
+def test_verify_replica_checksum(tmpdir):
+
+    history = StorageElementHistory(tmpdir.join("history.sqlite").strpath)
+    history.record("CORRUPT-USER", 2**20, 0.01)
+    history.record("FAST-USER", 2**20, 0.1)
+
+    lfns = [f"/vo.cta.in2p3.fr/user/x/xxx/run{i}.h5" for i in range(2)]
+    checksum = f"{zlib.adler32(b'0' * 2**20):08x}"
+    FakeStorageElement.transfers = []
+    failed = download_files(
+        lfns,
+        tmpdir.strpath,
+        concurrency=1,
+        backoff=0,
+        replicas={lfn: ["CORRUPT-USER", "FAST-USER"] for lfn in lfns},
+        se_history=history,
+        storage_element=FakeStorageElement,
+        metadata={lfn: {"Size": 2**20, "Checksum": checksum} for lfn in lfns},
+    )
+
+    # corrupted transfers are retried from the next SE
+    assert failed == {}
+    assert FakeStorageElement.transfers == [
+        (se, lfn) for lfn in lfns for se in ["CORRUPT-USER", "FAST-USER"]
+    ]
+    for lfn in lfns:
+        assert tmpdir.join(os.path.basename(lfn)).read_binary() == b"0" * 2**20
+    assert history.statistics()["CORRUPT-USER"]["failure_rate"] > 0
+
+
+class FakeGrid(FakeDirac):
+    """Catalog of directories on the GRID, whose files are copies of local ones."""
+
+    def __init__(self, sources, unreachable=()):
+        super().__init__(latency=0.01)
+        self.sources = sources
+        self.unreachable = set(unreachable)
+        self.transfers = []
+
+    def getFile(self, lfn, destDir=""):
+        self.transfers.append(lfn)
+        return super().getFile(lfn, destDir=destDir)
+
+    def content(self, lfn):
+        with open(self.sources[lfn], "rb") as f:
+            return f.read()
+
+    def listDirectory(self, paths):
+        if self.unreachable.intersection(paths):
+            return {"OK": False, "Message": "timeout"}
+        successful = {
+            path: {
+                "Files": {
+                    lfn: {} for lfn in self.sources if os.path.dirname(lfn) == path
+                },
+                "SubDirs": {},
+            }
+            for path in paths
+        }
+        return {"OK": True, "Value": {"Successful": successful, "Failed": {}}}
+
+
+def test_download_and_merge_stream(tmpdir, monkeypatch):
+
+    from protopipe_grid_interface import utils
+    from protopipe_grid_interface.scripts.download_and_merge import (
+        download_and_merge_stream,
+    )
+
+    source = tmpdir.mkdir("grid")
+    directory = "/vo.cta.in2p3.fr/user/x/xxx/analysis/data/DL2/proton"
+    sources = {}
+    for i in range(10):
+        filename = source.join(f"DL2_proton_tail_run{i}.h5").strpath
+        with tb.open_file(filename, mode="w") as f:
+            f.create_table("/", "CHEC", obj=np.full(5, i, dtype=[("n", "i4")]))
+        sources[f"{directory}/DL2_proton_tail_run{i}.h5"] = filename
+    sources[f"{directory}/DL2_proton_tail_run10.log"] = source.join("log").strpath
+    source.join("log").write("log")
+    grid = FakeGrid(sources)
+    monkeypatch.setattr(utils, "Dirac", lambda: grid)
+
+    output_directory = tmpdir.mkdir("proton")
+    # a file downloaded by a previous run
+    with open(sources[f"{directory}/DL2_proton_tail_run0.h5"], "rb") as f:
+        output_directory.join("DL2_proton_tail_run0.h5").write_binary(f.read())
+    args = argparse.Namespace(concurrency=4, queue_size=2, delete_merged=True)
+    output_file = output_directory.join("DL2_tail_proton_merged.h5")
+    failed = download_and_merge_stream(
+        directory,
+        Path(output_directory.strpath),
+        Path(output_file.strpath),
+        "DL2_proton_tail",
+        args,
+        logging.getLogger(__name__),
+        catalog=grid,
+    )
+
+    assert failed == {}
+    with tb.open_file(output_file.strpath, "r") as f:
+        assert sorted(f.root.CHEC.col("n").tolist()) == sorted(list(range(10)) * 5)
+    # merged files were deleted, the others are kept
+    assert sorted(os.listdir(output_directory.strpath)) == [
+        "DL2_proton_tail_run10.log",
+        "DL2_tail_proton_merged.h5",
+    ]
+
+
+def test_shared_download_cache(tmpdir, monkeypatch):
+
+    from protopipe_grid_interface import utils
+
+    source = tmpdir.mkdir("grid")
+    directory = "/vo.cta.in2p3.fr/user/x/xxx/production/DL1"
+    sources = {}
+    for i in range(4):
+        source.join(f"run{i}.h5").write_binary(bytes([i]) * 2**10)
+        sources[f"{directory}/run{i}.h5"] = source.join(f"run{i}.h5").strpath
+    grid = FakeGrid(sources)
+    transfers = grid.transfers
+    monkeypatch.setattr(utils, "Dirac", lambda: grid)
+
+    cache = DownloadCache(tmpdir.join("productions", "download_cache").strpath)
+    first = tmpdir.join("analysis1")
+    download(directory, first.strpath, catalog=grid, cache=cache)
+    assert len(transfers) == 4
+
+    # another analysis links the cached files
+    second = tmpdir.join("analysis2")
+    download(directory, second.strpath, catalog=grid, cache=cache)
+    assert len(transfers) == 4
+    for i in range(4):
+        assert second.join(f"run{i}.h5").read_binary() == bytes([i]) * 2**10
+        assert os.path.samefile(first.join(f"run{i}.h5"), second.join(f"run{i}.h5"))
+        # cached data cannot be modified through an analysis
+        assert os.stat(second.join(f"run{i}.h5")).st_mode & 0o222 == 0
+
+    # a file changed on the GRID is downloaded again
+    source.join("run0.h5").write_binary(b"new" * 2**8)
+    download(directory, second.strpath, catalog=grid, cache=cache)
+    assert transfers[4:] == [f"{directory}/run0.h5"]
+
+    # the least recently used files are removed first
+    assert cache.size() == 5 * 2**10 - 2**8
+    assert cache.evict(max_size_gb=3 * 2**10 / 2**30) == 2
+    assert cache.size() <= 3 * 2**10
+    assert not cache.get(f"{directory}/run1.h5", "0", tmpdir.join("x").strpath)
+
+
+def test_concurrent_particles(tmpdir, monkeypatch):
+
+    from protopipe_grid_interface import utils
+    from protopipe_grid_interface.scripts.download_and_merge import (
+        process_particles,
+    )
+
+    source = tmpdir.mkdir("grid")
+    directory = "/vo.cta.in2p3.fr/user/x/xxx/analysis/data/DL2"
+    sources = {}
+    for value, part in enumerate(["gamma", "proton", "electron"]):
+        for i in range(6):
+            filename = source.join(f"DL2_{part}_tail_run{i}.h5").strpath
+            with tb.open_file(filename, mode="w") as f:
+                f.create_table("/", "CHEC", obj=np.full(5, value, dtype=[("n", "i4")]))
+            sources[f"{directory}/{part}/DL2_{part}_tail_run{i}.h5"] = filename
+    # the files of one particle type cannot be listed
+    grid = FakeGrid(sources, unreachable=[f"{directory}/electron"])
+    grid.latency = 0.05
+    monkeypatch.setattr(utils, "Dirac", lambda: grid)
+
+    def directories(part):
+        return Path(directory) / part, Path(tmpdir.mkdir(part).strpath)
+
+    args = argparse.Namespace(
+        pipeline=True,
+        concurrency=2,
+        queue_size=4,
+        delete_merged=False,
+        data_type="DL2",
+        cleaning_mode="tail",
+    )
+    failed = process_particles(
+        ["gamma", "proton", "electron"],
+        args,
+        directories,
+        logging.getLogger(__name__),
+        catalog=grid,
+    )
+
+    assert failed == ["electron"]
+    # the transfer limit is shared by all particle types
+    assert grid.max_in_flight == 2
+    assert len(grid.transfers) == 12
+    for value, part in enumerate(["gamma", "proton"]):
+        with tb.open_file(
+            tmpdir.join(part, f"DL2_tail_{part}_merged.h5").strpath, "r"
+        ) as f:
+            assert f.root.CHEC.col("n").tolist() == [value] * 30
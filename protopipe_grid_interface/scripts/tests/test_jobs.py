@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("DIRAC")
+
+from protopipe_grid_interface.utils import check_parametric_jdl, submit_job_list
+
+# description of 2 parametric jobs, as written by DIRAC
+JDL = """[
+    Arguments = "jobDescription.xml -o LogLevel=INFO";
+    Executable = "dirac-jobexec";
+    JobName = "%(job_name)s";
+    OutputData = "%(output_file)s";
+    Parameters = 2;
+    Parameters.InputData =
+        {
+            "LFN:/vo.cta.in2p3.fr/MC/run1.simtel;LFN:/vo.cta.in2p3.fr/user/x/model.yaml",
+            "LFN:/vo.cta.in2p3.fr/MC/run2.simtel;LFN:/vo.cta.in2p3.fr/user/x/model.yaml"
+        };
+    Parameters.job_name =
+        {
+            "protopipe_test_DL2_gamma_run1",
+            "protopipe_test_DL2_gamma_run2"
+        };
+    Parameters.output_file =
+        {
+            "DL2_gamma_tail_run1.h5",
+            "DL2_gamma_tail_run2.h5"
+        };
+    CPUTime = 172800;
+]"""
+
+
+def test_check_parametric_jdl():
+
+    sequences = check_parametric_jdl(JDL, n_jobs=2)
+    assert sequences["output_file"] == [
+        "DL2_gamma_tail_run1.h5",
+        "DL2_gamma_tail_run2.h5",
+    ]
+    assert len(sequences["InputData"]) == 2
+
+    # a placeholder without values
+    with pytest.raises(ValueError, match="mode"):
+        check_parametric_jdl(JDL.replace("CPUTime", 'Mode = "%(mode)s";\n    CPUTime'))
+
+    # sequences of different lengths
+    jdl = JDL.replace(
+        '"DL2_gamma_tail_run2.h5"', '"DL2_gamma_tail_run2.h5", "extra.h5"'
+    )
+    with pytest.raises(ValueError, match="output_file"):
+        check_parametric_jdl(jdl)
+
+    with pytest.raises(ValueError, match="Parameters = 2"):
+        check_parametric_jdl(JDL, n_jobs=3)
+
+
+class FakeWMS:
+    """Stand-in for the job submission of DIRAC.Interfaces.API.Dirac.Dirac."""
+
+    def __init__(self, latency=0.05, failing=()):
+        self.latency = latency
+        self.failing = set(failing)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.n_jobs = 0
+
+    def submitJob(self, job):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+            if job in self.failing:
+                return {"OK": False, "Message": "Cannot upload the input sandbox"}
+            self.n_jobs += 1
+            return {"OK": True, "Value": 1000 + self.n_jobs}
+
+
+def test_concurrent_submission():
+
+    jobs = [(f"run{i}", f"job{i}") for i in range(20)]
+    wms = FakeWMS(failing=["job3"])
+
+    start = time.perf_counter()
+    submitted, failed = submit_job_list(jobs, dirac=wms, concurrency=5)
+    elapsed = time.perf_counter() - start
+
+    assert wms.max_in_flight == 5
+    assert elapsed < 20 * wms.latency / 2
+    assert failed == {"run3": "Cannot upload the input sandbox"}
+    assert sorted(submitted) == sorted(f"run{i}" for i in range(20) if i != 3)
+    assert len(set(submitted.values())) == 19
+
+
+def test_rate_limited_submission():
+
+    jobs = [(f"run{i}", f"job{i}") for i in range(10)]
+    wms = FakeWMS(latency=0)
+
+    start = time.perf_counter()
+    submitted, failed = submit_job_list(jobs, dirac=wms, concurrency=5, max_rate=50)
+    elapsed = time.perf_counter() - start
+
+    assert len(submitted) == 10 and not failed
+    # 10 submissions started at most every 20 ms
+    assert elapsed >= 9 / 50
@@ -1,13 +1,20 @@
 # make 2 HDF5 files
 
 import glob
+import json
+import logging
 import subprocess
+from pathlib import Path
 from pkg_resources import resource_filename
 
+import numpy as np
+import pytest
 import tables as tb
 
+from protopipe_grid_interface.scripts.merge_tables import StreamingMerger
 
-def create_mock_file(tmpdir, filename):
+
+def create_mock_file(tmpdir, filename, value=0, n_rows=50):
 
     filepath = tmpdir.join(filename)
     outfile = tb.open_file(filepath.strpath, mode="w", title="Run_1")
@@ -22,8 +29,8 @@ def create_mock_file(tmpdir, filename):
         if cam_id not in outdata:
             out_table[cam_id] = outfile.create_table("/", cam_id, output_variables)
             outdata[cam_id] = out_table[cam_id].row
-        for n_image in range(50):
-            outdata[cam_id]["n"] = 0
+        for n_image in range(n_rows):
+            outdata[cam_id]["n"] = value
             outdata[cam_id].append()
 
     outfile.close()
@@ -74,3 +81,376 @@ def test_merge(tmpdir):
 
     for camera in cameras:
         assert n_images_from_runs[camera] == n_tot_images[camera]
+
+
+def run_merge(tmpdir, merged_file_path, *options):
+
+    subprocess.run(
+        [
+            "python",
+            resource_filename("protopipe_grid_interface", "scripts/merge_tables.py"),
+            "--indir",
+            tmpdir.strpath,
+            "--template_file_name",
+            "*run*",
+            "--outfile",
+            merged_file_path,
+            *options,
+        ],
+        check=True,
+    )
+
+
+def test_parallel_merge(tmpdir):
+
+    # 7 files with different content, so that the row order is checked too
+    for i in range(7):
+        create_mock_file(tmpdir, f"run{i}.h5", value=i)
+
+    serial_file_path = tmpdir.join("serial_merged_file.h5").strpath
+    parallel_file_path = tmpdir.join("parallel_merged_file.h5").strpath
+
+    # a tiny buffer forces many partial appends
+    run_merge(tmpdir, serial_file_path, "--buffer_mb", "0.0001")
+    run_merge(tmpdir, parallel_file_path, "--n_workers", "3")
+
+    with tb.open_file(serial_file_path, "r") as serial:
+        with tb.open_file(parallel_file_path, "r") as parallel:
+            for child in serial.root:
+                other = parallel.get_node("/", child._v_name)
+                assert len(other) == 7 * 50
+                assert child.read().tolist() == other.read().tolist()
+
+
+def test_merge_skips_bad_files(tmpdir):
+
+    create_mock_file(tmpdir, "run1.h5")
+    create_mock_file(tmpdir, "run2.h5", n_rows=20)
+    # a file without tables
+    tb.open_file(tmpdir.join("run3.h5").strpath, mode="w").close()
+    # a file which is not HDF5
+    tmpdir.join("run4.h5").write("not an HDF5 file")
+    # a file with a different schema
+    with tb.open_file(tmpdir.join("run5.h5").strpath, mode="w") as f:
+        f.create_table("/", "CHEC", dict(n=tb.Float64Col(pos=0)))
+
+    # the schema of the majority of files is the reference one
+    create_mock_file(tmpdir, "run0.h5")
+
+    merged_file_path = tmpdir.join("merged_file.h5").strpath
+    report_path = tmpdir.join("validation.json").strpath
+    run_merge(
+        tmpdir,
+        merged_file_path,
+        "--n_workers",
+        "2",
+        "--validation_report",
+        report_path,
+    )
+
+    with tb.open_file(merged_file_path, "r") as f:
+        for camera in ["NectarCam", "CHEC"]:
+            table = f.get_node("/", camera)
+            assert len(table) == 120
+            assert table.coldtypes["n"] == "int16"
+
+    with open(report_path, mode="r", encoding="utf8") as f:
+        report = json.load(f)
+    assert report["n_files"] == 6
+    assert report["status"] == {"ok": 3, "empty": 1, "corrupt": 1, "mismatch": 1}
+    assert report["tables"]["CHEC"]["nrows"] == 120
+
+
+def test_virtual_merge(tmpdir):
+
+    from protopipe_grid_interface.scripts.merge_tables import read_virtual_table
+
+    for i in range(3):
+        create_mock_file(tmpdir, f"run{i}.h5", value=i)
+    tmpdir.join("run3.h5").write("not an HDF5 file")
+
+    index_file_path = tmpdir.join("index.h5").strpath
+    run_merge(tmpdir, index_file_path, "--virtual")
+
+    for camera in ["NectarCam", "CHEC"]:
+        data = read_virtual_table(index_file_path, camera)
+        assert data["n"].tolist() == [0] * 50 + [1] * 50 + [2] * 50
+
+
+def test_incremental_merge(tmpdir):
+
+    create_mock_file(tmpdir, "run1.h5", value=1)
+    create_mock_file(tmpdir, "run2.h5", value=2)
+    tmpdir.join("run3.h5").write("not an HDF5 file")
+
+    merged_file_path = tmpdir.join("merged_file.h5").strpath
+    manifest_path = tmpdir.join("merged_file.manifest.json")
+
+    def merged_values():
+        with tb.open_file(merged_file_path, "r") as f:
+            return f.root.CHEC.col("n").tolist()
+
+    run_merge(tmpdir, merged_file_path, "--incremental")
+    assert merged_values() == [1] * 50 + [2] * 50
+    assert manifest_path.exists()
+
+    # a new file is appended, a corrupt one which has been fixed too
+    create_mock_file(tmpdir, "run0.h5", value=0)
+    tmpdir.join("run3.h5").remove()
+    create_mock_file(tmpdir, "run3.h5", value=3)
+    run_merge(tmpdir, merged_file_path, "--incremental")
+    assert sorted(merged_values()) == [0] * 50 + [1] * 50 + [2] * 50 + [3] * 50
+    assert merged_values()[:100] == [1] * 50 + [2] * 50
+
+    # removing a file triggers a merge from scratch
+    tmpdir.join("run1.h5").remove()
+    run_merge(tmpdir, merged_file_path, "--incremental")
+    assert merged_values() == [0] * 50 + [2] * 50 + [3] * 50
+
+    # so does a change of the row selection, and back
+    run_merge(tmpdir, merged_file_path, "--incremental", "--where", "n > 2")
+    assert merged_values() == [3] * 50
+    create_mock_file(tmpdir, "run4.h5", value=4)
+    run_merge(tmpdir, merged_file_path, "--incremental", "--where", "n > 2")
+    assert merged_values() == [3] * 50 + [4] * 50
+    run_merge(tmpdir, merged_file_path, "--incremental")
+    assert merged_values() == [0] * 50 + [2] * 50 + [3] * 50 + [4] * 50
+
+    # a merge without the incremental option removes the manifest
+    run_merge(tmpdir, merged_file_path)
+    assert not manifest_path.exists()
+
+
+def test_merge_output_filters(tmpdir):
+
+    from protopipe_grid_interface.scripts.merge_tables import compression_report
+
+    create_mock_file(tmpdir, "run1.h5")
+    create_mock_file(tmpdir, "run2.h5")
+
+    merged_file_path = tmpdir.join("merged_file.h5").strpath
+    run_merge(
+        tmpdir,
+        merged_file_path,
+        "--complib",
+        "zlib",
+        "--complevel",
+        "1",
+        "--chunkshape",
+        "16",
+        "--report",
+    )
+
+    with tb.open_file(merged_file_path, "r") as f:
+        for table in f.root:
+            assert table.filters.complib == "zlib"
+            assert table.filters.complevel == 1
+            assert table.chunkshape == (16,)
+
+    report = compression_report(merged_file_path)
+    assert report["CHEC"]["nrows"] == 100
+    assert report["CHEC"]["chunkshape"] == (16,)
+
+    # the shuffle or level alone would silently change the compression
+    with pytest.raises(subprocess.CalledProcessError):
+        run_merge(tmpdir, merged_file_path, "--shuffle", "bit")
+
+
+def test_parquet_output(tmpdir):
+
+    pytest.importorskip("pyarrow")
+    from protopipe_grid_interface.scripts.merge_tables import read_parquet_table
+
+    for i in range(5):
+        create_mock_file(tmpdir, f"run{i}.h5", value=i)
+
+    output_path = tmpdir.join("merged").strpath
+    run_merge(
+        tmpdir,
+        output_path,
+        "--output_format",
+        "parquet",
+        "--row_group_size",
+        "64",
+        "--n_workers",
+        "2",
+    )
+
+    for camera in ["NectarCam", "CHEC"]:
+        table = read_parquet_table(output_path, camera, columns=["n"])
+        assert table.column("n").to_pylist() == sum(([i] * 50 for i in range(5)), [])
+
+    # row groups are smaller if the buffer memory is not enough
+    import pyarrow.parquet as pq
+    from protopipe_grid_interface.scripts.merge_tables import write_parquet_dataset
+
+    write_parquet_dataset(
+        glob.glob(tmpdir.join("run*.h5").strpath),
+        output_path,
+        logger=logging.getLogger(__name__),
+        row_group_size=64,
+        buffer_mb=2 * 32 * 2 / 2**20,
+    )
+    for path in Path(output_path, "CHEC").glob("*.parquet"):
+        metadata = pq.ParquetFile(path).metadata
+        assert {
+            metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)
+        } == {32, 250 % 32}
+    table = read_parquet_table(output_path, "CHEC", columns=["n"])
+    assert table.column("n").to_pylist() == sum(([i] * 50 for i in range(5)), [])
+
+
+def test_merge_selection(tmpdir):
+
+    row = dict(n=tb.Int16Col(pos=0), intensity=tb.Float32Col(pos=1))
+    for i in range(4):
+        with tb.open_file(tmpdir.join(f"run{i}.h5").strpath, mode="w") as f:
+            for camera in ["NectarCam", "CHEC"]:
+                table = f.create_table("/", camera, row)
+                table.append([(i, intensity) for intensity in range(50)])
+
+    merged_file_path = tmpdir.join("merged_file.h5").strpath
+    run_merge(
+        tmpdir,
+        merged_file_path,
+        "--columns",
+        "n",
+        "--where",
+        "intensity >= 40",
+        "--n_workers",
+        "2",
+    )
+
+    with tb.open_file(merged_file_path, "r") as f:
+        for camera in ["NectarCam", "CHEC"]:
+            table = f.get_node("/", camera)
+            assert table.colnames == ["n"]
+            assert table.col("n").tolist() == sum(([i] * 10 for i in range(4)), [])
+
+
+def test_sorted_indexed_merge(tmpdir):
+
+    row = dict(obs_id=tb.Int64Col(pos=0), event_id=tb.Int64Col(pos=1))
+    rng = np.random.default_rng(0)
+    for i in range(3):
+        with tb.open_file(tmpdir.join(f"run{i}.h5").strpath, mode="w") as f:
+            for camera in ["NectarCam", "CHEC"]:
+                table = f.create_table("/", camera, row)
+                table.append(rng.integers(0, 20, size=(200, 2)).tolist())
+
+    merged_file_path = tmpdir.join("merged_file.h5").strpath
+    run_merge(
+        tmpdir,
+        merged_file_path,
+        "--sort_by",
+        "obs_id",
+        "event_id",
+        "--index_columns",
+        "event_id",
+        "--buffer_mb",
+        "0.001",
+    )
+
+    with tb.open_file(merged_file_path, "r") as f:
+        for camera in ["NectarCam", "CHEC"]:
+            table = f.get_node("/", camera)
+            rows = table.read()
+            assert len(rows) == 600
+            assert (rows == np.sort(rows, order=["obs_id", "event_id"])).all()
+            assert table.cols.obs_id.index.is_csi
+            assert table.cols.event_id.index.is_csi
+            assert (
+                len(table.read_where("event_id == 3")) == (rows["event_id"] == 3).sum()
+            )
+
+
+def test_sharded_merge(tmpdir):
+
+    for i in range(5):
+        create_mock_file(tmpdir, f"run{i}.h5", value=i)
+
+    merged_file_path = tmpdir.join("merged_file.h5").strpath
+    run_merge(tmpdir, merged_file_path, "--max_shard_rows", "100")
+
+    with open(tmpdir.join("merged_file.shards.json").strpath, "r") as f:
+        shards = json.load(f)["shards"]
+    assert [shard["filename"] for shard in shards] == [
+        f"merged_file_{i:04d}.h5" for i in range(3)
+    ]
+    assert [shard["tables"]["CHEC"] for shard in shards] == [
+        [0, 100],
+        [100, 200],
+        [200, 250],
+    ]
+    values = []
+    for shard in shards:
+        with tb.open_file(tmpdir.join(shard["filename"]).strpath, "r") as f:
+            values += f.root.CHEC.col("n").tolist()
+    assert values == sum(([i] * 50 for i in range(5)), [])
+
+    # a failed merge restarts after the last complete shard
+    first_shard = tmpdir.join("merged_file_0000.h5")
+    mtime = first_shard.mtime()
+    tmpdir.join("merged_file_0002.h5").remove()
+    run_merge(tmpdir, merged_file_path, "--max_shard_rows", "100")
+    assert first_shard.mtime() == mtime
+    assert tmpdir.join("merged_file_0002.h5").exists()
+
+    # without any valid input, the manifest lists no shard
+    for i in range(5):
+        tmpdir.join(f"run{i}.h5").write("not an HDF5 file")
+    run_merge(tmpdir, merged_file_path, "--max_shard_rows", "100")
+    with open(tmpdir.join("merged_file.shards.json").strpath, "r") as f:
+        assert json.load(f)["shards"] == []
+    assert not first_shard.exists()
+
+
+def test_streaming_merge(tmpdir):
+
+    for i in range(4):
+        create_mock_file(tmpdir, f"run{i}.h5", value=i)
+    tmpdir.join("run4.h5").write("not an HDF5 file")
+    with tb.open_file(tmpdir.join("run5.h5").strpath, mode="w") as f:
+        f.create_table("/", "CHEC", dict(n=tb.Float64Col(pos=0)))
+
+    merged_file_path = tmpdir.join("merged_file.h5").strpath
+    with StreamingMerger(
+        merged_file_path, logging.getLogger(__name__), n_files=6
+    ) as merger:
+        batches = [["run0.h5"], ["run1.h5", "run4.h5"], ["run5.h5", "run2.h5"]]
+        merged = [
+            merger.append([tmpdir.join(name).strpath for name in batch])
+            for batch in batches
+        ]
+        merged.append(merger.append([tmpdir.join("run3.h5").strpath]))
+
+    assert [len(files) for files in merged] == [1, 1, 1, 1]
+    with tb.open_file(merged_file_path, "r") as f:
+        assert f.root.CHEC.col("n").tolist() == sum(([i] * 50 for i in range(4)), [])
+
+
+def test_streaming_merge_schema_within_batch(tmpdir):
+
+    create_mock_file(tmpdir, "run0.h5", value=0)
+    create_mock_file(tmpdir, "run1.h5", value=1)
+    with tb.open_file(tmpdir.join("float.h5").strpath, mode="w") as f:
+        f.create_table("/", "CHEC", dict(n=tb.Float64Col(pos=0)))
+        f.root.CHEC.append([(0.5,)] * 10)
+    with tb.open_file(tmpdir.join("renamed.h5").strpath, mode="w") as f:
+        f.create_table("/", "CHEC", dict(m=tb.Int16Col(pos=0)))
+        f.root.CHEC.append([(7,)] * 10)
+
+    merged_file_path = tmpdir.join("merged_file.h5").strpath
+    with StreamingMerger(merged_file_path, logging.getLogger(__name__)) as merger:
+        merged = merger.append(
+            [
+                tmpdir.join(name).strpath
+                for name in ["run0.h5", "float.h5", "renamed.h5", "run1.h5"]
+            ]
+        )
+
+    assert merged == [tmpdir.join(name).strpath for name in ["run0.h5", "run1.h5"]]
+    statuses = {Path(scan["filename"]).name: scan["status"] for scan in merger.scans}
+    assert statuses["float.h5"] == statuses["renamed.h5"] == "mismatch"
+    with tb.open_file(merged_file_path, "r") as f:
+        assert f.root.CHEC.col("n").tolist() == [0] * 50 + [1] * 50
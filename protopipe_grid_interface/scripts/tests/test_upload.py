@@ -0,0 +1,225 @@
+import threading
+import time
+import zlib
+
+import pytest
+
+pytest.importorskip("DIRAC")
+
+from protopipe_grid_interface.utils import (
+    CachedFileCatalog,
+    upload_files,
+    upload_to_sites,
+    DEFAULT_SE,
+)
+
+
+class FakeDataManager:
+    """Stand-in for a DataManager and for the catalog where it registers files."""
+
+    def __init__(self, latency=0.05, broken_ses=()):
+        self.latency = latency
+        self.broken_ses = set(broken_ses)
+        self.replicas = {}
+        self.metadata = {}
+        self.transfers = []
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _transfer(self, lfn, se):
+        with self.lock:
+            self.transfers.append((lfn, se))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+            if se in self.broken_ses:
+                return {"OK": False, "Message": f"{se} unavailable"}
+            self.replicas.setdefault(lfn, []).append(se)
+        return {"OK": True, "Value": {"Successful": {lfn: {}}, "Failed": {}}}
+
+    def putAndRegister(self, lfn, fileName, diracSE, overwrite=False):
+        if lfn in self.metadata and not overwrite:
+            return {"OK": False, "Message": "File exists"}
+        self.replicas.pop(lfn, None)
+        result = self._transfer(lfn, diracSE)
+        if result["OK"]:
+            with open(fileName, "rb") as f:
+                content = f.read()
+            self.metadata[lfn] = {
+                "Size": len(content),
+                "Checksum": f"{zlib.adler32(content):x}",
+            }
+        return result
+
+    def replicateAndRegister(self, lfn, destSE, sourceSE=""):
+        # replicas are made from the uploaded file
+        assert sourceSE in self.replicas[lfn]
+        return self._transfer(lfn, destSE)
+
+    def getFileMetadata(self, lfns):
+        metadata = {lfn: self.metadata[lfn] for lfn in lfns if lfn in self.metadata}
+        return {"OK": True, "Value": {"Successful": metadata, "Failed": {}}}
+
+    def getReplicas(self, lfns):
+        replicas = {
+            lfn: {se: lfn for se in self.replicas[lfn]}
+            for lfn in lfns
+            if lfn in self.replicas
+        }
+        return {"OK": True, "Value": {"Successful": replicas, "Failed": {}}}
+
+
+def test_upload_and_replicate(tmpdir):
+
+    filenames = []
+    for camera in ["LSTCam", "NectarCam", "FlashCam"]:
+        tmpdir.join(f"regressor_{camera}.pkl.gz").write("model")
+        filenames.append(tmpdir.join(f"regressor_{camera}.pkl.gz").strpath)
+    outdir = "/vo.cta.in2p3.fr/user/x/xxx/analysis/estimators"
+    ses = ["DESY-ZN-USER", "CNAF-USER", "CEA-USER"]
+    data_manager = FakeDataManager(broken_ses=["CNAF-USER"])
+
+    results = upload_files(
+        filenames,
+        outdir,
+        se="CC-IN2P3-USER",
+        replicate_to=ses,
+        data_manager=data_manager,
+        concurrency=4,
+        catalog=data_manager,
+    )
+
+    assert data_manager.max_in_flight == 4
+    assert sorted(results) == sorted(
+        f"{outdir}/regressor_{camera}.pkl.gz"
+        for camera in ["LSTCam", "NectarCam", "FlashCam"]
+    )
+    for lfn, result in results.items():
+        assert result == {
+            "CC-IN2P3-USER": None,
+            "DESY-ZN-USER": None,
+            "CNAF-USER": "CNAF-USER unavailable",
+            "CEA-USER": None,
+        }
+        assert data_manager.replicas[lfn][0] == "CC-IN2P3-USER"
+
+    # nothing is replicated if the upload fails
+    data_manager = FakeDataManager(latency=0, broken_ses=["CC-IN2P3-USER"])
+    results = upload_files(
+        filenames[:1],
+        outdir,
+        se="CC-IN2P3-USER",
+        replicate_to=ses,
+        data_manager=data_manager,
+        catalog=data_manager,
+    )
+    assert results == {
+        f"{outdir}/regressor_LSTCam.pkl.gz": {
+            "CC-IN2P3-USER": "CC-IN2P3-USER unavailable"
+        }
+    }
+
+
+def test_skip_unchanged_uploads(tmpdir):
+
+    for name in ["analysis.yaml", "grid.yaml", "model.pkl.gz"]:
+        tmpdir.join(name).write(name)
+    filenames = [tmpdir.join(name).strpath for name in ["analysis.yaml", "grid.yaml"]]
+    outdir = "/vo.cta.in2p3.fr/user/x/xxx/analysis"
+    data_manager = FakeDataManager(latency=0, broken_ses=["CEA-USER"])
+    options = dict(
+        se="CC-IN2P3-USER",
+        replicate_to=["DESY-ZN-USER", "CEA-USER"],
+        data_manager=data_manager,
+        catalog=data_manager,
+        overwrite=True,
+    )
+    upload_files(filenames, outdir, **options)
+    assert len(data_manager.transfers) == 6
+
+    # grid.yaml changed, a new file, and CEA-USER is back
+    tmpdir.join("grid.yaml").write("changed")
+    data_manager.broken_ses = set()
+    data_manager.transfers = []
+    results = upload_files(
+        filenames + [tmpdir.join("model.pkl.gz").strpath], outdir, **options
+    )
+
+    # only the missing replica of the unchanged file is made
+    assert sorted(data_manager.transfers) == sorted(
+        [(f"{outdir}/analysis.yaml", "CEA-USER")]
+        + [
+            (f"{outdir}/{name}", se)
+            for name in ["grid.yaml", "model.pkl.gz"]
+            for se in ["CC-IN2P3-USER", "DESY-ZN-USER", "CEA-USER"]
+        ]
+    )
+    assert all(
+        reason is None for result in results.values() for reason in result.values()
+    )
+    assert sorted(data_manager.replicas[f"{outdir}/analysis.yaml"]) == [
+        "CC-IN2P3-USER",
+        "CEA-USER",
+        "DESY-ZN-USER",
+    ]
+
+    # changed files are replaced even without overwrite
+    tmpdir.join("analysis.yaml").write("changed again")
+    data_manager.transfers = []
+    results = upload_files(filenames, outdir, **dict(options, overwrite=False))
+    assert sorted(data_manager.transfers) == sorted(
+        (f"{outdir}/analysis.yaml", se)
+        for se in ["CC-IN2P3-USER", "DESY-ZN-USER", "CEA-USER"]
+    )
+    assert all(
+        reason is None for result in results.values() for reason in result.values()
+    )
+    assert data_manager.metadata[f"{outdir}/analysis.yaml"]["Size"] == 13
+
+
+def test_upload_invalidates_catalog_cache(tmpdir):
+
+    tmpdir.join("model.pkl.gz").write("model")
+    filenames = [tmpdir.join("model.pkl.gz").strpath]
+    outdir = "/vo.cta.in2p3.fr/user/x/xxx/analysis"
+    lfn = f"{outdir}/model.pkl.gz"
+    data_manager = FakeDataManager(latency=0)
+    catalog = CachedFileCatalog(
+        data_manager, path=tmpdir.join("catalog.sqlite").strpath
+    )
+
+    def cached_size():
+        return catalog.getFileMetadata([lfn])["Value"]["Successful"][lfn]["Size"]
+
+    options = dict(se="CC-IN2P3-USER", data_manager=data_manager, catalog=catalog)
+    upload_files(filenames, outdir, **options)
+    assert cached_size() == 5
+
+    tmpdir.join("model.pkl.gz").write("changed")
+    results = upload_files(filenames, outdir, **options)
+    assert results == {lfn: {"CC-IN2P3-USER": None}}
+    assert cached_size() == 7
+
+
+@pytest.mark.parametrize("upload_sites", [None, [], ["DESY-ZN-USER", "CEA-USER"]])
+def test_upload_to_sites(tmpdir, upload_sites):
+
+    tmpdir.join("analysis.yaml").write("analysis")
+    outdir = "/vo.cta.in2p3.fr/user/x/xxx/analysis"
+    data_manager = FakeDataManager(latency=0)
+
+    se, results = upload_to_sites(
+        [tmpdir.join("analysis.yaml").strpath],
+        outdir,
+        upload_sites,
+        data_manager=data_manager,
+        catalog=data_manager,
+    )
+
+    ses = upload_sites or [DEFAULT_SE]
+    assert se == ses[0]
+    assert results == {f"{outdir}/analysis.yaml": {site: None for site in ses}}
+    assert data_manager.replicas[f"{outdir}/analysis.yaml"] == ses
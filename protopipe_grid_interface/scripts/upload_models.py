@@ -1,10 +1,15 @@
 import argparse
 from argparse import RawTextHelpFormatter
 from pathlib import Path
-import subprocess
 import yaml
 
-from protopipe_grid_interface.utils import initialize_logger, upload, load_config
+from protopipe_grid_interface.utils import (
+    initialize_logger,
+    load_config,
+    upload_files,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_SE,
+)
 
 
 def main():
@@ -78,6 +83,14 @@ def main():
         help="List of DIRAC Storage Elements which will host the uploaded models",
     )
 
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"""Number of uploads and replications at the same time
+                (default: {DEFAULT_CONCURRENCY})""",
+    )
+
     parser.add_argument(
         "--analysis_name",
         type=str,
@@ -141,82 +154,41 @@ def main():
     )
     output_directory = grid_home / grid_path_from_home / analysis_name / "estimators"
 
-    # Upload configuration file
-    configuration_file = f"{args.model_name}.yaml"
+    # Upload the configuration file and the model files
+    configuration_file = analysis_configuration_directory / f"{args.model_name}.yaml"
+    model_files = [
+        input_directory / f"{args.model_type}_{camera}_{args.model_name}.pkl.gz"
+        for camera in args.cameras
+    ]
     log.info(
-        "Uploading %s from %s to %s",
-        configuration_file,
-        analysis_configuration_directory,
+        "Uploading %s and %d model files from %s to %s",
+        configuration_file.name,
+        len(model_files),
+        input_directory,
         output_directory,
     )
-    upload(analysis_configuration_directory, configuration_file, output_directory)
-    # Make replicas
-    # but check that some upload sites have been defined
-    if upload_sites:
-        for se in upload_sites:
-            log.info("Producing replicas of %s on %s", configuration_file, se)
-            try:
-                result = subprocess.run(
-                    [
-                        "dirac-dms-replicate-lfn",
-                        str(output_directory / configuration_file),
-                        se,
-                    ],
-                    check=True,
-                    text=True,
-                    capture_output=True,
-                )
-                log.debug(result)
-            except subprocess.CalledProcessError as e:
-                log.error("Exit status: %s", e.returncode)
-                log.error("Command: %s", e.cmd)
-                log.error("STDOUT: %s", e.stdout)
-                log.error("STDERR: %s", e.stderr)
-    else:
-        log.error(
-            "No replicas have been produced as no upload site has been specified."
-        )
-
-    # Upload model files
-    for camera in args.cameras:
-
-        model_file = f"{args.model_type}_{camera}_{args.model_name}.pkl.gz"
+    # Replicas are made only if some upload sites have been defined
+    if not upload_sites:
+        log.error("No replicas will be produced as no upload site has been specified.")
+    results = upload_files(
+        [configuration_file] + model_files,
+        output_directory,
+        replicate_to=upload_sites,
+        concurrency=args.concurrency,
+        logger=log,
+    )
+    for lfn, result in results.items():
         log.info(
-            "Uploading %s from %s to %s...",
-            model_file,
-            input_directory,
-            output_directory,
+            "%s: stored on %s, failed on %s",
+            lfn,
+            [se for se, reason in result.items() if reason is None],
+            [se for se, reason in result.items() if reason is not None],
         )
-        upload(input_directory, model_file, output_directory)
-
-        # Make replicas
-        if upload_sites:
-            for se in upload_sites:
-                log.info("Producing replicas of %s on %s...", model_file, se)
-                try:
-                    result = subprocess.run(
-                        [
-                            "dirac-dms-replicate-lfn",
-                            str(output_directory / model_file),
-                            se,
-                        ],
-                        check=True,
-                        text=True,
-                        capture_output=True,
-                    )
-                    log.debug(result)
-                except subprocess.CalledProcessError as e:
-                    log.error("Exit status: %s", e.returncode)
-                    log.error("Command: %s", e.cmd)
-                    log.error("STDOUT: %s", e.stdout)
-                    log.error("STDERR: %s", e.stderr)
-        else:
-            log.error(
-                "No replicas have been produced as no upload site has been specified."
-            )
-
+    if any(reason is not None for r in results.values() for reason in r.values()):
+        raise SystemExit("Some files could not be uploaded or replicated")
     log.info(
-        "Models and configuration files have been uploaded (at least on CC-IN2P3-USER)."
+        "Models and configuration files have been uploaded (at least on %s).",
+        DEFAULT_SE,
     )
 
 
@@ -1,17 +1,43 @@
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager, nullcontext
+from fnmatch import fnmatch
+import hashlib
+import json
 import logging
 import logging.config
 import os
 from pkg_resources import resource_filename
+import re
 import shutil
-import subprocess
+import sqlite3
+import threading
+import time
+import zlib
 import yaml
 from pathlib import Path
 
+from DIRAC.DataManagementSystem.Client.DataManager import DataManager
 from DIRAC.Interfaces.API.Dirac import Dirac
+from DIRAC.Resources.Catalog.FileCatalog import FileCatalog
+from DIRAC.Resources.Storage.StorageElement import StorageElement
 
 log = logging.getLogger(__name__)
 
 DEFAULT_SE = "CC-IN2P3-USER"
+# Number of files transferred at the same time by default
+DEFAULT_CONCURRENCY = 8
+# Local cache of the answers of the file catalog
+DEFAULT_CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "protopipe_grid_interface"
+)
+DEFAULT_CATALOG_CACHE = DEFAULT_CACHE_DIR / "catalog.sqlite"
+DEFAULT_CACHE_TTL = 3600
+# Local history of the transfers from each Storage Element
+DEFAULT_SE_HISTORY = DEFAULT_CACHE_DIR / "storage_elements.sqlite"
+# Linux ioctl cloning a file (reflink) on copy-on-write filesystems
+FICLONE = 0x40049409
 
 
 class CustomFormatter(logging.Formatter):
@@ -123,7 +149,523 @@ def check_voms():
         )
 
 
-def download(indir, outdir):
+@contextmanager
+def _sqlite_connection(path):
+    """Open a SQLite connection committing at the end of the block, then closed."""
+    connection = sqlite3.connect(path, timeout=60)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+class CachedFileCatalog:
+    """File catalog answering from a local SQLite cache when possible.
+
+    Directory listings (listDirectory), file metadata such as size and
+    checksum (getFileMetadata) and replicas (getReplicas) are stored in a
+    SQLite database the first time they are asked, and later requests for the
+    same paths are answered from it until the entries are older than ttl.
+    Only the paths missing from the cache (or expired) are asked to the
+    catalog, and only successful answers are cached.
+    The database can be shared by several processes.
+
+    Entries must be invalidated (see `invalidate`) when files are added or
+    removed, e.g. after uploads and deletions.
+
+    Parameters
+    ----------
+    catalog: DIRAC.Resources.Catalog.FileCatalog.FileCatalog
+        Catalog to query for entries missing from the cache
+        (default: new FileCatalog object, created at the first query)
+    path: str or pathlib.Path
+        Path of the SQLite database
+    ttl: float
+        Time after which cached entries are queried again, in seconds
+
+    """
+
+    TABLES = {
+        "listDirectory": "directories",
+        "getFileMetadata": "metadata",
+        "getReplicas": "replicas",
+    }
+
+    def __init__(self, catalog=None, path=DEFAULT_CATALOG_CACHE, ttl=DEFAULT_CACHE_TTL):
+        self._catalog = catalog
+        self.path = Path(path)
+        self.ttl = ttl
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            for table in self.TABLES.values():
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} "
+                    "(path TEXT PRIMARY KEY, value TEXT, cached_at REAL)"
+                )
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = FileCatalog()
+        return self._catalog
+
+    def _connect(self):
+        return _sqlite_connection(self.path)
+
+    def _query(self, method, paths, *args, **kwargs):
+        if isinstance(paths, (str, Path)):
+            paths = [paths]
+        paths = [str(path) for path in paths]
+        table = self.TABLES[method]
+
+        now = time.time()
+        values = {}
+        with self._connect() as connection:
+            for start in range(0, len(paths), 500):
+                batch = paths[start : start + 500]
+                rows = connection.execute(
+                    f"SELECT path, value FROM {table} "
+                    f"WHERE cached_at > ? AND path IN ({','.join('?' * len(batch))})",
+                    [now - self.ttl] + batch,
+                )
+                values.update((path, json.loads(value)) for path, value in rows)
+
+        failed = {}
+        missing = [path for path in paths if path not in values]
+        if missing:
+            result = getattr(self.catalog, method)(missing, *args, **kwargs)
+            if not result["OK"]:
+                return result
+            successful = result["Value"]["Successful"]
+            failed = result["Value"]["Failed"]
+            values.update(successful)
+            with self._connect() as connection:
+                connection.executemany(
+                    f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)",
+                    [
+                        (path, json.dumps(value, default=str), now)
+                        for path, value in successful.items()
+                    ],
+                )
+
+        successful = {path: values[path] for path in paths if path in values}
+        return {"OK": True, "Value": {"Successful": successful, "Failed": failed}}
+
+    def listDirectory(self, paths, *args, **kwargs):
+        """List directories, see FileCatalog.listDirectory."""
+        return self._query("listDirectory", paths, *args, **kwargs)
+
+    def getFileMetadata(self, lfns, *args, **kwargs):
+        """Get metadata of files, see FileCatalog.getFileMetadata."""
+        return self._query("getFileMetadata", lfns, *args, **kwargs)
+
+    def getReplicas(self, lfns, *args, **kwargs):
+        """Get replicas of files, see FileCatalog.getReplicas."""
+        return self._query("getReplicas", lfns, *args, **kwargs)
+
+    def invalidate(self, paths):
+        """Remove from the cache files or directories, and their parents.
+
+        Entries of the files and directories under each path, and the
+        listings of the directories containing it, are removed.
+        """
+        if isinstance(paths, (str, Path)):
+            paths = [paths]
+        with self._connect() as connection:
+            for path in paths:
+                path = str(path).rstrip("/")
+                parents = [str(parent) for parent in Path(path).parents]
+                for table in self.TABLES.values():
+                    connection.execute(
+                        f"DELETE FROM {table} WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                        (path, _escape_like(path) + "/%"),
+                    )
+                connection.executemany(
+                    "DELETE FROM directories WHERE path = ?",
+                    [(parent,) for parent in parents],
+                )
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._connect() as connection:
+            for table in self.TABLES.values():
+                connection.execute(f"DELETE FROM {table}")
+
+
+def _escape_like(text):
+    """Escape the wildcards of a SQL LIKE pattern."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def invalidate_catalog_cache(paths, path=DEFAULT_CATALOG_CACHE):
+    """Remove paths from the catalog cache, if any (see CachedFileCatalog)."""
+    if Path(path).exists():
+        CachedFileCatalog(path=path).invalidate(paths)
+
+
+class StorageElementHistory:
+    """Throughput and failures of the downloads from each Storage Element (SE).
+
+    Each transfer updates exponentially weighted moving averages of the
+    throughput (for successful transfers) and of the failure rate of its SE,
+    stored in a SQLite database so that they build up over many downloads.
+
+    Parameters
+    ----------
+    path: str or pathlib.Path
+        Path of the SQLite database
+    weight: float
+        Weight of the last transfer in the moving averages
+    max_failure_rate: float
+        SEs failing more often than this are ranked last
+
+    """
+
+    def __init__(self, path=DEFAULT_SE_HISTORY, weight=0.2, max_failure_rate=0.5):
+        self.path = Path(path)
+        self.weight = weight
+        self.max_failure_rate = max_failure_rate
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with _sqlite_connection(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS storage_elements (se TEXT PRIMARY KEY, "
+                "mbps REAL, failure_rate REAL, n_transfers INTEGER, updated_at REAL)"
+            )
+
+    def record(self, se, n_bytes, seconds, success=True):
+        """Add a transfer to the history of an SE."""
+        with _sqlite_connection(self.path) as connection:
+            # lock the database until the update is committed
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT mbps, failure_rate, n_transfers FROM storage_elements "
+                "WHERE se = ?",
+                (se,),
+            ).fetchone()
+            mbps = n_bytes / 2**20 / seconds if (success and seconds > 0) else None
+            if row is None:
+                row = (mbps, float(not success), 1)
+            else:
+                old_mbps, failure_rate, n_transfers = row
+                if mbps is not None and old_mbps is not None:
+                    mbps = (1 - self.weight) * old_mbps + self.weight * mbps
+                elif mbps is None:
+                    mbps = old_mbps
+                failure_rate = (1 - self.weight) * failure_rate + self.weight * (
+                    not success
+                )
+                row = (mbps, failure_rate, n_transfers + 1)
+            connection.execute(
+                "INSERT OR REPLACE INTO storage_elements VALUES (?, ?, ?, ?, ?)",
+                (se,) + row + (time.time(),),
+            )
+
+    def statistics(self):
+        """Throughput (MB/s), failure rate and number of transfers by SE."""
+        with _sqlite_connection(self.path) as connection:
+            rows = connection.execute(
+                "SELECT se, mbps, failure_rate, n_transfers FROM storage_elements"
+            ).fetchall()
+        return {
+            se: {"mbps": mbps, "failure_rate": failure_rate, "n_transfers": n}
+            for se, mbps, failure_rate, n in rows
+        }
+
+    def rank(self, ses, statistics=None):
+        """Sort SEs from the most to the least preferred.
+
+        Healthy SEs come first, fastest first; SEs without a measured
+        throughput are assumed to be as fast as the median of the known ones,
+        so that they get tried; unhealthy SEs come last.
+        """
+        if statistics is None:
+            statistics = self.statistics()
+        known = sorted(
+            entry["mbps"] for entry in statistics.values() if entry["mbps"] is not None
+        )
+        median = known[len(known) // 2] if known else 0.0
+
+        def key(se):
+            entry = statistics.get(se, {})
+            healthy = entry.get("failure_rate", 0.0) <= self.max_failure_rate
+            mbps = entry.get("mbps")
+            return (not healthy, -(median if mbps is None else mbps), se)
+
+        return sorted(ses, key=key)
+
+
+def link_file(source, destination):
+    """Make destination a copy of source, sharing its data if possible.
+
+    A hard link is tried first, then a reflink (copy-on-write clone, on
+    Linux filesystems supporting it), and the file is copied otherwise,
+    e.g. across filesystems.
+
+    Returns
+    -------
+    method: str
+        "hardlink", "reflink" or "copy"
+
+    """
+    destination = Path(destination)
+    if destination.exists():
+        destination.unlink()
+    try:
+        os.link(source, destination)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        import fcntl
+
+        with open(source, mode="rb") as src, open(destination, mode="wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return "reflink"
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(source, destination)
+    return "copy"
+
+
+class DownloadCache:
+    """Local cache of downloaded files, shared by the analyses of a production.
+
+    Files are stored once under a name derived from their LFN and checksum,
+    so that a file changed on the GRID is a new entry, and are linked into
+    the output directory of each download (see `link_file`) instead of
+    being transferred again.
+    When the cache grows beyond max_size_gb, the least recently used files
+    are removed; their data is only freed once no analysis links to them.
+    Since hard links share their data with the cache, cached files are made
+    read-only: downloaded files must be replaced, not modified in place.
+    The files are indexed in a SQLite database, so that the cache can be
+    shared by several processes.
+
+    Parameters
+    ----------
+    directory: str or pathlib.Path
+        Directory of the cache, e.g. shared_folder/productions/download_cache
+    max_size_gb: float
+        Size limit of the cache (default: no limit)
+
+    """
+
+    def __init__(self, directory, max_size_gb=None):
+        self.directory = Path(directory)
+        self.max_size_gb = max_size_gb
+        self.path = self.directory / "index.sqlite"
+        (self.directory / "files").mkdir(parents=True, exist_ok=True)
+        with _sqlite_connection(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, "
+                "lfn TEXT, checksum TEXT, size INTEGER, last_used REAL)"
+            )
+
+    @staticmethod
+    def key(lfn, checksum):
+        """Name of the cached copy of a version of a file."""
+        return hashlib.sha256(f"{lfn}\n{int(checksum, 16):08x}".encode()).hexdigest()
+
+    def _filename(self, key):
+        return self.directory / "files" / key[:2] / key
+
+    def get(self, lfn, checksum, destination):
+        """Link the cached copy of a file to destination if there is one.
+
+        Returns whether the file was found in the cache.
+        """
+        key = self.key(lfn, checksum)
+        with _sqlite_connection(self.path) as connection:
+            found = connection.execute(
+                "UPDATE files SET last_used = ? WHERE key = ?", (time.time(), key)
+            ).rowcount
+        if not found:
+            return False
+        try:
+            link_file(self._filename(key), destination)
+        except FileNotFoundError:
+            # removed by another process in the meantime
+            return False
+        return True
+
+    def put(self, lfn, checksum, filename, logger=log):
+        """Add a downloaded file to the cache, if its checksum is right.
+
+        Least recently used files are then removed if the cache is too large.
+        Returns whether the file was added.
+        """
+        if adler32(filename) != f"{int(checksum, 16):08x}":
+            logger.warning("Checksum of %s differs from the catalog: not cached", lfn)
+            return False
+        key = self.key(lfn, checksum)
+        cached = self._filename(key)
+        cached.parent.mkdir(exist_ok=True)
+        # link to a temporary name first, so that a cached file is always complete
+        temporary = cached.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}")
+        link_file(filename, temporary)
+        # a file modified in place would corrupt the cache
+        os.chmod(temporary, temporary.stat().st_mode & ~0o222)
+        os.replace(temporary, cached)
+        with _sqlite_connection(self.path) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (key, lfn, checksum, cached.stat().st_size, time.time()),
+            )
+        self.evict()
+        return True
+
+    def fetch(self, lfns, outdir, metadata, logger=log):
+        """Link the cached copies of files into a directory.
+
+        Parameters
+        ----------
+        lfns: list
+            Logical File Names of the files
+        outdir: str or pathlib.Path
+            Output directory
+        metadata: dict
+            Catalog metadata by LFN, with the checksum of each file
+            (see `get_file_metadata`)
+        logger: logging.Logger
+            Logger
+
+        Returns
+        -------
+        lfns: list
+            Logical File Names of the files which are not in the cache
+
+        """
+        missing = [
+            lfn
+            for lfn in lfns
+            if not metadata.get(lfn, {}).get("Checksum")
+            or not self.get(
+                lfn,
+                metadata[lfn]["Checksum"],
+                Path(outdir) / os.path.basename(lfn),
+            )
+        ]
+        logger.info(
+            "%d of %d files found in the cache %s",
+            len(lfns) - len(missing),
+            len(lfns),
+            self.directory,
+        )
+        return missing
+
+    def size(self):
+        """Total size of the cached files, in bytes."""
+        with _sqlite_connection(self.path) as connection:
+            return connection.execute("SELECT SUM(size) FROM files").fetchone()[0] or 0
+
+    def evict(self, max_size_gb=None):
+        """Remove the least recently used files until the cache fits in max_size_gb.
+
+        Returns the number of files removed.
+        """
+        max_size_gb = self.max_size_gb if max_size_gb is None else max_size_gb
+        if max_size_gb is None:
+            return 0
+        with _sqlite_connection(self.path) as connection:
+            # lock the database until the files are removed
+            connection.execute("BEGIN IMMEDIATE")
+            excess = connection.execute("SELECT SUM(size) FROM files").fetchone()[0]
+            excess = (excess or 0) - max_size_gb * 2**30
+            removed = []
+            rows = connection.execute(
+                "SELECT key, size FROM files ORDER BY last_used"
+            ).fetchall()
+            for key, size in rows:
+                if excess <= 0:
+                    break
+                self._filename(key).unlink(missing_ok=True)
+                removed.append((key,))
+                excess -= size
+            connection.executemany("DELETE FROM files WHERE key = ?", removed)
+        return len(removed)
+
+
+def list_lfns(base_dir, pattern=None, catalog=None, batch_size=100, logger=log):
+    """Iterate over the files under a directory of the file catalog.
+
+    The directory tree is walked breadth-first, listing up to batch_size
+    directories with each call to the catalog, and the files of each listed
+    directory are yielded before the next call.
+    Directories which cannot be listed are skipped with an error message.
+
+    Parameters
+    ----------
+    base_dir: str or pathlib.Path
+        Directory of the catalog (e.g. /vo.cta.in2p3.fr/user/x/xxx/analysis)
+    pattern: str
+        Shell-style pattern on the file names (e.g. "*.h5", default: all files)
+    catalog: DIRAC.Resources.Catalog.FileCatalog.FileCatalog
+        Catalog to list (default: new FileCatalog object)
+    batch_size: int
+        Number of directories listed with each call to the catalog
+    logger: logging.Logger
+        Logger
+
+    Yields
+    ------
+    lfn: str
+        Logical File Name of a file, sorted by name within each directory
+
+    """
+    if catalog is None:
+        catalog = FileCatalog()
+    directories = [str(base_dir)]
+    while directories:
+        batch, directories = directories[:batch_size], directories[batch_size:]
+        result = catalog.listDirectory(batch)
+        if not result["OK"]:
+            raise IOError(f"Cannot list {batch}: {result['Message']}")
+        for directory, reason in result["Value"]["Failed"].items():
+            logger.error("Cannot list %s: %s", directory, reason)
+        for directory in batch:
+            content = result["Value"]["Successful"].get(directory)
+            if content is None:
+                continue
+            for lfn in sorted(content["Files"]):
+                if pattern is None or fnmatch(os.path.basename(lfn), pattern):
+                    yield lfn
+            directories.extend(sorted(content["SubDirs"]))
+
+
+def _cache_callback(cache, metadata):
+    """Callback of `download_files` adding the downloaded files to a cache."""
+
+    def callback(lfn, filename):
+        if metadata.get(lfn, {}).get("Checksum"):
+            cache.put(lfn, metadata[lfn]["Checksum"], filename)
+
+    return callback
+
+
+def _checksum_error(filename, metadata):
+    """Reason why a file differs from its catalog metadata, or None.
+
+    Files without a checksum in the catalog are not checked.
+    """
+    if not (metadata or {}).get("Checksum"):
+        return None
+    checksum = adler32(filename)
+    if int(checksum, 16) != int(metadata["Checksum"], 16):
+        return f"Adler32 checksum {checksum} instead of {metadata['Checksum']}"
+    return None
+
+
+def download(
+    indir,
+    outdir,
+    concurrency=DEFAULT_CONCURRENCY,
+    skip_existing=True,
+    catalog=None,
+    se_history=None,
+    transfer_slots=None,
+    cache=None,
+):
     """Download files from a user's folder on the GRID.
 
     Parameters
@@ -132,6 +674,29 @@ def download(indir, outdir):
         Input directory on the GRID
     outdir: str or pathlib.Path
         Output directory
+    concurrency: int
+        Number of files transferred (or checked) at the same time
+    skip_existing: bool
+        If True (default), do not download again the files already in outdir
+        whose size and Adler32 checksum match those in the catalog
+        (see `files_to_download`)
+    catalog: DIRAC.Resources.Catalog.FileCatalog.FileCatalog
+        Catalog listing the files and their metadata, e.g. a
+        `CachedFileCatalog` (default: new FileCatalog object)
+    se_history: StorageElementHistory
+        If set, download each file from its replica on the Storage Element
+        which has been the fastest and most reliable (see `download_files`)
+    transfer_slots: threading.Semaphore
+        Semaphore limiting the transfers shared with other downloads
+        (see `download_files`)
+    cache: DownloadCache
+        If set, files found in this cache are linked into outdir instead of
+        being downloaded, and downloaded files are added to it
+
+    Returns
+    -------
+    failed: dict
+        Reasons of the failure by LFN, for files which could not be downloaded
 
     """
 
@@ -139,32 +704,424 @@ def download(indir, outdir):
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
-    # Get list of files
-    batcmd = f"dirac-dms-user-lfns --BaseDir {indir}"
-    result = subprocess.check_output(batcmd, shell=True)
-    file_list = result.split()[-1]
+    if catalog is None:
+        catalog = FileCatalog()
 
-    # Open list and download each file
-    try:
-        with open(file_list, mode="r", encoding="utf8") as f:
-            dirac = Dirac()
+    lfns = list(list_lfns(indir, catalog=catalog))
+
+    if skip_existing:
+        lfns = files_to_download(lfns, outdir, catalog=catalog, n_workers=concurrency)
+
+    metadata = None
+    if cache is not None or se_history is not None:
+        metadata = get_file_metadata(lfns, catalog=catalog)
+
+    callback = None
+    if cache is not None:
+        lfns = cache.fetch(lfns, outdir, metadata)
+        callback = _cache_callback(cache, metadata)
 
-            file_collection = []
-            for line in f.read().splitlines():
+    replicas = None
+    if se_history is not None:
+        replicas = get_replicas(lfns, catalog=catalog)
 
-                if len(file_collection) < 100:
-                    file_collection.append(line)  # files will be downloaded later
+    return download_files(
+        lfns,
+        outdir,
+        concurrency=concurrency,
+        replicas=replicas,
+        se_history=se_history,
+        transfer_slots=transfer_slots,
+        callback=callback,
+        metadata=metadata,
+    )
+
+
+def get_file_metadata(lfns, catalog=None, batch_size=1000, logger=log):
+    """Get the catalog metadata (size, checksum...) of files.
+
+    Parameters
+    ----------
+    lfns: list
+        Logical File Names of the files
+    catalog: DIRAC.Resources.Catalog.FileCatalog.FileCatalog
+        Catalog with the metadata (default: new FileCatalog object)
+    batch_size: int
+        Number of files asked with each call to the catalog
+    logger: logging.Logger
+        Logger
+
+    Returns
+    -------
+    metadata: dict
+        Metadata by LFN (files without known metadata are missing)
+
+    """
+    if catalog is None:
+        catalog = FileCatalog()
+    metadata = {}
+    for start in range(0, len(lfns), batch_size):
+        batch = lfns[start : start + batch_size]
+        result = catalog.getFileMetadata(batch)
+        if not result["OK"]:
+            logger.warning("Could not get the metadata: %s", result["Message"])
+            continue
+        metadata.update(result["Value"]["Successful"])
+    return metadata
+
+
+def get_replicas(lfns, catalog=None, batch_size=1000, logger=log):
+    """Get the Storage Elements hosting a replica of each file.
+
+    Parameters
+    ----------
+    lfns: list
+        Logical File Names of the files
+    catalog: DIRAC.Resources.Catalog.FileCatalog.FileCatalog
+        Catalog with the replicas (default: new FileCatalog object)
+    batch_size: int
+        Number of files asked with each call to the catalog
+    logger: logging.Logger
+        Logger
+
+    Returns
+    -------
+    replicas: dict
+        Names of the SEs by LFN (files without known replicas are missing)
+
+    """
+    if catalog is None:
+        catalog = FileCatalog()
+    replicas = {}
+    for start in range(0, len(lfns), batch_size):
+        batch = lfns[start : start + batch_size]
+        result = catalog.getReplicas(batch)
+        if not result["OK"]:
+            logger.warning("Could not get the replicas: %s", result["Message"])
+            continue
+        for lfn, ses in result["Value"]["Successful"].items():
+            replicas[lfn] = sorted(ses)
+    return replicas
+
+
+def adler32(filename, block_size=2**20):
+    """Compute the Adler32 checksum of a file.
+
+    Returns
+    -------
+    checksum: str
+        Checksum as 8 hexadecimal digits, as stored in the DIRAC catalog
+
+    """
+    checksum = 1
+    with open(filename, mode="rb") as f:
+        block = f.read(block_size)
+        while block:
+            checksum = zlib.adler32(block, checksum)
+            block = f.read(block_size)
+    return f"{checksum:08x}"
+
+
+def files_to_download(
+    lfns, outdir, catalog=None, n_workers=DEFAULT_CONCURRENCY, logger=log
+):
+    """Select the files which are missing or different in a local directory.
+
+    Local files are compared with the size and Adler32 checksum registered
+    in the catalog; checksums are only computed (in parallel) for files
+    whose size matches.
+    Local files which differ are removed, so that they are downloaded again.
+    Local files whose size or checksum is unknown to the catalog (e.g. if
+    it cannot be reached) are neither verified nor removed, and are not
+    downloaded again.
+
+    Parameters
+    ----------
+    lfns: list
+        Logical File Names of the files to download
+    outdir: str or pathlib.Path
+        Output directory
+    catalog: DIRAC.Resources.Catalog.FileCatalog.FileCatalog
+        Catalog with the metadata of the files (default: new FileCatalog object)
+    n_workers: int
+        Number of threads computing checksums
+    logger: logging.Logger
+        Logger
+
+    Returns
+    -------
+    lfns: list
+        Logical File Names of the files to download
+
+    """
+    local_files = {lfn: Path(outdir) / os.path.basename(lfn) for lfn in lfns}
+    existing = [lfn for lfn in lfns if local_files[lfn].exists()]
+    if not existing:
+        return list(lfns)
+
+    metadata = get_file_metadata(existing, catalog=catalog, logger=logger)
+
+    different = {
+        lfn
+        for lfn in existing
+        if lfn in metadata
+        and metadata[lfn].get("Size") is not None
+        and local_files[lfn].stat().st_size != metadata[lfn]["Size"]
+    }
+    to_check = [
+        lfn
+        for lfn in existing
+        if lfn in metadata and lfn not in different and metadata[lfn].get("Checksum")
+    ]
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as pool:
+        checksums = dict(
+            zip(to_check, pool.map(adler32, [local_files[lfn] for lfn in to_check]))
+        )
+    up_to_date = set()
+    for lfn, checksum in checksums.items():
+        if int(checksum, 16) == int(metadata[lfn]["Checksum"], 16):
+            up_to_date.add(lfn)
+        else:
+            different.add(lfn)
+
+    for lfn in different:
+        logger.debug("Local copy of %s differs from the catalog", lfn)
+        local_files[lfn].unlink()
+
+    # without size and checksum in the catalog, local copies cannot be
+    # verified: they are kept as they are
+    unverified = [
+        lfn for lfn in existing if lfn not in up_to_date and lfn not in different
+    ]
+    if unverified:
+        logger.warning(
+            "%d files in %s could not be verified against the catalog "
+            "and are kept as they are (e.g. %s)",
+            len(unverified),
+            outdir,
+            unverified[0],
+        )
+
+    logger.info(
+        "%d of %d files are already in %s and up to date",
+        len(up_to_date),
+        len(lfns),
+        outdir,
+    )
+    kept = up_to_date.union(unverified)
+    return [lfn for lfn in lfns if lfn not in kept]
+
+
+def log_se_ranking(ses, ranking, statistics, logger=log):
+    """Log the Storage Elements used for downloads, from the most preferred.
+
+    Parameters
+    ----------
+    ses: list
+        SEs hosting the files, from the most to the least preferred
+    ranking: dict
+        SEs of each LFN, from the most to the least preferred
+    statistics: dict
+        Statistics of the SEs (see `StorageElementHistory.statistics`)
+    logger: logging.Logger
+        Logger
+
+    """
+    first_choices = Counter(ranked[0] for ranked in ranking.values() if ranked)
+    logger.info("Ranking of the Storage Elements:")
+    for se in ses:
+        entry = statistics.get(se)
+        if entry is None or entry["mbps"] is None:
+            throughput = "unknown throughput"
+        else:
+            throughput = f"{entry['mbps']:.1f} MB/s"
+        logger.info(
+            "%s: %s, %.0f%% failures over %d transfers, first choice for %d files",
+            se,
+            throughput,
+            100 * entry["failure_rate"] if entry else 0.0,
+            entry["n_transfers"] if entry else 0,
+            first_choices[se],
+        )
+
+
+def download_files(
+    lfns,
+    outdir,
+    dirac=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    retries=3,
+    backoff=1.0,
+    logger=log,
+    replicas=None,
+    se_history=None,
+    storage_element=StorageElement,
+    transfer_slots=None,
+    callback=None,
+    metadata=None,
+):
+    """Download files from the GRID keeping several transfers in flight.
+
+    Each file is fetched with its own call to Dirac.getFile from a pool of
+    threads, so that a slow transfer does not hold back the others.
+    Failed transfers are retried after waiting backoff, 2 * backoff,
+    4 * backoff... seconds.
+
+    If the replicas of the files and a history of the Storage Elements (SE)
+    are given, each file is instead fetched directly from its SE ranked best
+    by the history (see `StorageElementHistory.rank`), retries going through
+    the next SEs in the ranking, and each transfer is added to the history.
+    Since such transfers, unlike Dirac.getFile, do not check the file, their
+    Adler32 checksum is compared with that in metadata, a different one
+    counting as a failed transfer from the SE.
+
+    Parameters
+    ----------
+    lfns: list
+        Logical File Names of the files to download
+    outdir: str or pathlib.Path
+        Output directory
+    dirac: DIRAC.Interfaces.API.Dirac.Dirac
+        Object used for the transfers.
+        Default is None, using a new Dirac object in each thread.
+    concurrency: int
+        Number of files transferred at the same time
+    retries: int
+        Number of times a failed transfer is tried again
+    backoff: float
+        Waiting time before the first retry, in seconds
+    logger: logging.Logger
+        Logger
+    replicas: dict
+        SEs hosting a replica of each file, by LFN
+    se_history: StorageElementHistory
+        History of the transfers from each SE
+    storage_element: callable
+        Returns the object used to transfer files from an SE given its name
+        (default: DIRAC StorageElement)
+    transfer_slots: threading.Semaphore
+        If set, each transfer holds the semaphore, which limits the number of
+        transfers of several concurrent downloads sharing it
+    callback: callable
+        Called with the LFN and the local path of each file once it has been
+        downloaded, from the thread of the transfer (which waits for it to
+        return before starting the next one), e.g. to process the files
+        while the others are still being downloaded
+    metadata: dict
+        Catalog metadata by LFN (see `get_file_metadata`), whose checksums
+        are used to verify the files transferred from an SE
+
+    Returns
+    -------
+    failed: dict
+        Reasons of the failure by LFN, for files which could not be downloaded
+
+    """
+    local = threading.local()
+
+    def get_dirac():
+        if dirac is not None:
+            return dirac
+        if not hasattr(local, "dirac"):
+            local.dirac = Dirac()
+        return local.dirac
+
+    def get_storage_element(se):
+        if not hasattr(local, "storage_elements"):
+            local.storage_elements = {}
+        if se not in local.storage_elements:
+            local.storage_elements[se] = storage_element(se)
+        return local.storage_elements[se]
+
+    ranking = {}
+    if replicas and se_history is not None:
+        statistics = se_history.statistics()
+        ranking = {
+            lfn: se_history.rank(replicas.get(lfn, []), statistics) for lfn in lfns
+        }
+        ses = {se for ranked in ranking.values() for se in ranked}
+        log_se_ranking(se_history.rank(ses, statistics), ranking, statistics, logger)
+
+    def get_file(lfn):
+        ses = ranking.get(lfn) or [None]
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            se = ses[attempt % len(ses)]
+            start = time.perf_counter()
+            try:
+                with transfer_slots or nullcontext():
+                    if se is None:
+                        result = get_dirac().getFile(lfn, destDir=str(outdir))
+                    else:
+                        result = get_storage_element(se).getFile(
+                            lfn, localPath=str(outdir)
+                        )
+            except Exception as error:  # pylint: disable=broad-except
+                reason = repr(error)
+            else:
+                if not result["OK"]:
+                    reason = result["Message"]
+                elif lfn in result["Value"]["Failed"]:
+                    reason = result["Value"]["Failed"][lfn]
                 else:
-                    dirac.getFile(file_collection, destDir=outdir)
-                    file_collection = []  # there won't be any loop at the end
-            if file_collection:
-                dirac.getFile(file_collection, destDir=outdir)
-    except IOError:
-        raise IOError("cannot read lfns file list...") from None
+                    reason = None
+            if se is not None:
+                local_file = Path(outdir) / os.path.basename(lfn)
+                if reason is None:
+                    reason = _checksum_error(local_file, (metadata or {}).get(lfn))
+                    if reason is not None:
+                        local_file.unlink()
+                se_history.record(
+                    se,
+                    local_file.stat().st_size if reason is None else 0,
+                    time.perf_counter() - start,
+                    success=reason is None,
+                )
+            if reason is None:
+                if callback is not None:
+                    callback(lfn, Path(outdir) / os.path.basename(lfn))
+                return None
+            logger.debug(
+                "Attempt %d of %d for %s failed: %s",
+                attempt + 1,
+                retries + 1,
+                lfn,
+                reason,
+            )
+        return reason
+
+    start = time.perf_counter()
+    n_bytes = 0
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        futures = {pool.submit(get_file, lfn): lfn for lfn in lfns}
+        for future in as_completed(futures):
+            lfn = futures[future]
+            reason = future.result()
+            if reason is None:
+                local_file = Path(outdir) / os.path.basename(lfn)
+                if local_file.exists():
+                    n_bytes += local_file.stat().st_size
+            else:
+                failed[lfn] = reason
+                logger.error("Could not download %s: %s", lfn, reason)
+    elapsed = time.perf_counter() - start
+
+    logger.info(
+        "Downloaded %d of %d files (%.1f MB) in %.1f s: %.1f MB/s with %d transfers",
+        len(lfns) - len(failed),
+        len(lfns),
+        n_bytes / 2**20,
+        elapsed,
+        n_bytes / 2**20 / elapsed if elapsed > 0 else float("nan"),
+        concurrency,
+    )
+    return failed
 
 
 def upload(indir, infile, outdir, se=DEFAULT_SE):
-    """Upload a file to the grid using dirac-dms-add-file.
+    """Upload a file to the grid.
 
     Parameters
     ----------
@@ -178,23 +1135,460 @@ def upload(indir, infile, outdir, se=DEFAULT_SE):
         Dirac Storage Element
 
     """
+    upload_files([os.path.join(indir, infile)], outdir, se=se, concurrency=1)
 
-    file_to_upload = os.path.join(indir, infile)
-    file_on_dirac = os.path.join(outdir, infile)
 
-    try:
-        result = subprocess.run(
-            ["dirac-dms-add-file", file_on_dirac, file_to_upload, se],
-            check=True,
-            text=True,
-            capture_output=True,
+def _dirac_result_error(result, lfn):
+    """Reason of the failure of a DIRAC operation on a file, or None."""
+    if not result["OK"]:
+        return result["Message"]
+    if lfn in result["Value"]["Failed"]:
+        return result["Value"]["Failed"][lfn]
+    return None
+
+
+def unchanged_files(filenames, outdir, catalog=None, n_workers=4, logger=log):
+    """Find the local files which are already on the GRID, unchanged.
+
+    Files are compared with the size and Adler32 checksum registered in the
+    catalog; checksums are only computed for files whose size matches.
+
+    Parameters
+    ----------
+    filenames: list
+        Paths of the local files
+    outdir: str or pathlib.Path
+        Directory of the files on the GRID
+    catalog: DIRAC.Resources.Catalog.FileCatalog.FileCatalog
+        Catalog with the metadata and replicas of the files
+        (default: new FileCatalog object)
+    n_workers: int
+        Number of threads computing checksums
+    logger: logging.Logger
+        Logger
+
+    Returns
+    -------
+    replicas: dict
+        Storage Elements hosting a replica of each unchanged file, by LFN
+
+    """
+    if catalog is None:
+        catalog = FileCatalog()
+    lfns = {
+        os.path.join(str(outdir), os.path.basename(filename)): filename
+        for filename in filenames
+    }
+    metadata = get_file_metadata(list(lfns), catalog=catalog, logger=logger)
+    same_size = [
+        lfn
+        for lfn in lfns
+        if lfn in metadata and os.path.getsize(lfns[lfn]) == metadata[lfn]["Size"]
+    ]
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as pool:
+        checksums = dict(
+            zip(same_size, pool.map(adler32, [lfns[lfn] for lfn in same_size]))
+        )
+    unchanged = [
+        lfn
+        for lfn, checksum in checksums.items()
+        if int(checksum, 16) == int(metadata[lfn]["Checksum"] or "0", 16)
+    ]
+    replicas = get_replicas(unchanged, catalog=catalog, logger=logger)
+    return {lfn: replicas.get(lfn, []) for lfn in unchanged}
+
+
+def upload_files(
+    filenames,
+    outdir,
+    se=DEFAULT_SE,
+    replicate_to=None,
+    data_manager=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    overwrite=False,
+    skip_unchanged=True,
+    catalog=None,
+    logger=log,
+):
+    """Upload files to the GRID and replicate them, with several transfers at once.
+
+    Each file is uploaded to a first Storage Element (SE) and registered in
+    the catalog (DataManager.putAndRegister, as dirac-dms-add-file), then
+    replicated from there to each of the other SEs
+    (DataManager.replicateAndRegister, as dirac-dms-replicate-lfn).
+    Uploads and replications run in a pool of threads, each replication
+    starting as soon as the upload of its file is done.
+
+    Files already on the GRID with the same size and checksum
+    (see `unchanged_files`) are not uploaded again, but only replicated to
+    the SEs which do not have them, while files registered with a different
+    content are replaced.
+
+    Parameters
+    ----------
+    filenames: list
+        Paths of the local files
+    outdir: str or pathlib.Path
+        Output directory on the GRID
+    se: str
+        SE where the files are uploaded
+    replicate_to: list
+        SEs where the files are then replicated
+    data_manager: DIRAC.DataManagementSystem.Client.DataManager.DataManager
+        Object used for the transfers.
+        Default is None, using a new DataManager object in each thread.
+    concurrency: int
+        Number of transfers at the same time
+    overwrite: bool
+        Replace files already registered in the catalog
+        (with skip_unchanged, changed files are replaced in any case)
+    skip_unchanged: bool
+        If True (default), do not upload again unchanged files
+    catalog: DIRAC.Resources.Catalog.FileCatalog.FileCatalog
+        Catalog used to find unchanged files (default: new FileCatalog object)
+    logger: logging.Logger
+        Logger
+
+    Returns
+    -------
+    results: dict
+        By LFN, the reason of the failure of the transfer to each SE
+        (None if successful, or if the SE already had the file);
+        replications of files which could not be uploaded are missing
+
+    """
+    local = threading.local()
+
+    def get_data_manager():
+        if data_manager is not None:
+            return data_manager
+        if not hasattr(local, "data_manager"):
+            local.data_manager = DataManager()
+        return local.data_manager
+
+    def transfer(lfn, filename, target, source=None):
+        try:
+            if source is None:
+                result = get_data_manager().putAndRegister(
+                    lfn, str(filename), target, overwrite=overwrite or lfn in changed
+                )
+            else:
+                result = get_data_manager().replicateAndRegister(
+                    lfn, target, sourceSE=source
+                )
+        except Exception as error:  # pylint: disable=broad-except
+            return repr(error)
+        return _dirac_result_error(result, lfn)
+
+    lfns = {
+        os.path.join(str(outdir), os.path.basename(filename)): filename
+        for filename in filenames
+    }
+    targets = [se] + [target for target in replicate_to or [] if target != se]
+    unchanged = {}
+    changed = set()
+    if skip_unchanged:
+        if catalog is None:
+            catalog = FileCatalog()
+        unchanged = {
+            lfn: replicas
+            for lfn, replicas in unchanged_files(
+                lfns.values(), outdir, catalog=catalog, logger=logger
+            ).items()
+            if replicas
+        }
+        if not overwrite:
+            # files registered with another content are replaced
+            changed = set(
+                get_file_metadata(
+                    [lfn for lfn in lfns if lfn not in unchanged],
+                    catalog=catalog,
+                    logger=logger,
+                )
+            )
+            for lfn in sorted(changed):
+                logger.info("%s changed: replacing it on the GRID", lfn)
+
+    results = {lfn: {} for lfn in lfns}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        futures = {}
+        for lfn, filename in lfns.items():
+            if lfn not in unchanged:
+                futures[pool.submit(transfer, lfn, filename, se)] = (lfn, se)
+                continue
+            # replicate from an SE which has it, preferably the first one
+            source = se if se in unchanged[lfn] else unchanged[lfn][0]
+            for target in targets:
+                if target in unchanged[lfn]:
+                    results[lfn][target] = None
+                else:
+                    future = pool.submit(transfer, lfn, filename, target, source)
+                    futures[future] = (lfn, target)
+        # replications are added to the pool as uploads complete
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                lfn, target = futures.pop(future)
+                reason = future.result()
+                results[lfn][target] = reason
+                if reason is not None:
+                    logger.error("Could not transfer %s to %s: %s", lfn, target, reason)
+                    continue
+                logger.debug("%s transferred to %s", lfn, target)
+                if target != se or lfn in unchanged:
+                    continue
+                for replica_se in targets[1:]:
+                    replication = pool.submit(transfer, lfn, lfns[lfn], replica_se, se)
+                    futures[replication] = (lfn, replica_se)
+    elapsed = time.perf_counter() - start
+
+    transferred = [
+        lfn
+        for lfn in lfns
+        if lfn not in unchanged or set(targets) - set(unchanged[lfn])
+    ]
+    if transferred:
+        if isinstance(catalog, CachedFileCatalog):
+            catalog.invalidate(transferred)
+        else:
+            invalidate_catalog_cache(transferred)
+    uploads = [results[lfn][se] for lfn in lfns if lfn not in unchanged]
+    replicas = [
+        reason
+        for lfn, result in results.items()
+        for target, reason in result.items()
+        if (target != se or lfn in unchanged) and target not in unchanged.get(lfn, [])
+    ]
+    logger.info(
+        "Uploaded %d of %d files to %s (%d unchanged) and made %d of %d replicas"
+        " in %.1f s",
+        uploads.count(None),
+        len(uploads),
+        se,
+        len(unchanged),
+        replicas.count(None),
+        len(replicas),
+        elapsed,
+    )
+    return results
+
+
+def upload_to_sites(filenames, outdir, upload_sites=None, logger=log, **options):
+    """Upload files to the first of a list of SEs, and replicate them to the others.
+
+    Parameters
+    ----------
+    filenames: list
+        Paths of the local files
+    outdir: str or pathlib.Path
+        Output directory on the GRID
+    upload_sites: list
+        SEs where the files are stored, the first one receiving the upload
+        (default, or if empty: DEFAULT_SE only)
+    logger: logging.Logger
+        Logger
+    options:
+        Other options of `upload_files`
+
+    Returns
+    -------
+    se: str
+        SE where the files have been uploaded
+    results: dict
+        Results of the transfers (see `upload_files`)
+
+    """
+    upload_sites = list(upload_sites or [])
+    se = upload_sites[0] if upload_sites else DEFAULT_SE
+    logger.info(
+        "Uploading %s to %s, then replicating them to %s...",
+        [os.path.basename(filename) for filename in filenames],
+        se,
+        upload_sites[1:],
+    )
+    results = upload_files(
+        filenames,
+        outdir,
+        se=se,
+        replicate_to=upload_sites[1:],
+        logger=logger,
+        **options,
+    )
+    return se, results
+
+
+class RateLimiter:
+    """Space out calls made from several threads to at most rate per second.
+
+    Parameters
+    ----------
+    rate: float
+        Maximum number of calls per second (None for no limit)
+
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        """Wait for the next available slot."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def submit_job_list(
+    jobs,
+    dirac=None,
+    concurrency=4,
+    max_rate=None,
+    logger=log,
+):
+    """Submit jobs to the DIRAC WMS from a pool of threads.
+
+    Each job is submitted with its own call to Dirac.submitJob, so that
+    the latency of the submissions (including the upload of their input
+    sandboxes) overlaps, while at most max_rate submissions per second
+    are started to spare the WMS.
+    A failed submission does not stop the others.
+
+    Parameters
+    ----------
+    jobs: list
+        Pairs of a key identifying the job (e.g. its run token) and the
+        DIRAC.Interfaces.API.Job.Job object
+    dirac: DIRAC.Interfaces.API.Dirac.Dirac
+        Object used for the submissions.
+        Default is None, using a new Dirac object in each thread.
+    concurrency: int
+        Number of submissions at the same time
+    max_rate: float
+        Maximum number of submissions started per second (default: no limit)
+    logger: logging.Logger
+        Logger
+
+    Returns
+    -------
+    submitted: dict
+        Job ID by key, for the submitted jobs
+    failed: dict
+        Reason of the failure by key, for the other jobs
+
+    """
+    local = threading.local()
+    rate_limiter = RateLimiter(max_rate)
+
+    def get_dirac():
+        if dirac is not None:
+            return dirac
+        if not hasattr(local, "dirac"):
+            local.dirac = Dirac()
+        return local.dirac
+
+    def submit(job):
+        rate_limiter.wait()
+        try:
+            result = get_dirac().submitJob(job)
+        except Exception as error:  # pylint: disable=broad-except
+            return False, repr(error)
+        if not result["OK"]:
+            return False, result["Message"]
+        return True, result["Value"]
+
+    start = time.perf_counter()
+    submitted = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        futures = {pool.submit(submit, job): key for key, job in jobs}
+        for future in as_completed(futures):
+            key = futures[future]
+            ok, value = future.result()
+            if ok:
+                submitted[key] = value
+                logger.debug("Job %s submitted with ID %s", key, value)
+            else:
+                failed[key] = value
+                logger.critical("Job submission failed for %s: %s", key, value)
+    elapsed = time.perf_counter() - start
+
+    logger.info(
+        "Submitted %d of %d jobs in %.1f s (%.1f jobs/s) with %d submissions at once",
+        len(submitted),
+        len(jobs),
+        elapsed,
+        len(submitted) / elapsed if elapsed > 0 else float("nan"),
+        concurrency,
+    )
+    return submitted, failed
+
+
+def check_parametric_jdl(jdl, n_jobs=None):
+    """Check the description (JDL) of parametric jobs before submitting it.
+
+    Every placeholder %(name)s must have a parameter sequence
+    (Parameters.name), and all sequences must have one value per job.
+
+    Parameters
+    ----------
+    jdl: str
+        Job description, e.g. from DIRAC.Interfaces.API.Job.Job._toJDL()
+    n_jobs: int
+        Expected number of jobs (default: the Parameters attribute)
+
+    Returns
+    -------
+    sequences: dict
+        Values of each parameter sequence by name
+
+    Raises
+    ------
+    ValueError
+        If the description is not consistent
+
+    """
+    sequences = {
+        name: [
+            quoted or unquoted
+            for quoted, unquoted in re.findall(
+                r'"((?:[^"\\]|\\.)*)"|([^\s,"]+)', values
+            )
+        ]
+        for name, values in re.findall(
+            r"Parameters\.(\w+)\s*=\s*\{(.*?)\}\s*;", jdl, flags=re.DOTALL
+        )
+    }
+    if not sequences:
+        raise ValueError("The job description has no parameter sequence")
+
+    match = re.search(r"\bParameters\s*=\s*(\d+)\s*;", jdl)
+    if n_jobs is None:
+        if match is None:
+            raise ValueError("The job description has no number of parameters")
+        n_jobs = int(match.group(1))
+    elif match is not None and int(match.group(1)) != n_jobs:
+        raise ValueError(f"Parameters = {match.group(1)} instead of {n_jobs}")
+
+    wrong_lengths = {
+        name: len(values) for name, values in sequences.items() if len(values) != n_jobs
+    }
+    if wrong_lengths:
+        raise ValueError(
+            f"Parameter sequences without {n_jobs} values: {wrong_lengths}"
+        )
+    undefined = set(re.findall(r"%\((\w+)\)s", jdl)) - set(sequences)
+    if undefined:
+        raise ValueError(
+            f"Placeholders without parameter sequence: {sorted(undefined)}"
         )
-        log.debug(result)
-    except subprocess.CalledProcessError as e:
-        log.error("Exit status: %s", e.returncode)
-        log.error("Command: %s", e.cmd)
-        log.error("STDOUT: %s", e.stdout)
-        log.error("STDERR: %s", e.stderr)
+    return sequences
 
 
 def load_config(input_file):
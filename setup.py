@@ -8,10 +8,11 @@ extras_require = {
         "codecov",
         "pyyaml",
         "tables",
-    ]
+    ],
+    "parquet": ["pyarrow"],
 }
 
-extras_require["all"] = list(set(extras_require["tests"]))
+extras_require["all"] = list(set(extras_require["tests"] + extras_require["parquet"]))
 
 
 setup(
@@ -45,7 +46,7 @@ setup(
         "Programming Language :: Python :: 3.8",
     ],
     python_requires=">=3.8,<3.9",
-    extras_require={"all": extras_require["tests"], "tests": extras_require["tests"]},
+    extras_require=extras_require,
     entry_points={
         "console_scripts": [
             "protopipe-SPLIT_DATASET=protopipe_grid_interface.scripts.split_dataset:main",